@@ -24,7 +24,21 @@ def argument_parser():
                         help="split index (note: 0-based)")
     parser.add_argument('--train-sampler', type=str, default='',
                         help="sampler for trainloader")
+    parser.add_argument('--hard-sampler-refresh', type=int, default=200,
+                        help="number of batches between identity prototype refreshes (for --train-sampler HardIdentitySampler)")
     parser.add_argument('--data-augment', type=str, nargs='+', choices=['none', 'crop', 'random-erase', 'color-jitter', 'crop,random-erase', 'crop,color-jitter', 'crop,color-jitter,random-erase'], default='crop')
+    parser.add_argument('--draft-decode', action='store_true',
+                        help="decode JPEGs at reduced resolution (DCT scaling) close to --height x --width")
+    parser.add_argument('--batch-augment', action='store_true',
+                        help="apply training augmentation to whole batches on device instead of per image in workers")
+    parser.add_argument('--uint8-loader', action='store_true',
+                        help="load images as uint8 tensors and normalize them on device")
+    parser.add_argument('--shared-workers', action='store_true',
+                        help="serve train and test loaders from one persistent pool of -j workers")
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help="number of batches prefetched per worker (with --shared-workers)")
+    parser.add_argument('--io-threads', type=int, default=0,
+                        help="number of files each worker reads concurrently ahead of decoding (0 to disable)")
     # ************************************************************
     # Video datasets
     # ************************************************************
@@ -33,7 +47,8 @@ def argument_parser():
     parser.add_argument('--sample-method', type=str, default='evenly',
                         help="how to sample images from a tracklet")
     parser.add_argument('--pool-tracklet-features', type=str, default='avg', choices=['avg', 'max'],
-                        help="how to pool features over a tracklet (for video reid)")
+                        help="how to pool features over a tracklet (for video reid; only read by callers of "
+                             "torchreid.utils.torchtools.extract_tracklet_features, no script here evaluates video reid)")
 
     # ************************************************************
     # CUHK03-specific setting
@@ -42,6 +57,8 @@ def argument_parser():
                         help="use labeled images, if false, use detected images")
     parser.add_argument('--cuhk03-classic-split', action='store_true',
                         help="use classic split by Li et al. CVPR'14")
+    parser.add_argument('--cuhk03-packed', action='store_true',
+                        help="extract images into packed arrays instead of png files")
     parser.add_argument('--use-metric-cuhk03', action='store_true',
                         help="use cuhk03's metric for evaluation")
 
@@ -69,6 +86,8 @@ def argument_parser():
                         help="exponential decay rate for adam's first moment")
     parser.add_argument('--adam-beta2', default=0.999, type=float,
                         help="exponential decay rate for adam's second moment")
+    parser.add_argument('--zero-optimizer', action='store_true',
+                        help="with distributed training, shard the optimizer state across processes (ZeRO stage 1)")
 
     # ************************************************************
     # Training hyperparameters
@@ -91,6 +110,9 @@ def argument_parser():
                         help="always fix base network")
     parser.add_argument('--fixbase-epoch', type=int, default=10,
                         help="how many epochs to fix base network (only train randomly initialized classifier)")
+    parser.add_argument('--fixbase-cache', type=int, default=0,
+                        help="during fixbase epochs, train the heads from the cached backbone outputs of this many "
+                             "augmented versions of the training set (0 to disable)")
     parser.add_argument('--open-layers', type=str, nargs='+', default=['classifier'],
                         help="open specified layers for training while keeping others frozen")
 
@@ -120,6 +142,10 @@ def argument_parser():
                         help="weight to balance cross entropy loss")
     parser.add_argument('--lambda-htri', type=float, default=0.1,
                         help="weight to balance hard triplet loss")
+    parser.add_argument('--xbm-size', type=int, default=0,
+                        help="number of recent embeddings kept per triplet head for hard mining across batches (0 to disable)")
+    parser.add_argument('--xbm-start', type=int, default=1000,
+                        help="number of iterations before mining in the cross-batch memory")
 
     # ************************************************************
     # Architecture
@@ -138,6 +164,21 @@ def argument_parser():
     parser.add_argument('--start-eval', type=int, default=0,
                         help="start to evaluate after a specific epoch")
     parser.add_argument('--flip-eval', action='store_true')
+    parser.add_argument('--proxy-eval-ids', type=int, default=0,
+                        help="evaluate on the queries of this many random identities (and a gallery subset) "
+                             "at eval epochs, and on the full test set only every --full-eval-freq epochs (0 to disable)")
+    parser.add_argument('--proxy-eval-negatives', type=int, default=2000,
+                        help="number of gallery images of other identities in the proxy test set")
+    parser.add_argument('--full-eval-freq', type=int, default=-1,
+                        help="full evaluation frequency with --proxy-eval-ids (set to -1 to fully test only in the end)")
+    parser.add_argument('--background-eval', action='store_true',
+                        help="evaluate the saved checkpoints in a separate process while training goes on")
+    parser.add_argument('--eval-gpu-devices', type=str, default='',
+                        help="gpu device ids of the background evaluation ('cpu' for the CPU, the training ones by default)")
+    parser.add_argument('--eval-cpus', type=str, default='',
+                        help="cpu cores of the background evaluation, e.g. 0-3,8 (all by default)")
+    parser.add_argument('--eval-worker', action='store_true',
+                        help=argparse.SUPPRESS)
 
     # ************************************************************
     # Miscs
@@ -150,8 +191,28 @@ def argument_parser():
                         help="resume from a checkpoint")
     parser.add_argument('--save-dir', type=str, default='log',
                         help="path to save log and model weights")
+    parser.add_argument('--keep-checkpoints', type=int, default=1,
+                        help="number of latest epoch checkpoints kept (besides the best one)")
     parser.add_argument('--use-cpu', action='store_true',
                         help="use cpu")
+    parser.add_argument('--amp', action='store_true',
+                        help="mixed precision training (fp16 with loss scaling on GPU, bf16 on CPU)")
+    parser.add_argument('--compile', action='store_true',
+                        help="compile the model with torch.compile")
+    parser.add_argument('--activation-checkpointing', nargs='+', type=str, default=[],
+                        help="recompute in backward the activations of: common, deep (or deep<i> for branch i), attention")
+    parser.add_argument('--channels-last', action='store_true',
+                        help="use the channels_last (NHWC) memory format for the model and its inputs")
+    parser.add_argument('--dist-backend', type=str, default=None, choices=['nccl', 'gloo'],
+                        help="backend for distributed training launched by torchrun (default: nccl on GPU, gloo on CPU)")
+    parser.add_argument('--step-stats-freq', type=int, default=0,
+                        help="write per-phase step timings to <save-dir>/step_stats.jsonl every N steps (0 to disable)")
+    parser.add_argument('--sync-timing', action='store_true',
+                        help="synchronize the device around timed phases (accurate, but slower)")
+    parser.add_argument('--profile-steps', type=str, default='',
+                        help="profile training steps START-STOP (e.g. 50-60, counted from 0 over all epochs) with torch.profiler")
+    parser.add_argument('--profile-eval', action='store_true',
+                        help="profile the feature extraction of the first evaluation with torch.profiler")
     parser.add_argument('--gpu-devices', default='0', type=str,
                         help='gpu device ids for CUDA_VISIBLE_DEVICES')
     parser.add_argument('--use-avai-gpus', action='store_true',
@@ -213,11 +274,19 @@ def image_dataset_kwargs(parsed_args):
         'train_batch_size': parsed_args.train_batch_size,
         'test_batch_size': parsed_args.test_batch_size,
         'workers': parsed_args.workers,
-        'train_sampler': parsed_args.train_sampler if 'htri' not in parsed_args.criterion or os.environ.get('ns') else 'RandomIdentitySampler',
+        'train_sampler': parsed_args.train_sampler if 'htri' not in parsed_args.criterion or os.environ.get('ns') or parsed_args.train_sampler == 'HardIdentitySampler' else 'RandomIdentitySampler',
+        'hard_sampler_refresh': parsed_args.hard_sampler_refresh,
         'num_instances': parsed_args.num_instances,
         'cuhk03_labeled': parsed_args.cuhk03_labeled,
         'cuhk03_classic_split': parsed_args.cuhk03_classic_split,
+        'cuhk03_packed': parsed_args.cuhk03_packed,
         'data_augment': parsed_args.data_augment,
+        'draft_decode': parsed_args.draft_decode,
+        'batch_augment': parsed_args.batch_augment,
+        'uint8': parsed_args.uint8_loader,
+        'shared_workers': parsed_args.shared_workers,
+        'prefetch': parsed_args.prefetch,
+        'io_threads': parsed_args.io_threads,
         # 'flip_eval': parsed_args.flip_eval,
     }
 
@@ -238,7 +307,8 @@ def video_dataset_kwargs(parsed_args):
         'test_batch_size': parsed_args.test_batch_size,
         'workers': parsed_args.workers,
         'seq_len': parsed_args.seq_len,
-        'sample_method': parsed_args.sample_method
+        'sample_method': parsed_args.sample_method,
+        'pool_tracklet_features': parsed_args.pool_tracklet_features,
     }
 
 
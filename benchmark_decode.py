@@ -0,0 +1,64 @@
+"""
+Measure how much image decoding time `--draft-decode` saves per epoch.
+
+For every dataset, a fixed random subset of training images is decoded
+with and without reduced-size decoding, and the difference is
+extrapolated to the full training set.
+
+Usage:
+    python benchmark_decode.py -s veri cub_200_2011 vehicleid --height 384 --width 128
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import random
+import time
+
+from torchreid.datasets import init_imgreid_dataset
+from torchreid.dataset_loader import read_image, _turbo_jpeg
+from torchreid.transforms import get_decode_size
+
+
+def time_decode(img_paths, size):
+
+    start = time.time()
+    for img_path in img_paths:
+        read_image(img_path, size)
+    return time.time() - start
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('--root', type=str, default='data')
+    parser.add_argument('-s', '--source-names', type=str, required=True, nargs='+')
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=128)
+    parser.add_argument('--data-augment', type=str, nargs='+', default=['crop'])
+    parser.add_argument('--num-images', type=int, default=500,
+                        help="number of training images to decode per dataset")
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    print("Decoder backend: {}".format('libjpeg-turbo (PyTurboJPEG)' if _turbo_jpeg is not None else 'PIL'))
+    size = get_decode_size(args.height, args.width, is_train=True, data_augment=args.data_augment)
+
+    print("  dataset          | # train | full (ms/img) | draft (ms/img) | saved/epoch (s)")
+    for name in args.source_names:
+        dataset = init_imgreid_dataset(root=args.root, name=name, verbose=False)
+        img_paths = [item[0] for item in dataset.train]
+        random.Random(args.seed).shuffle(img_paths)
+        img_paths = img_paths[:args.num_images]
+
+        # warm up the page cache so both passes measure decoding only
+        time_decode(img_paths, None)
+        full = time_decode(img_paths, None) / len(img_paths)
+        draft = time_decode(img_paths, size) / len(img_paths)
+
+        print("  {:16s} | {:7d} | {:13.3f} | {:14.3f} | {:15.1f}".format(
+            name, len(dataset.train), full * 1e3, draft * 1e3, (full - draft) * len(dataset.train)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+"""
+Run a set of train.py experiments concurrently on the local machine.
+
+The experiments are described by a JSON file:
+
+    {
+        "base": "-s market1501 -t market1501 --arch resnet50 ...",
+        "grid": {"--of-beta": ["1e-5", "1e-6"], "--use-of": [true, false]},
+        "runs": [{"name": "xent", "args": "--criterion xent"},
+                 {"name": "htri", "args": "--criterion htri", "resources": {"gpus": 2}}],
+        "resources": {"cpus": 8, "gpus": 1, "memory_gb": 24}
+    }
+
+Every entry of "runs" (a string of arguments, or a dict) is combined with
+every point of "grid" and appended to "base". A grid value of true / false
+adds / omits a flag. "resources" is what each run needs, overridable per
+run; runs without GPUs train on the CPU.
+
+Runs are started, in order, as soon as enough of the resources given on
+the command line are free, so smaller runs fill the gaps left by larger
+ones. Each run is pinned to its own CPU cores and GPUs; memory is only
+accounted for, not enforced. Before the first run, the dataset index
+caches are built once for all runs. Failed runs are retried from their
+last checkpoint. Runs whose save directory already holds a summary.json
+are not run again, so an interrupted scheduler can simply be restarted.
+The rank-1 of every run is summarized in <save-root>/summary.tsv.
+
+Usage:
+    python scheduler.py scripts/abl_of.json --save-root log/abl_of --cpus 0-31 --gpus 0,1,2,3 --memory-gb 200
+"""
+
+from __future__ import print_function
+from __future__ import division
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import os.path as osp
+import shlex
+import subprocess
+import sys
+import time
+
+from args import argument_parser
+from torchreid.datasets import init_imgreid_dataset
+from torchreid.utils.background_eval import parse_cpus
+from torchreid.utils.iotools import mkdir_if_missing
+
+
+class Run(object):
+    """
+    One train.py run and its state in the scheduler.
+
+    Args:
+    - name (str): name of the run, also its directory in the save root.
+    - args (list): arguments of train.py.
+    - resources (dict): number of 'cpus' and 'gpus', and 'memory_gb' needed.
+    - save_dir (str): --save-dir of the run.
+    """
+
+    def __init__(self, name, args, resources, save_dir):
+        self.name = name
+        self.args = args
+        self.num_cpus = int(resources.get('cpus', 1))
+        self.num_gpus = int(resources.get('gpus', 0))
+        self.memory_gb = float(resources.get('memory_gb', 0))
+        self.save_dir = save_dir
+        self.attempts = 0
+        self.status = 'pending'
+        self.elapsed = 0.
+        self.process = None
+        self.cpus = self.gpus = []
+
+    @property
+    def summary_path(self):
+        return osp.join(self.save_dir, 'summary.json')
+
+    def start(self, cpus, gpus):
+        self.cpus, self.gpus = cpus, gpus
+        self.attempts += 1
+        self.status = 'running'
+        self.start_time = time.time()
+
+        # in the working directory of the scheduler, which relative paths (--root, --save-dir) refer to
+        argv = [sys.executable, osp.join(osp.dirname(osp.abspath(__file__)), 'train.py')] + self.args + ['--save-dir', self.save_dir]
+        if gpus:
+            argv += ['--gpu-devices', ','.join(str(gpu) for gpu in gpus)]
+        else:
+            argv.append('--use-cpu')
+        latest = osp.join(self.save_dir, 'checkpoint_latest.pth.tar')
+        if self.attempts > 1 and osp.exists(latest):
+            argv += ['--resume', latest]
+
+        env = dict(os.environ)
+        env['OMP_NUM_THREADS'] = env['MKL_NUM_THREADS'] = str(len(cpus))
+        mkdir_if_missing(self.save_dir)
+        # log_train.txt is rewritten by every attempt, stdout.txt keeps all of them
+        with open(osp.join(self.save_dir, 'stdout.txt'), 'a') as f:
+            self.process = subprocess.Popen(
+                argv, env=env, stdout=f, stderr=subprocess.STDOUT,
+                preexec_fn=lambda: os.sched_setaffinity(0, cpus)
+            )
+        print("{} Started {} (attempt {}) on cpus {} and {}".format(
+            _now(), self.name, self.attempts, _format_cpus(cpus),
+            'gpus {}'.format(','.join(str(gpu) for gpu in gpus)) if gpus else 'no gpu'))
+
+    def poll(self):
+        """
+        Return the exit code of the run, or None if it is running.
+        """
+        code = self.process.poll()
+        if code is not None:
+            self.elapsed += time.time() - self.start_time
+        return code
+
+
+def _now():
+    return datetime.datetime.now().strftime('[%H:%M:%S]')
+
+
+def _format_cpus(cpus):
+    return '{}-{}'.format(cpus[0], cpus[-1]) if cpus == list(range(cpus[0], cpus[-1] + 1)) else \
+        ','.join(str(cpu) for cpu in cpus)
+
+
+def expand_runs(spec, save_root):
+    """
+    Return the runs described by `spec`, see the module docstring.
+    """
+    base = shlex.split(spec.get('base', ''))
+    grid = spec.get('grid', {})
+    entries = spec.get('runs', [''])
+
+    runs = []
+    names = set()
+    for entry in entries:
+        if not isinstance(entry, dict):
+            entry = {'args': entry}
+        resources = dict(spec.get('resources', {}))
+        resources.update(entry.get('resources', {}))
+
+        for values in itertools.product(*grid.values()):
+            args = base + shlex.split(entry.get('args', ''))
+            name_parts = [entry['name']] if 'name' in entry else []
+            for key, value in zip(grid, values):
+                if value is True:
+                    args.append(key)
+                elif value is not False:
+                    args += [key] + shlex.split(str(value))
+                name_parts.append('{}={}'.format(key.lstrip('-'), str(value).replace(' ', ',')))
+
+            name = '_'.join(name_parts) or 'run{}'.format(len(runs))
+            if name in names:
+                name = '{}_{}'.format(name, len(runs))
+            names.add(name)
+            runs.append(Run(name, args, resources, osp.join(save_root, name)))
+    return runs
+
+
+def prepare_datasets(runs):
+    """
+    Parse the arguments of all runs, and build the index caches of their
+    datasets (and the packed arrays of --cuhk03-packed) once, instead of in
+    every run at the same time.
+    """
+    parser = argument_parser()
+    prepared = set()
+    for run in runs:
+        args = parser.parse_args(run.args)
+        for name in args.source_names + args.target_names:
+            key = (args.root, name, args.split_id, args.cuhk03_labeled, args.cuhk03_classic_split, args.cuhk03_packed)
+            if key in prepared:
+                continue
+            prepared.add(key)
+            print("=> Preparing dataset {} in {}".format(name, args.root))
+            init_imgreid_dataset(
+                root=args.root, name=name, split_id=args.split_id, cuhk03_labeled=args.cuhk03_labeled,
+                cuhk03_classic_split=args.cuhk03_classic_split, cuhk03_packed=args.cuhk03_packed
+            )
+
+
+def schedule(runs, cpus, gpus, memory_gb, retries, poll_interval=5):
+    """
+    Run `runs` concurrently within the resources: start every pending run
+    that fits (first fit, in order), retry failed runs up to `retries`
+    times, until all runs are done.
+
+    Args:
+    - runs (list): the runs.
+    - cpus (list): available CPU cores.
+    - gpus (list): available GPU ids.
+    - memory_gb (float): available memory, or 0 not to account for memory.
+    - retries (int): number of retries of a failed run.
+    """
+    for run in runs:
+        if run.num_cpus > len(cpus) or run.num_gpus > len(gpus) or (memory_gb and run.memory_gb > memory_gb):
+            raise ValueError("Run {} needs {} cpus, {} gpus and {} GB, more than available".format(
+                run.name, run.num_cpus, run.num_gpus, run.memory_gb))
+
+    pending = [run for run in runs if run.status == 'pending']
+    running = []
+    free_cpus, free_gpus, free_memory = list(cpus), list(gpus), memory_gb
+    while pending or running:
+        for run in list(pending):
+            if run.num_cpus <= len(free_cpus) and run.num_gpus <= len(free_gpus) and \
+                    (not memory_gb or run.memory_gb <= free_memory):
+                run.start(free_cpus[:run.num_cpus], free_gpus[:run.num_gpus])
+                free_cpus, free_gpus = free_cpus[run.num_cpus:], free_gpus[run.num_gpus:]
+                free_memory -= run.memory_gb
+                pending.remove(run)
+                running.append(run)
+
+        time.sleep(poll_interval)
+        retried = []
+        for run in list(running):
+            code = run.poll()
+            if code is None:
+                continue
+            running.remove(run)
+            free_cpus, free_gpus = sorted(free_cpus + run.cpus), sorted(free_gpus + run.gpus)
+            free_memory += run.memory_gb
+
+            if code == 0:
+                run.status = 'done'
+                print("{} Finished {} in {}".format(_now(), run.name, datetime.timedelta(seconds=round(run.elapsed))))
+            elif run.attempts <= retries:
+                print("{} {} failed with code {}, retrying, see {}".format(
+                    _now(), run.name, code, osp.join(run.save_dir, 'stdout.txt')))
+                retried.append(run)
+            else:
+                run.status = 'failed ({})'.format(code)
+                print("{} {} failed with code {}, see {}".format(
+                    _now(), run.name, code, osp.join(run.save_dir, 'stdout.txt')))
+        # ahead of runs that have not started yet
+        pending = retried + pending
+
+
+def summarize(runs, save_root):
+    """
+    Print a table of the best and the last rank-1 of every run and target,
+    and write it to <save_root>/summary.tsv.
+    """
+    header = ['run', 'status', 'attempts', 'time']
+    rows = []
+    for run in runs:
+        row = {'run': run.name, 'status': run.status, 'attempts': str(run.attempts),
+               'time': str(datetime.timedelta(seconds=round(run.elapsed)))}
+        if osp.exists(run.summary_path):
+            with open(run.summary_path) as f:
+                summary = json.load(f)
+            for name, results in summary['results'].items():
+                if not results['rank1']:
+                    continue
+                best = max(range(len(results['rank1'])), key=lambda i: results['rank1'][i])
+                row[name + ' best'] = '{:.1%} (ep {})'.format(results['rank1'][best], results['epoch'][best])
+                row[name + ' last'] = '{:.1%}'.format(results['rank1'][-1])
+                for column in (name + ' best', name + ' last'):
+                    if column not in header:
+                        header.append(column)
+        rows.append(row)
+
+    widths = [max([len(column)] + [len(row.get(column, '')) for row in rows]) for column in header]
+    print("  " + " | ".join(column.ljust(width) for column, width in zip(header, widths)).rstrip())
+    for row in rows:
+        print("  " + " | ".join(row.get(column, '').ljust(width) for column, width in zip(header, widths)).rstrip())
+
+    with open(osp.join(save_root, 'summary.tsv'), 'w') as f:
+        f.write('\t'.join(header) + '\n')
+        for row in rows:
+            f.write('\t'.join(row.get(column, '') for column in header) + '\n')
+
+
+def main():
+    parser = argparse.ArgumentParser(formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('spec', type=str,
+                        help="JSON file describing the runs")
+    parser.add_argument('--save-root', type=str, default='log/scheduler',
+                        help="directory of the runs, each in <save-root>/<run name>")
+    parser.add_argument('--cpus', type=str, default='0-{}'.format(os.cpu_count() - 1),
+                        help="cpu cores to run on, e.g. 0-15,32-47")
+    parser.add_argument('--gpus', type=str, default='',
+                        help="gpu device ids to run on, e.g. 0,1,2,3")
+    parser.add_argument('--memory-gb', type=float, default=0,
+                        help="memory available to the runs (0 not to account for memory)")
+    parser.add_argument('--retries', type=int, default=1,
+                        help="number of retries of a failed run")
+    parser.add_argument('--dry-run', action='store_true',
+                        help="only print the runs")
+    args = parser.parse_args()
+
+    with open(args.spec) as f:
+        spec = json.load(f)
+    runs = expand_runs(spec, args.save_root)
+    for run in runs:
+        if osp.exists(run.summary_path):
+            run.status = 'done'
+        print("{} [{}]: {}".format(run.name, run.status, ' '.join(shlex.quote(arg) for arg in run.args)))
+    if args.dry_run:
+        return
+
+    cpus = parse_cpus(args.cpus)
+    unavailable = sorted(set(cpus) - os.sched_getaffinity(0))
+    if unavailable:
+        raise ValueError("cpus {} are not available".format(','.join(str(cpu) for cpu in unavailable)))
+
+    prepare_datasets(runs)
+    mkdir_if_missing(args.save_root)
+    schedule(runs, cpus, [int(gpu) for gpu in args.gpus.split(',') if gpu], args.memory_gb, args.retries)
+    summarize(runs, args.save_root)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,254 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+import torch.nn.functional as F
+
+
+class BatchRandom2DTranslation(object):
+    """
+    Batched version of `Random2DTranslation`. Input images are expected to be
+    decoded at (1 + 1/8) of the target size; with a probability each sample is
+    randomly cropped to the target size, otherwise it is resized to it.
+    Crops and resizes are done in one pass with `affine_grid` + `grid_sample`.
+
+    Args:
+    - height (int): target image height.
+    - width (int): target image width.
+    - p (float): probability of performing the crop. Default: 0.5.
+    """
+
+    def __init__(self, height, width, p=0.5):
+        self.height = height
+        self.width = width
+        self.p = p
+
+    def __call__(self, imgs, generator):
+        B, C, H, W = imgs.size()
+        # size of the crop window relative to the enlarged image
+        scale_x = scale_y = 1 / 1.125
+
+        crop = torch.rand(B, generator=generator, device=imgs.device) < self.p
+        offset = torch.rand(B, 2, generator=generator, device=imgs.device) * 2 - 1
+
+        theta = torch.zeros(B, 2, 3, device=imgs.device, dtype=imgs.dtype)
+        theta[:, 0, 0] = torch.where(crop, imgs.new_tensor(scale_x), imgs.new_tensor(1.))
+        theta[:, 1, 1] = torch.where(crop, imgs.new_tensor(scale_y), imgs.new_tensor(1.))
+        theta[:, 0, 2] = crop.to(imgs.dtype) * offset[:, 0] * (1 - scale_x)
+        theta[:, 1, 2] = crop.to(imgs.dtype) * offset[:, 1] * (1 - scale_y)
+
+        grid = F.affine_grid(theta, (B, C, self.height, self.width), align_corners=False)
+        return F.grid_sample(imgs, grid, mode='bilinear', padding_mode='border', align_corners=False)
+
+
+class BatchResize(object):
+    """Resize a batch of images to (height, width)."""
+
+    def __init__(self, height, width):
+        self.height = height
+        self.width = width
+
+    def __call__(self, imgs, generator):
+        if imgs.size(2) == self.height and imgs.size(3) == self.width:
+            return imgs
+        return F.interpolate(imgs, size=(self.height, self.width), mode='bilinear', align_corners=False)
+
+
+class BatchRandomHorizontalFlip(object):
+    """Horizontally flip each sample of a batch with probability p."""
+
+    def __init__(self, p=0.5):
+        self.p = p
+
+    def __call__(self, imgs, generator):
+        mask = torch.rand(imgs.size(0), generator=generator, device=imgs.device) < self.p
+        return torch.where(mask.view(-1, 1, 1, 1), imgs.flip(3), imgs)
+
+
+class BatchColorJitter(object):
+    """
+    Batched brightness/contrast/saturation jitter on images in [0, 1],
+    with the same factor ranges as `torchvision.transforms.ColorJitter`.
+    Hue jitter is not supported.
+    """
+
+    def __init__(self, brightness=0, contrast=0, saturation=0):
+        self.brightness = brightness
+        self.contrast = contrast
+        self.saturation = saturation
+
+    @staticmethod
+    def _factor(value, B, generator, device):
+        return 1 + (torch.rand(B, 1, 1, 1, generator=generator, device=device) * 2 - 1) * value
+
+    @staticmethod
+    def _grayscale(imgs):
+        return (0.299 * imgs[:, 0:1] + 0.587 * imgs[:, 1:2] + 0.114 * imgs[:, 2:3])
+
+    def __call__(self, imgs, generator):
+        B = imgs.size(0)
+
+        if self.brightness > 0:
+            imgs = imgs * self._factor(self.brightness, B, generator, imgs.device)
+
+        if self.contrast > 0:
+            mean = self._grayscale(imgs).mean(dim=(1, 2, 3), keepdim=True)
+            factor = self._factor(self.contrast, B, generator, imgs.device)
+            imgs = factor * imgs + (1 - factor) * mean
+
+        if self.saturation > 0:
+            gray = self._grayscale(imgs)
+            factor = self._factor(self.saturation, B, generator, imgs.device)
+            imgs = factor * imgs + (1 - factor) * gray
+
+        return imgs.clamp(0, 1)
+
+    def __repr__(self):
+        return '{}(brightness={}, contrast={}, saturation={})'.format(
+            self.__class__.__name__, self.brightness, self.contrast, self.saturation)
+
+
+class BatchNormalize(object):
+    """Normalize a batch of images with per-channel mean and std."""
+
+    def __init__(self, mean, std):
+        self.mean = mean
+        self.std = std
+
+    def __call__(self, imgs, generator):
+        mean = imgs.new_tensor(self.mean).view(1, -1, 1, 1)
+        std = imgs.new_tensor(self.std).view(1, -1, 1, 1)
+        return (imgs - mean) / std
+
+
+class BatchRandomErasing(object):
+    """
+    Batched version of `RandomErasing`. A fixed number of rectangles is drawn
+    per sample at once and the first one fitting into the image is erased;
+    samples without a fitting rectangle are kept unchanged.
+
+    Args: see `RandomErasing`.
+    - attempts (int): number of candidate rectangles per sample.
+    """
+
+    def __init__(self, probability=0.5, sl=0.02, sh=0.4, r1=0.3, mean=[0.4914, 0.4822, 0.4465], attempts=10):
+        self.probability = probability
+        self.mean = mean
+        self.sl = sl
+        self.sh = sh
+        self.r1 = r1
+        self.attempts = attempts
+
+    def __call__(self, imgs, generator):
+        B, C, H, W = imgs.size()
+        device = imgs.device
+
+        def _rand(*size):
+            return torch.rand(*size, generator=generator, device=device)
+
+        area = H * W
+        target_area = (_rand(B, self.attempts) * (self.sh - self.sl) + self.sl) * area
+        # uniform in [r1, 1 / r1], as in `RandomErasing`
+        aspect_ratio = _rand(B, self.attempts) * (1 / self.r1 - self.r1) + self.r1
+
+        h = torch.sqrt(target_area * aspect_ratio).round().long()
+        w = torch.sqrt(target_area / aspect_ratio).round().long()
+
+        valid = (h < H) & (w < W)
+        # index of the first valid attempt; argmax returns the first maximum
+        first = valid.to(torch.uint8).argmax(dim=1, keepdim=True)
+        apply = valid.any(dim=1) & (_rand(B) < self.probability)
+        h = h.gather(1, first).squeeze(1)
+        w = w.gather(1, first).squeeze(1)
+
+        x1 = (_rand(B) * (H - h + 1).clamp(min=1)).long()
+        y1 = (_rand(B) * (W - w + 1).clamp(min=1)).long()
+
+        rows = torch.arange(H, device=device).view(1, H, 1)
+        cols = torch.arange(W, device=device).view(1, 1, W)
+        mask = (rows >= x1.view(B, 1, 1)) & (rows < (x1 + h).view(B, 1, 1)) & \
+            (cols >= y1.view(B, 1, 1)) & (cols < (y1 + w).view(B, 1, 1)) & apply.view(B, 1, 1)
+
+        value = imgs.new_tensor(self.mean[:C]).view(1, C, 1, 1)
+        return torch.where(mask.unsqueeze(1), value, imgs)
+
+
+class BatchCompose(object):
+    """
+    Apply batch transforms in order. Every call draws its randomness from a
+    generator re-seeded with (seed + number of batches seen so far), so the
+    augmentation of a batch is reproducible. uint8 batches are converted to
+    float images in [0, 1] first.
+    """
+
+    def __init__(self, transforms, seed=0):
+        self.transforms = transforms
+        self.seed = seed
+        self.step = 0
+
+    def __call__(self, imgs):
+        if imgs.dtype == torch.uint8:
+            imgs = imgs.float().div_(255)
+
+        generator = torch.Generator(device=imgs.device)
+        generator.manual_seed(self.seed + self.step)
+        self.step += 1
+
+        for t in self.transforms:
+            imgs = t(imgs, generator)
+        return imgs
+
+    def state_dict(self):
+        """Number of batches seen, to resume training with the same augmentation."""
+        return {'step': self.step}
+
+    def load_state_dict(self, state_dict):
+        self.step = state_dict['step']
+
+    def __repr__(self):
+        format_string = self.__class__.__name__ + '('
+        for t in self.transforms:
+            format_string += '\n    {0}'.format(t.__class__.__name__)
+        format_string += '\n)'
+        return format_string
+
+
+def build_batch_transforms(height, width, data_augment, seed=0):
+    """Batch counterpart of `build_training_transforms`, applied to the
+    collated (batch, channel, height, width) tensor in [0, 1] or uint8."""
+
+    imagenet_mean = [0.485, 0.456, 0.406]
+    imagenet_std = [0.229, 0.224, 0.225]
+
+    data_augment = set(data_augment)
+
+    transforms = []
+    if 'crop' in data_augment:
+        transforms.append(BatchRandom2DTranslation(height, width))
+    else:
+        transforms.append(BatchResize(height, width))
+
+    transforms.append(BatchRandomHorizontalFlip())
+
+    if 'color-jitter' in data_augment:
+        transforms.append(BatchColorJitter())
+
+    transforms.append(BatchNormalize(mean=imagenet_mean, std=imagenet_std))
+
+    if 'random-erase' in data_augment:
+        transforms.append(BatchRandomErasing())
+
+    transforms = BatchCompose(transforms, seed=seed)
+    print('Using batch transform:', transforms)
+
+    return transforms
+
+
+def build_normalize_transform():
+    """Only normalize batches; used for uint8 batches that were already
+    augmented (or not augmented at all) in the workers."""
+
+    imagenet_mean = [0.485, 0.456, 0.406]
+    imagenet_std = [0.229, 0.224, 0.225]
+
+    return BatchCompose([BatchNormalize(mean=imagenet_mean, std=imagenet_std)])
@@ -104,18 +104,19 @@ class PAM_Module(Module):
                 attention: B X (HxW) X (HxW)
         """
         m_batchsize, C, height, width = x.size()
+        # reshape, not view: x may be channels_last
         proj_query = self\
             .query_conv(x)\
-            .view(m_batchsize, -1, width * height)\
+            .reshape(m_batchsize, -1, width * height)\
             .permute(0, 2, 1)
         proj_key = self\
             .key_conv(x)\
-            .view(m_batchsize, -1, width * height)
+            .reshape(m_batchsize, -1, width * height)
         energy = torch.bmm(proj_query, proj_key)
         attention = self.softmax(energy)
         proj_value = self\
             .value_conv(x)\
-            .view(m_batchsize, -1, width * height)
+            .reshape(m_batchsize, -1, width * height)
 
         out = torch.bmm(
             proj_value,
@@ -146,20 +147,18 @@ class CAM_Module(Module):
                 attention: B X C X C
         """
         m_batchsize, C, height, width = x.size()
-        proj_query = x.view(m_batchsize, C, -1)
-        proj_key = x.view(m_batchsize, C, -1).permute(0, 2, 1)
+        proj_query = x.reshape(m_batchsize, C, -1)
+        proj_key = proj_query.permute(0, 2, 1)
         energy = torch.bmm(proj_query, proj_key)
         max_energy_0 = torch.max(energy, -1, keepdim=True)[0].expand_as(energy)
         energy_new = max_energy_0 - energy
         attention = self.softmax(energy_new)
-        proj_value = x.view(m_batchsize, C, -1)
+        proj_value = proj_query
 
         out = torch.bmm(attention, proj_value)
         out = out.view(m_batchsize, C, height, width)
 
-        logging.debug('cam device: {}, {}'.format(out.device, self.gamma.device))
-        gamma = self.gamma.to(out.device)
-        out = gamma * out + x
+        out = self.gamma * out + x
         return out
 
 
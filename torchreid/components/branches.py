@@ -1,11 +1,8 @@
-import weakref
-
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from collections import defaultdict
 
-from torchreid.utils.torchtools import init_params
+from torchreid.utils.torchtools import init_params, maybe_checkpoint
 from torchreid.components.attention import get_attention_module_instance
 
 class MultiBranchNetwork(nn.Module):
@@ -26,7 +23,9 @@ class MultiBranchNetwork(nn.Module):
 
     def _get_branches(self, backbone, args) -> list:
 
-        branch_names = frozenset(args['branches'])
+        # in the order of --branches: the iteration order of a set changes between
+        # processes (string hashing), and so would the keys of the state dict
+        branch_names = list(dict.fromkeys(args['branches']))
         branch_list = []
 
         for branch_name in branch_names:
@@ -88,28 +87,77 @@ class MultiBranchNetwork(nn.Module):
 
         return lst
 
-    def forward(self, x):
-        x, *intermediate_fmaps = self.common_branch(x)
+    def set_activation_checkpointing(self, targets):
+        """
+        Recompute activations in backward instead of storing them, for the
+        modules in `targets`:
+        - 'common': the common branch.
+        - 'deep': the deep sub-branch (e.g. the copy of layer4) of every branch, 'deep<i>' of branch i only.
+        - 'attention': the CAM/PAM modules, with their heads.
+        """
+        targets = set(targets)
+        valid = {'common', 'deep', 'attention'} | {'deep{}'.format(i) for i in range(len(self.branches))}
+        if targets - valid:
+            raise ValueError("Unknown activation checkpointing targets {}, expected some of {}".format(
+                sorted(targets - valid), sorted(valid)))
+
+        self.common_branch.checkpointing = 'common' in targets
+        for i, branch in enumerate(self.branches):
+            branch[0].checkpointing = 'deep' in targets or 'deep{}'.format(i) in targets
+            for name in getattr(branch[1], 'dan_module_names', []):
+                if name != 'before_module':
+                    getattr(branch[1], name).checkpointing = 'attention' in targets
+
+    def forward_middle(self, x):
+        """
+        Run the common branch, then the deep sub-branch of every branch.
+        Return the outputs of the deep sub-branches and the intermediate
+        fmaps of the common branch.
+        """
+        x, *intermediate_fmaps = maybe_checkpoint(self.common_branch, x)
+        return [maybe_checkpoint(middle_subbranch, x) for middle_subbranch, _ in self.branches], intermediate_fmaps
+
+    def forward(self, x, from_middle=False):
+        """
+        Args:
+        - x (Tensor): images, or, with `from_middle`, the list of the outputs
+          of the deep sub-branches (see `forward_middle`), e.g. cached while
+          the backbone is frozen.
+        """
+        if from_middle:
+            middle_outputs, intermediate_fmaps = x, []
+        else:
+            middle_outputs, intermediate_fmaps = self.forward_middle(x)
 
-        fmap_dict = defaultdict(list)
-        fmap_dict['intermediate'].extend(intermediate_fmaps)
+        # plain dicts and lists only, so that torch.compile traces the forward without graph breaks
+        fmap_dict = {'intermediate': list(intermediate_fmaps)}
 
         predict_features, xent_features, triplet_features = [], [], []
 
-        for branch in self.branches:
-            predict, xent, triplet, fmap = branch(x)
+        for x, (_, head) in zip(middle_outputs, self.branches):
+            predict, xent, triplet, fmap = head(x)
             predict_features.extend(predict)
             xent_features.extend(xent)
             triplet_features.extend(triplet)
 
             for name, fmap_list in fmap.items():
-                fmap_dict[name].extend(fmap_list)
+                fmap_dict.setdefault(name, []).extend(fmap_list)
 
         fmap_dict = {k: tuple(v) for k, v in fmap_dict.items()}
 
         return torch.cat(predict_features, 1), tuple(xent_features),\
             tuple(triplet_features), fmap_dict
 
+    def identity_prototypes(self):
+        """
+        Return the classifier weight of the global branch, whose row i
+        represents identity i, or None without a global branch.
+        """
+        for m in self.modules():
+            if isinstance(m, GlobalBranch):
+                return m.classifier.weight
+        return None
+
 
 class Sequential(nn.Sequential):
 
@@ -127,8 +175,6 @@ class GlobalBranch(nn.Module):
     def __init__(self, owner, backbone, args, input_dim):
         super().__init__()
 
-        self.owner = weakref.ref(owner)
-
         self.input_dim = input_dim
         self.output_dim = args['global_dim']
         self.args = args
@@ -191,8 +237,6 @@ class NPBranch(nn.Module):
     def __init__(self, owner, backbone, args, input_dim, part_num=None):
         super().__init__()
 
-        self.owner = weakref.ref(owner)
-
         self.input_dim = input_dim
         self.output_dim = args['np_dim']
         self.args = args
@@ -277,8 +321,6 @@ class ABDBranch(nn.Module):
     def __init__(self, owner, backbone, args, input_dim):
         super().__init__()
 
-        self.owner = weakref.ref(owner)
-
         self.input_dim = input_dim
         self.output_dim = args['abd_dim']
         self.args = args
@@ -319,7 +361,7 @@ class ABDBranch(nn.Module):
     def _init_attention_modules(self):
 
         args = self.args
-        self.dan_module_names = set()
+        self.dan_module_names = []
         DAN_module_names = {'cam', 'pam'} & set(args['abd_dan'])
         use_head = not args['abd_dan_no_head']
         self.use_dan = bool(DAN_module_names)
@@ -329,7 +371,7 @@ class ABDBranch(nn.Module):
             self.output_dim,
             use_head=use_head
         )
-        self.dan_module_names.add('before_module')
+        self.dan_module_names.append('before_module')
         self.before_module = before_module
         if use_head:
             init_params(before_module)
@@ -341,7 +383,7 @@ class ABDBranch(nn.Module):
                 use_head=use_head
             )
             init_params(cam_module)
-            self.dan_module_names.add('cam_module')
+            self.dan_module_names.append('cam_module')
             self.cam_module = cam_module
 
         if 'pam' in DAN_module_names:
@@ -351,7 +393,7 @@ class ABDBranch(nn.Module):
                 use_head=use_head
             )
             init_params(pam_module)
-            self.dan_module_names.add('pam_module')
+            self.dan_module_names.append('pam_module')
             self.pam_module = pam_module
 
         sum_conv = nn.Sequential(
@@ -361,27 +403,31 @@ class ABDBranch(nn.Module):
         init_params(sum_conv)
         self.sum_conv = sum_conv
 
+        # keys of the returned fmap, e.g. 'cam' for the output of cam_module
+        self.fmap_names = [name.partition('_')[0] for name in self.dan_module_names]
+
     def forward(self, x):
 
         predict, xent, triplet = [], [], []
-        fmap = defaultdict(list)
+        fmap = {name: [] for name in self.fmap_names + ['after']}
 
         x = self.reduction(x)
 
         assert x.size(2) % self.part_num == 0,\
             "Height {} is not a multiplication of {}. Aborted.".format(x.size(2), self.part_num)
 
+        # part_num is a constant, so torch.compile unrolls the loop. Parts are not
+        # batched together, as BatchNorm in the attention heads sees one part at a time.
         margin = x.size(2) // self.part_num
         for p in range(self.part_num):
             x_sliced = x[:, :, margin * p:margin * (p + 1), :]
 
             if self.use_dan:
                 to_sum = []
-                # module_name: str
-                for module_name in self.dan_module_names:
-                    x_out = getattr(self, module_name)(x_sliced)
+                for module_name, fmap_name in zip(self.dan_module_names, self.fmap_names):
+                    x_out = maybe_checkpoint(getattr(self, module_name), x_sliced)
                     to_sum.append(x_out)
-                    fmap[module_name.partition('_')[0]].append(x_out)
+                    fmap[fmap_name].append(x_out)
 
                 fmap_after = self.sum_conv(sum(to_sum))
                 fmap['after'].append(fmap_after)
@@ -407,8 +453,6 @@ class DANBranch(nn.Module):
     def __init__(self, owner, backbone, args, input_dim):
         super().__init__()
 
-        self.owner = weakref.ref(owner)
-
         self.input_dim = input_dim
         self.output_dim = args['dan_dim']
         self.args = args
@@ -426,14 +470,14 @@ class DANBranch(nn.Module):
 
     def _init_classifier(self):
 
-        classifier = nn.Linear(len(self.dan_module_names) * self.output_dim, self.owner().num_classes)
+        classifier = nn.Linear(len(self.dan_module_names) * self.output_dim, self.num_classes)
         init_params(classifier)
         self.classifier = classifier
 
     def _init_attention_modules(self):
 
         args = self.args
-        self.dan_module_names = set()
+        self.dan_module_names = []
         DAN_module_names = {'cam', 'pam'} & set(args['dan_dan'])
         use_head = not args['dan_dan_no_head']
         self.use_dan = bool(DAN_module_names)
@@ -443,7 +487,7 @@ class DANBranch(nn.Module):
             self.output_dim,
             use_head=False
         )
-        self.dan_module_names.add('before_module')
+        self.dan_module_names.append('before_module')
         self.before_module = before_module
         if use_head:
             init_params(before_module)
@@ -456,7 +500,7 @@ class DANBranch(nn.Module):
                 use_head=use_head
             )
             init_params(cam_module)
-            self.dan_module_names.add('cam_module')
+            self.dan_module_names.append('cam_module')
             self.cam_module = cam_module
 
         if 'pam' in DAN_module_names:
@@ -468,7 +512,7 @@ class DANBranch(nn.Module):
                 use_head=use_head
             )
             init_params(pam_module)
-            self.dan_module_names.add('pam_module')
+            self.dan_module_names.append('pam_module')
             self.pam_module = pam_module
 
     def forward(self, x):
@@ -480,7 +524,7 @@ class DANBranch(nn.Module):
         feats = []
         # module_name: str
         for module_name in self.dan_module_names:
-            x_out = getattr(self, module_name)(x)
+            x_out = maybe_checkpoint(getattr(self, module_name), x)
             feats.append(x_out)
 
         v = self.avgpool(torch.cat(feats, 1))
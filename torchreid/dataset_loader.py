@@ -11,46 +11,147 @@ import io
 import torch
 from torch.utils.data import Dataset
 
+from .datasets.image_list import ImageList
+from .datasets.packed_images import is_packed_path, read_packed_image
+from .utils.readahead import ReadAhead, retry_io, read_bytes
+
+
+try:
+    # optional libjpeg-turbo bindings (pip install PyTurboJPEG)
+    from turbojpeg import TurboJPEG, TJPF_RGB
+    _turbo_jpeg = TurboJPEG()
+except Exception:
+    _turbo_jpeg = None
+
+_JPEG_MAGIC = b'\xff\xd8'
+
+
+def _turbo_scaling_factor(img_size, size):
+    """Pick the smallest libjpeg scaling factor whose output still covers `size`."""
+    width, height = img_size
+    best = (1, 1)
+    for num, denom in _turbo_jpeg.scaling_factors:
+        if num > denom:
+            continue
+        if width * num // denom >= size[0] and height * num // denom >= size[1] and num * best[1] < best[0] * denom:
+            best = (num, denom)
+    return best
+
+
+def decode_image(buf, size=None):
+    """Decode raw image bytes into an RGB PIL image.
+
+    If `size` (width, height) is given, JPEGs are decoded with DCT-domain
+    scaling to the smallest scale that is not smaller than `size`, so the
+    following resize is cheap and never upsamples.
+    """
+    if _turbo_jpeg is not None and buf[:2] == _JPEG_MAGIC:
+        try:
+            if size is None:
+                arr = _turbo_jpeg.decode(buf, pixel_format=TJPF_RGB)
+            else:
+                width, height, _, _ = _turbo_jpeg.decode_header(buf)
+                arr = _turbo_jpeg.decode(
+                    buf, pixel_format=TJPF_RGB,
+                    scaling_factor=_turbo_scaling_factor((width, height), size)
+                )
+            return Image.fromarray(arr)
+        except Exception:
+            pass  # fall back to PIL
+
+    img = Image.open(io.BytesIO(buf))
+    if size is not None:
+        img.draft('RGB', size)
+    return img.convert('RGB')
+
+
+def read_image(img_path, size=None):
+    """Read and decode an image, retrying a bounded number of times with
+    exponential backoff (see `retry_io`) on IOError incurred by heavy IO.
+
+    Args:
+    - img_path (str): path to the image, or to an image in a packed store
+      (see `torchreid.datasets.packed_images`).
+    - size (tuple, optional): (width, height) the image will be resized to;
+      JPEGs are then decoded at reduced resolution (see `decode_image`).
+    """
+    if is_packed_path(img_path):
+        return Image.fromarray(read_packed_image(img_path)).convert('RGB')
 
-def read_image(img_path):
-    """Keep reading image until succeed.
-    This can avoid IOError incurred by heavy IO process."""
-    got_img = False
     if not osp.exists(img_path):
         raise IOError("{} does not exist".format(img_path))
-    while not got_img:
-        try:
-            img = Image.open(img_path).convert('RGB')
-            got_img = True
-        except IOError:
-            print("IOError incurred when reading '{}'. Will redo. Don't worry. Just chill.".format(img_path))
-            pass
-    return img
+    return retry_io(lambda path: decode_image(read_bytes(path), size), img_path)
 
 
 class ImageDataset(Dataset):
-    """Image Person ReID Dataset"""
+    """Image Person ReID Dataset.
+    The (img_path, pid, camid) list is stored as an `ImageList`, so that
+    forked workers do not copy it page by page."""
 
-    def __init__(self, dataset, transform=None):
-        self.dataset = dataset
+    def __init__(self, dataset, transform=None, decode_size=None, io_threads=0):
+        self.dataset = ImageList.from_tuples(dataset)
         self.transform = transform
+        self.decode_size = decode_size
+        self.read_ahead = ReadAhead(io_threads) if io_threads > 0 else None
 
     def __len__(self):
         return len(self.dataset)
 
-    def __getitem__(self, index):
-        img_path, pid, camid = self.dataset[index]
-        img = read_image(img_path)
-
+    def _make_item(self, img, img_path, pid, camid):
         if self.transform is not None:
             img = self.transform(img)
 
         return img, pid, camid, img_path
 
+    def __getitem__(self, index):
+        img_path, pid, camid = self.dataset[index]
+        img = read_image(img_path, self.decode_size)
+
+        return self._make_item(img, img_path, pid, camid)
+
+    def __getitems__(self, indices):
+        """Load a whole batch. With `io_threads` > 0 the files of the batch
+        are read concurrently before decoding starts."""
+        if self.read_ahead is None:
+            return [self[index] for index in indices]
+
+        items = [self.dataset[index] for index in indices]
+        file_paths = [img_path for img_path, _, _ in items if not is_packed_path(img_path)]
+        bufs = dict(zip(file_paths, self.read_ahead.read(file_paths)))
+
+        batch = []
+        for img_path, pid, camid in items:
+            img = None
+            if img_path in bufs:
+                try:
+                    img = decode_image(bufs[img_path], self.decode_size)
+                except IOError:
+                    pass  # e.g. a truncated read, read again below
+            if img is None:
+                img = read_image(img_path, self.decode_size)
+            batch.append(self._make_item(img, img_path, pid, camid))
+        return batch
+
+
+def pack_tracklets(batch):
+    """Collate function packing tracklets of different lengths (e.g. sampled
+    with sample_method='all') into one flat frame batch without padding.
+
+    Returns:
+    - imgs (torch.Tensor): frames of all tracklets, shape (total_frames, channel, height, width).
+    - offsets (torch.LongTensor): tracklet i owns frames offsets[i]:offsets[i + 1].
+    - pids (torch.LongTensor), camids (torch.LongTensor): one per tracklet.
+    """
+    imgs, pids, camids = zip(*batch)
+    lengths = torch.tensor([0] + [x.size(0) for x in imgs], dtype=torch.long)
+    offsets = torch.cumsum(lengths, dim=0)
+    return torch.cat(imgs, dim=0), offsets, torch.tensor(pids), torch.tensor(camids)
+
 
 class VideoDataset(Dataset):
     """Video Person ReID Dataset.
-    Note batch data has shape (batch, seq_len, channel, height, width).
+    Note batch data has shape (batch, seq_len, channel, height, width),
+    or is packed by `pack_tracklets` when sample_method='all'.
     """
     _sample_methods = ['evenly', 'random', 'all']
 
@@ -95,8 +196,8 @@ class VideoDataset(Dataset):
 
         elif self.sample_method == 'all':
             """
-            Sample all items, seq_len is useless now and batch_size needs
-            to be set to 1.
+            Sample all items, seq_len is useless now; batch tracklets with
+            `TrackletBatchSampler` and `pack_tracklets`.
             """
             indices = np.arange(num)
 
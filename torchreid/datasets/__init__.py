@@ -2,6 +2,7 @@ from __future__ import absolute_import
 from __future__ import division
 from __future__ import print_function
 
+from .image_list import ImageList
 from .market1501 import Market1501
 from .market1501_d import Market1501_D
 from .cuhk03 import CUHK03
@@ -3,6 +3,8 @@ from __future__ import print_function
 
 import numpy as np
 
+from .image_list import ImageList
+
 
 class BaseDataset(object):
     """
@@ -10,6 +12,9 @@ class BaseDataset(object):
     """
 
     def get_imagedata_info(self, data):
+        if isinstance(data, ImageList):
+            return len(np.unique(data.pids)), len(data), len(np.unique(data.camids))
+
         pids, cams = [], []
         for _, pid, camid in data:
             pids += [pid]
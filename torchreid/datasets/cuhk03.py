@@ -6,10 +6,12 @@ import os
 import glob
 import re
 import sys
+import time
 import urllib
 import tarfile
 import zipfile
 import os.path as osp
+from multiprocessing import Pool
 from scipy.io import loadmat
 import numpy as np
 import h5py
@@ -17,6 +19,51 @@ from scipy.misc import imsave
 
 from torchreid.utils.iotools import mkdir_if_missing, write_json, read_json
 from .bases import BaseImageDataset
+from .packed_images import PackedImageWriter
+
+
+def _extract_camera_pair(task):
+    """
+    Extract all images of one camera pair from cuhk-03.mat, either as png
+    files or into a single packed store. Runs in a worker process, so the
+    .mat file is opened here.
+
+    Returns a list of (campid, pid, [(img_name, img_path, viewid), ...]).
+    """
+    raw_mat_path, name, campid, save_dir, packed = task
+
+    with h5py.File(raw_mat_path, 'r') as mat:
+        camp = mat[mat[name][0][campid]][:].T
+        writer = PackedImageWriter(osp.join(save_dir, 'pair_{}'.format(campid+1))) if packed else None
+
+        meta_data = []
+        for pid in range(camp.shape[0]):
+            images = [] # Note: some persons only have images for one view
+            for imgid, img_ref in enumerate(camp[pid, :]):
+                img = mat[img_ref][:].T
+                # skip empty cell
+                if img.size == 0 or img.ndim < 3: continue
+                # images are named with the following format, index-1 (ensure uniqueness)
+                # campid: index of camera pair (1-5)
+                # pid: index of person in 'campid'-th camera pair
+                # viewid: index of view, {1, 2}
+                # imgid: index of image, (1-10)
+                viewid = 1 if imgid < 5 else 2
+                img_name = '{:01d}_{:03d}_{:01d}_{:02d}.png'.format(campid+1, pid+1, viewid, imgid+1)
+                if writer is not None:
+                    img_path = writer.add(img)
+                else:
+                    img_path = osp.join(save_dir, img_name)
+                    if not osp.isfile(img_path):
+                        imsave(img_path, img)
+                images.append((img_name, img_path, viewid))
+            assert len(images) > 0, "campid{}-pid{} has no images".format(campid, pid)
+            meta_data.append((campid+1, pid+1, images))
+
+        if writer is not None:
+            writer.close()
+
+    return meta_data
 
 
 class CUHK03(BaseImageDataset):
@@ -37,23 +84,27 @@ class CUHK03(BaseImageDataset):
     Args:
         split_id (int): split index (default: 0)
         cuhk03_labeled (bool): whether to load labeled images; if false, detected images are loaded (default: False)
+        cuhk03_packed (bool): extract images into one packed file per camera pair instead of png files (default: False)
     """
     dataset_dir = 'cuhk03'
 
-    def __init__(self, root='data', split_id=0, cuhk03_labeled=False, cuhk03_classic_split=False, verbose=True, **kwargs):
+    def __init__(self, root='data', split_id=0, cuhk03_labeled=False, cuhk03_classic_split=False, cuhk03_packed=False, verbose=True, **kwargs):
         super(CUHK03, self).__init__()
         self.dataset_dir = osp.join(root, self.dataset_dir)
         self.data_dir = osp.join(self.dataset_dir, 'cuhk03_release')
         self.raw_mat_path = osp.join(self.data_dir, 'cuhk-03.mat')
         
-        self.imgs_detected_dir = osp.join(self.dataset_dir, 'images_detected')
-        self.imgs_labeled_dir = osp.join(self.dataset_dir, 'images_labeled')
+        self.packed = cuhk03_packed
+        suffix = '_packed' if cuhk03_packed else ''
+
+        self.imgs_detected_dir = osp.join(self.dataset_dir, 'images_detected' + suffix)
+        self.imgs_labeled_dir = osp.join(self.dataset_dir, 'images_labeled' + suffix)
         
-        self.split_classic_det_json_path = osp.join(self.dataset_dir, 'splits_classic_detected.json')
-        self.split_classic_lab_json_path = osp.join(self.dataset_dir, 'splits_classic_labeled.json')
+        self.split_classic_det_json_path = osp.join(self.dataset_dir, 'splits_classic_detected{}.json'.format(suffix))
+        self.split_classic_lab_json_path = osp.join(self.dataset_dir, 'splits_classic_labeled{}.json'.format(suffix))
         
-        self.split_new_det_json_path = osp.join(self.dataset_dir, 'splits_new_detected.json')
-        self.split_new_lab_json_path = osp.join(self.dataset_dir, 'splits_new_labeled.json')
+        self.split_new_det_json_path = osp.join(self.dataset_dir, 'splits_new_detected{}.json'.format(suffix))
+        self.split_new_lab_json_path = osp.join(self.dataset_dir, 'splits_new_labeled{}.json'.format(suffix))
         
         self.split_new_det_mat_path = osp.join(self.dataset_dir, 'cuhk03_new_protocol_config_detected.mat')
         self.split_new_lab_mat_path = osp.join(self.dataset_dir, 'cuhk03_new_protocol_config_labeled.mat')
@@ -105,7 +156,8 @@ class CUHK03(BaseImageDataset):
     def _preprocess(self):
         """
         This function is a bit complex and ugly, what it does is
-        1. Extract data from cuhk-03.mat and save as png images.
+        1. Extract data from cuhk-03.mat and save as png images (or packed
+           arrays), one camera pair per worker process.
         2. Create 20 classic splits. (Li et al. CVPR'14)
         3. Create new split. (Zhong et al. CVPR'17)
         """
@@ -118,75 +170,57 @@ class CUHK03(BaseImageDataset):
            osp.exists(self.split_new_lab_json_path):
             return
 
+        start = time.time()
         mkdir_if_missing(self.imgs_detected_dir)
         mkdir_if_missing(self.imgs_labeled_dir)
 
-        print("Extract image data from {} and save as png".format(self.raw_mat_path))
-        mat = h5py.File(self.raw_mat_path, 'r')
+        with h5py.File(self.raw_mat_path, 'r') as mat:
+            num_camps = {name: len(mat[name][0]) for name in ('detected', 'labeled')}
 
-        def _deref(ref):
-            return mat[ref][:].T
+        # one task per camera pair and image type, extracted in parallel
+        tasks = []
+        for name, imgs_dir in (('detected', self.imgs_detected_dir), ('labeled', self.imgs_labeled_dir)):
+            for campid in range(num_camps[name]):
+                tasks.append((self.raw_mat_path, name, campid, imgs_dir, self.packed))
 
-        def _process_images(img_refs, campid, pid, save_dir):
-            img_paths = [] # Note: some persons only have images for one view
-            for imgid, img_ref in enumerate(img_refs):
-                img = _deref(img_ref)
-                # skip empty cell
-                if img.size == 0 or img.ndim < 3: continue
-                # images are saved with the following format, index-1 (ensure uniqueness)
-                # campid: index of camera pair (1-5)
-                # pid: index of person in 'campid'-th camera pair
-                # viewid: index of view, {1, 2}
-                # imgid: index of image, (1-10)
-                viewid = 1 if imgid < 5 else 2
-                img_name = '{:01d}_{:03d}_{:01d}_{:02d}.png'.format(campid+1, pid+1, viewid, imgid+1)
-                img_path = osp.join(save_dir, img_name)
-                if not osp.isfile(img_path):
-                    imsave(img_path, img)
-                img_paths.append(img_path)
-            return img_paths
-
-        def _extract_img(name):
-            print("Processing {} images (extract and save) ...".format(name))
-            meta_data = []
-            imgs_dir = self.imgs_detected_dir if name == 'detected' else self.imgs_labeled_dir
-            for campid, camp_ref in enumerate(mat[name][0]):
-                camp = _deref(camp_ref)
-                num_pids = camp.shape[0]
-                for pid in range(num_pids):
-                    img_paths = _process_images(camp[pid,:], campid, pid, imgs_dir)
-                    assert len(img_paths) > 0, "campid{}-pid{} has no images".format(campid, pid)
-                    meta_data.append((campid+1, pid+1, img_paths))
-                print("- done camera pair {} with {} identities".format(campid+1, num_pids))
-            return meta_data
-
-        meta_detected = _extract_img('detected')
-        meta_labeled = _extract_img('labeled')
+        print("Extract image data from {} and save as {} ({} tasks) ...".format(
+            self.raw_mat_path, 'packed arrays' if self.packed else 'png', len(tasks)))
+        pool = Pool(min(len(tasks), os.cpu_count() or 1))
+        try:
+            results = pool.map(_extract_camera_pair, tasks)
+        finally:
+            pool.close()
+            pool.join()
+
+        meta_detected, meta_labeled = [], []
+        for (_, name, campid, _, _), meta_data in zip(tasks, results):
+            (meta_detected if name == 'detected' else meta_labeled).extend(meta_data)
+            print("- done {} camera pair {} with {} identities".format(name, campid+1, len(meta_data)))
 
         def _extract_classic_split(meta_data, test_split):
             train, test = [], []
             num_train_pids, num_test_pids = 0, 0
             num_train_imgs, num_test_imgs = 0, 0
-            for i, (campid, pid, img_paths) in enumerate(meta_data):
-                
-                if [campid, pid] in test_split:
-                    for img_path in img_paths:
-                        camid = int(osp.basename(img_path).split('_')[2]) - 1 # make it 0-based
-                        test.append((img_path, num_test_pids, camid))
+            for campid, pid, images in meta_data:
+                if (campid, pid) in test_split:
+                    for _, img_path, viewid in images:
+                        test.append((img_path, num_test_pids, viewid - 1)) # make camid 0-based
                     num_test_pids += 1
-                    num_test_imgs += len(img_paths)
+                    num_test_imgs += len(images)
                 else:
-                    for img_path in img_paths:
-                        camid = int(osp.basename(img_path).split('_')[2]) - 1 # make it 0-based
-                        train.append((img_path, num_train_pids, camid))
+                    for _, img_path, viewid in images:
+                        train.append((img_path, num_train_pids, viewid - 1))
                     num_train_pids += 1
-                    num_train_imgs += len(img_paths)
+                    num_train_imgs += len(images)
             return train, num_train_pids, num_train_imgs, test, num_test_pids, num_test_imgs
 
         print("Creating classic splits (# = 20) ...")
         splits_classic_det, splits_classic_lab = [], []
-        for split_ref in mat['testsets'][0]:
-            test_split = _deref(split_ref).tolist()
+        with h5py.File(self.raw_mat_path, 'r') as mat:
+            test_splits = [mat[split_ref][:].T.astype(np.int64) for split_ref in mat['testsets'][0]]
+
+        for test_split in test_splits:
+            test_split = set(map(tuple, test_split.tolist()))
 
             # create split for detected images
             train, num_train_pids, num_train_imgs, test, num_test_pids, num_test_imgs = \
@@ -211,7 +245,7 @@ class CUHK03(BaseImageDataset):
         write_json(splits_classic_det, self.split_classic_det_json_path)
         write_json(splits_classic_lab, self.split_classic_lab_json_path)
 
-        def _extract_set(filelist, pids, pid2label, idxs, img_dir, relabel):
+        def _extract_set(filelist, pids, pid2label, idxs, name2path, relabel):
             tmp_set = []
             unique_pids = set()
             for idx in idxs:
@@ -219,12 +253,13 @@ class CUHK03(BaseImageDataset):
                 camid = int(img_name.split('_')[2]) - 1 # make it 0-based
                 pid = pids[idx]
                 if relabel: pid = pid2label[pid]
-                img_path = osp.join(img_dir, img_name)
+                img_path = name2path[img_name]
                 tmp_set.append((img_path, int(pid), camid))
                 unique_pids.add(pid)
             return tmp_set, len(unique_pids), len(idxs)
 
-        def _extract_new_split(split_dict, img_dir):
+        def _extract_new_split(split_dict, meta_data):
+            name2path = {img_name: img_path for _, _, images in meta_data for img_name, img_path, _ in images}
             train_idxs = split_dict['train_idx'].flatten() - 1 # index-0
             pids = split_dict['labels'].flatten()
             train_pids = set(pids[train_idxs])
@@ -232,15 +267,15 @@ class CUHK03(BaseImageDataset):
             query_idxs = split_dict['query_idx'].flatten() - 1
             gallery_idxs = split_dict['gallery_idx'].flatten() - 1
             filelist = split_dict['filelist'].flatten()
-            train_info = _extract_set(filelist, pids, pid2label, train_idxs, img_dir, relabel=True)
-            query_info = _extract_set(filelist, pids, pid2label, query_idxs, img_dir, relabel=False)
-            gallery_info = _extract_set(filelist, pids, pid2label, gallery_idxs, img_dir, relabel=False)
+            train_info = _extract_set(filelist, pids, pid2label, train_idxs, name2path, relabel=True)
+            query_info = _extract_set(filelist, pids, pid2label, query_idxs, name2path, relabel=False)
+            gallery_info = _extract_set(filelist, pids, pid2label, gallery_idxs, name2path, relabel=False)
             return train_info, query_info, gallery_info
 
         print("Creating new splits for detected images (767/700) ...")
         train_info, query_info, gallery_info = _extract_new_split(
             loadmat(self.split_new_det_mat_path),
-            self.imgs_detected_dir,
+            meta_detected,
         )
         splits = [{
             'train': train_info[0], 'query': query_info[0], 'gallery': gallery_info[0],
@@ -253,7 +288,7 @@ class CUHK03(BaseImageDataset):
         print("Creating new splits for labeled images (767/700) ...")
         train_info, query_info, gallery_info = _extract_new_split(
             loadmat(self.split_new_lab_mat_path),
-            self.imgs_labeled_dir,
+            meta_labeled,
         )
         splits = [{
             'train': train_info[0], 'query': query_info[0], 'gallery': gallery_info[0],
@@ -262,3 +297,5 @@ class CUHK03(BaseImageDataset):
             'num_gallery_pids': gallery_info[1], 'num_gallery_imgs': gallery_info[2],
         }]
         write_json(splits, self.split_new_lab_json_path)
+
+        print("=> CUHK03 preprocessed in {:.1f}s".format(time.time() - start))
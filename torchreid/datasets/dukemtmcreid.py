@@ -17,6 +17,7 @@ from scipy.misc import imsave
 
 from torchreid.utils.iotools import mkdir_if_missing
 from .bases import BaseImageDataset
+from .index_cache import cached_index
 
 
 class DukeMTMCreID(BaseImageDataset):
@@ -92,18 +93,25 @@ class DukeMTMCreID(BaseImageDataset):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _process_dir(self, dir_path, relabel=False):
+        return cached_index(
+            self.dataset_dir, '{}_{}'.format(osp.basename(dir_path), 'relabel' if relabel else 'raw'),
+            [dir_path], lambda: self._parse_dir(dir_path, relabel)
+        )
+
+    def _parse_dir(self, dir_path, relabel=False):
         img_paths = glob.glob(osp.join(dir_path, '*.jpg'))
         pattern = re.compile(r'([-\d]+)_c(\d)')
 
+        parsed = []
         pid_container = set()
         for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
+            pid, camid = map(int, pattern.search(img_path).groups())
             pid_container.add(pid)
+            parsed.append((img_path, pid, camid))
         pid2label = {pid:label for label, pid in enumerate(pid_container)}
 
         dataset = []
-        for img_path in img_paths:
-            pid, camid = map(int, pattern.search(img_path).groups())
+        for img_path, pid, camid in parsed:
             assert 1 <= camid <= 8
             camid -= 1 # index starts from 0
             if relabel: pid = pid2label[pid]
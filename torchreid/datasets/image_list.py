@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+class ImageList(object):
+    """
+    Compact, read-only replacement of a list of (img_path, pid, camid).
+
+    Paths are stored back to back in one uint8 buffer indexed by an offsets
+    array, pids and camids in int64 arrays. Unlike a list of tuples, reading
+    an item does not touch the reference counts of stored objects, so the
+    pages of a forked DataLoader worker stay shared with the main process.
+
+    Args:
+    - paths (np.ndarray): uint8 buffer of utf-8 encoded paths.
+    - offsets (np.ndarray): path i is paths[offsets[i]:offsets[i + 1]].
+    - pids (np.ndarray): person ids.
+    - camids (np.ndarray): camera ids.
+    """
+
+    def __init__(self, paths, offsets, pids, camids):
+        assert len(offsets) == len(pids) + 1 and len(pids) == len(camids)
+        self.paths = paths
+        self.offsets = offsets
+        self.pids = pids
+        self.camids = camids
+
+    @classmethod
+    def from_tuples(cls, data):
+        """Build from any sequence of (img_path, pid, camid)."""
+        if isinstance(data, cls):
+            return data
+
+        encoded = [img_path.encode('utf-8') for img_path, _, _ in data]
+        offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+        np.cumsum([len(x) for x in encoded], out=offsets[1:])
+        return cls(
+            np.frombuffer(b''.join(encoded), dtype=np.uint8),
+            offsets,
+            np.asarray([item[1] for item in data], dtype=np.int64),
+            np.asarray([item[2] for item in data], dtype=np.int64),
+        )
+
+    @classmethod
+    def concat(cls, lists):
+        lists = [cls.from_tuples(x) for x in lists]
+        if not lists:
+            return cls.from_tuples([])
+
+        offsets = [lists[0].offsets]
+        for x in lists[1:]:
+            offsets.append(x.offsets[1:] + offsets[-1][-1])
+        return cls(
+            np.concatenate([x.paths for x in lists]),
+            np.concatenate(offsets),
+            np.concatenate([x.pids for x in lists]),
+            np.concatenate([x.camids for x in lists]),
+        )
+
+    def shift(self, pid_offset=0, camid_offset=0):
+        """Return a copy whose pids and camids are shifted by the given offsets."""
+        return ImageList(self.paths, self.offsets, self.pids + pid_offset, self.camids + camid_offset)
+
+    def path(self, index):
+        return self.paths[self.offsets[index]:self.offsets[index + 1]].tobytes().decode('utf-8')
+
+    def __len__(self):
+        return len(self.pids)
+
+    def __getitem__(self, index):
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('ImageList index out of range')
+        return self.path(index), int(self.pids[index]), int(self.camids[index])
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield self[index]
+
+    def __repr__(self):
+        return '{}({} images)'.format(self.__class__.__name__, len(self))
@@ -0,0 +1,88 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import os.path as osp
+import json
+
+import numpy as np
+
+from torchreid.utils.iotools import mkdir_if_missing
+from .image_list import ImageList
+
+# bump when the layout of the cache files or the parsing of any dataset changes
+INDEX_VERSION = 2
+
+CACHE_DIR_NAME = '.index_cache'
+
+
+def _fingerprint(dataset_dir, watched_paths, extra):
+    """Identify the state of the watched files and directories. A directory's
+    mtime changes whenever files are added, removed or renamed in it.
+    `dataset_dir` is kept as given since the cached image paths are built from it."""
+    stats = []
+    for path in watched_paths:
+        st = os.stat(path)
+        stats.append([osp.abspath(path), st.st_mtime_ns, st.st_size])
+    return json.dumps({'version': INDEX_VERSION, 'root': dataset_dir, 'paths': stats, 'extra': extra}, sort_keys=True)
+
+
+def _save_index(fpath, fingerprint, dataset):
+    dataset = ImageList.from_tuples(dataset)
+    tmp_fpath = fpath + '.tmp.{}'.format(os.getpid())
+    with open(tmp_fpath, 'wb') as f:
+        np.savez(
+            f,
+            fingerprint=np.frombuffer(fingerprint.encode('utf-8'), dtype=np.uint8),
+            paths=dataset.paths,
+            offsets=dataset.offsets,
+            pids=dataset.pids,
+            camids=dataset.camids,
+        )
+    os.replace(tmp_fpath, fpath)
+
+
+def _load_index(fpath, fingerprint):
+    with np.load(fpath) as data:
+        if data['fingerprint'].tobytes().decode('utf-8') != fingerprint:
+            return None
+        return ImageList(data['paths'], data['offsets'], data['pids'], data['camids'])
+
+
+def cached_index(dataset_dir, name, watched_paths, build, extra=None):
+    """
+    Return the (img_path, pid, camid) table produced by `build()` as an
+    `ImageList`, caching it in a binary file under `dataset_dir`. The cache is keyed by the mtimes and
+    sizes of `watched_paths` (plus `extra`), so it is rebuilt automatically
+    when images are added or removed. Set the envvar `no_index_cache` to
+    always rebuild.
+
+    Args:
+    - dataset_dir (str): root directory of the dataset.
+    - name (str): name of the cached table, unique within the dataset.
+    - watched_paths (list): directories and files the table is derived from.
+    - build (callable): builds the table.
+    - extra (optional): any JSON-serializable parameters the table depends on.
+    """
+    if os.environ.get('no_index_cache'):
+        return ImageList.from_tuples(build())
+
+    fpath = osp.join(dataset_dir, CACHE_DIR_NAME, name + '.npz')
+    fingerprint = _fingerprint(dataset_dir, watched_paths, extra)
+
+    if osp.isfile(fpath):
+        try:
+            dataset = _load_index(fpath, fingerprint)
+        except Exception as e:
+            print("=> Warning: failed to read index cache '{}' ({}), rebuilding".format(fpath, e))
+            dataset = None
+        if dataset is not None:
+            return dataset
+
+    dataset = ImageList.from_tuples(build())
+    try:
+        mkdir_if_missing(osp.dirname(fpath))
+        _save_index(fpath, fingerprint, dataset)
+    except OSError as e:
+        print("=> Warning: failed to write index cache '{}' ({})".format(fpath, e))
+    return dataset
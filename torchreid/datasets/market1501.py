@@ -16,6 +16,7 @@ import h5py
 from scipy.misc import imsave
 
 from .bases import BaseImageDataset
+from .index_cache import cached_index
 
 
 class Market1501(BaseImageDataset):
@@ -70,22 +71,29 @@ class Market1501(BaseImageDataset):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _process_dir(self, dir_path, relabel=False):
+        return cached_index(
+            self.dataset_dir, '{}_{}'.format(osp.basename(dir_path), 'relabel' if relabel else 'raw'),
+            [dir_path], lambda: self._parse_dir(dir_path, relabel),
+            extra={'junk': os.environ.get('junk') is not None}
+        )
+
+    def _parse_dir(self, dir_path, relabel=False):
         img_paths = glob.glob(osp.join(dir_path, '*.jpg'))
         pattern = re.compile(r'([-\d]+)_c(\d)')
+        keep_junk = os.environ.get('junk') is not None
 
+        parsed = []
         pid_container = set()
         for img_path in img_paths:
-            pid, _ = map(int, pattern.search(img_path).groups())
-            if pid == -1 and os.environ.get('junk') is None:
+            pid, camid = map(int, pattern.search(img_path).groups())
+            if pid == -1 and not keep_junk:
                 continue  # junk images are just ignored
             pid_container.add(pid)
+            parsed.append((img_path, pid, camid))
         pid2label = {pid: label for label, pid in enumerate(pid_container)}
 
         dataset = []
-        for img_path in img_paths:
-            pid, camid = map(int, pattern.search(img_path).groups())
-            if pid == -1 and os.environ.get('junk') is None:
-                continue  # junk images are just ignored
+        for img_path, pid, camid in parsed:
             assert -1 <= pid <= 1501  # pid == 0 means background
             assert 1 <= camid <= 6
             camid -= 1  # index starts from 0
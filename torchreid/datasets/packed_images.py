@@ -0,0 +1,71 @@
+from __future__ import absolute_import
+
+import os
+import os.path as osp
+
+import numpy as np
+
+# a packed image is addressed as '<store>.bin#<index>'
+PACKED_SUFFIX = '.bin'
+PACKED_SEP = '#'
+
+_stores = {}
+
+
+class PackedImageWriter(object):
+    """
+    Append raw uint8 (height, width, channel) images to a single binary file,
+    instead of writing one image file each.
+
+    The pixels go to `<prefix>.bin`, and an int64 (offset, height, width,
+    channel) row per image to `<prefix>.idx.npy` on `close()`.
+
+    Args:
+    - prefix (str): path of the store without extension.
+    """
+
+    def __init__(self, prefix):
+        self.bin_path = prefix + PACKED_SUFFIX
+        self.idx_path = prefix + '.idx.npy'
+        self.f = open(self.bin_path, 'wb')
+        self.index = []
+        self.offset = 0
+
+    def add(self, img):
+        """Append an image and return the path it can be read back from."""
+        img = np.ascontiguousarray(img, dtype=np.uint8)
+        if img.ndim == 2:
+            img = img[:, :, None]
+        self.f.write(img.tobytes())
+        self.index.append((self.offset, ) + img.shape)
+        self.offset += img.nbytes
+        return '{}{}{}'.format(self.bin_path, PACKED_SEP, len(self.index) - 1)
+
+    def close(self):
+        self.f.close()
+        np.save(self.idx_path, np.asarray(self.index, dtype=np.int64).reshape(-1, 4))
+
+
+def is_packed_path(path):
+    store, sep, index = path.rpartition(PACKED_SEP)
+    return bool(sep) and store.endswith(PACKED_SUFFIX) and index.isdigit()
+
+
+def _open_store(bin_path):
+    # memory-mapped once per process; pages are shared through the page cache
+    if bin_path not in _stores:
+        if not osp.exists(bin_path):
+            raise IOError("{} does not exist".format(bin_path))
+        index = np.load(bin_path[:-len(PACKED_SUFFIX)] + '.idx.npy')
+        data = np.memmap(bin_path, dtype=np.uint8, mode='r') if os.path.getsize(bin_path) else np.zeros(0, np.uint8)
+        _stores[bin_path] = (data, index)
+    return _stores[bin_path]
+
+
+def read_packed_image(path):
+    """Return the (height, width, channel) uint8 array stored at `path`."""
+    bin_path, _, index = path.rpartition(PACKED_SEP)
+    data, table = _open_store(bin_path)
+    offset, height, width, channel = table[int(index)]
+    img = np.asarray(data[offset:offset + height * width * channel]).reshape(height, width, channel)
+    return img[:, :, 0] if channel == 1 else img
@@ -6,6 +6,7 @@ import os.path as osp
 from collections import defaultdict
 
 from .bases import BaseImageDataset
+from .index_cache import cached_index
 
 class VeRi(BaseImageDataset):
 
@@ -47,6 +48,9 @@ class VeRi(BaseImageDataset):
             raise RuntimeError("'{}' is not available".format(self.gallery_dir))
 
     def _get_train(self):
+        return cached_index(self.dataset_dir, 'train', [self.train_dir], self._parse_train)
+
+    def _parse_train(self):
 
         files = glob(osp.join(self.train_dir, '*'))
 
@@ -68,6 +72,25 @@ class VeRi(BaseImageDataset):
 
     def _get_query_test(self):
 
+        if os.environ.get('use_info'):
+            watched_paths = [osp.join(self.dataset_dir, 'info/query_info.txt'), osp.join(self.dataset_dir, 'info/gallery_info.txt')]
+        else:
+            watched_paths = [self.query_dir, self.gallery_dir]
+        extra = {'use_info': bool(os.environ.get('use_info'))}
+
+        parsed = []
+
+        def _build(index):
+            if not parsed:
+                parsed.extend(self._parse_query_test())
+            return parsed[index]
+
+        q = cached_index(self.dataset_dir, 'query', watched_paths, lambda: _build(0), extra=extra)
+        g = cached_index(self.dataset_dir, 'gallery', watched_paths, lambda: _build(1), extra=extra)
+        return q, g
+
+    def _parse_query_test(self):
+
         if os.environ.get('use_info'):
             q = []
             with open(osp.join(self.dataset_dir, 'info/query_info.txt')) as f:
@@ -149,6 +149,32 @@ def eval_market1501(distmat, q_pids, g_pids, q_camids, g_camids, max_rank):
     return all_cmc, mAP
 
 
+def eval_market1501_per_query(distmat, q_pids, g_pids, q_camids, g_camids):
+    """Per-query version of eval_market1501
+    Return (valid, rank1, AP): a mask of the queries whose identity appears in the gallery,
+    and the rank-1 hit and average precision of each of these queries.
+    """
+    indices = np.argsort(distmat, axis=1)
+    matches = g_pids[indices] == q_pids[:, np.newaxis]
+    keep = ~(matches & (g_camids[indices] == q_camids[:, np.newaxis]))
+
+    valid = np.zeros(len(q_pids), dtype=bool)
+    all_rank1 = []
+    all_AP = []
+    for q_idx in range(len(q_pids)):
+        raw_cmc = matches[q_idx][keep[q_idx]]
+        if not np.any(raw_cmc):
+            continue
+
+        valid[q_idx] = True
+        all_rank1.append(float(raw_cmc[0]))
+        hits = np.flatnonzero(raw_cmc)
+        all_AP.append(np.mean(np.arange(1, len(hits) + 1) / (hits + 1.)))
+
+    assert valid.any(), "Error: all query identities do not appear in gallery"
+    return valid, np.asarray(all_rank1), np.asarray(all_AP)
+
+
 def evaluate_py(distmat, q_pids, g_pids, q_camids, g_camids, max_rank, use_metric_cuhk03):
     if use_metric_cuhk03:
         return eval_cuhk03(distmat, q_pids, g_pids, q_camids, g_camids, max_rank)
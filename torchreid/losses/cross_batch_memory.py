@@ -0,0 +1,61 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import torch
+import torch.nn as nn
+
+
+class CrossBatchMemory(nn.Module):
+    """
+    FIFO queue of the embeddings and pids of recent batches, so that triplet
+    mining can search beyond the current batch.
+
+    Reference:
+    Wang et al. Cross-Batch Memory for Embedding Learning. CVPR 2020.
+
+    Args:
+    - size (int): number of embeddings kept.
+    """
+
+    def __init__(self, size):
+        super(CrossBatchMemory, self).__init__()
+        self.size = size
+        self.register_buffer('feats', torch.zeros(0))
+        self.register_buffer('pids', torch.zeros(0, dtype=torch.long))
+        self.ptr = 0
+        self.num_stored = 0
+
+    def enqueue(self, feats, pids):
+        feats = feats.detach().float()
+        if self.feats.dim() != 2 or self.feats.size(1) != feats.size(1) or self.feats.device != feats.device:
+            self.feats = feats.new_zeros(self.size, feats.size(1))
+            self.pids = pids.new_full((self.size, ), -1)
+            self.ptr = self.num_stored = 0
+
+        n = min(feats.size(0), self.size)
+        idx = (self.ptr + torch.arange(n, device=feats.device)) % self.size
+        # out of place: the previous contents may be saved for backward
+        self.feats = self.feats.index_copy(0, idx, feats[-n:])
+        self.pids = self.pids.index_copy(0, idx, pids[-n:])
+        self.ptr = (self.ptr + n) % self.size
+        self.num_stored = min(self.num_stored + n, self.size)
+
+    def get_extra_state(self):
+        return {'ptr': self.ptr, 'num_stored': self.num_stored}
+
+    def set_extra_state(self, state):
+        self.ptr, self.num_stored = state['ptr'], state['num_stored']
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # the buffers are allocated by the first enqueue, take their shapes from the checkpoint
+        for name in ('feats', 'pids'):
+            if prefix + name in state_dict:
+                setattr(self, name, torch.empty_like(state_dict[prefix + name], device=getattr(self, name).device))
+        super(CrossBatchMemory, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def get(self):
+        """Return the stored (feats, pids)."""
+        return self.feats[:self.num_stored], self.pids[:self.num_stored]
+
+    def __len__(self):
+        return self.num_stored
@@ -4,6 +4,8 @@ from __future__ import division
 import torch
 import torch.nn as nn
 
+from .cross_batch_memory import CrossBatchMemory
+
 
 class TripletLoss(nn.Module):
     """Triplet loss with hard positive/negative mining.
@@ -12,8 +14,14 @@ class TripletLoss(nn.Module):
     Hermans et al. In Defense of the Triplet Loss for Person Re-Identification. arXiv:1703.07737.
     Code imported from https://github.com/Cysu/open-reid/blob/master/reid/loss/triplet.py.
 
+    With `xbm_size` > 0, hardest positives and negatives are also mined
+    among the embeddings of recent batches (see `CrossBatchMemory`), one
+    memory per triplet head, once `xbm_start` iterations have passed.
+
     Args:
     - margin (float): margin for triplet.
+    - xbm_size (int): capacity of the cross-batch memory, 0 to disable.
+    - xbm_start (int): number of iterations before mining in the memory.
     """
 
     def __init__(self, num_classes, args, use_gpu=True):
@@ -27,6 +35,23 @@ class TripletLoss(nn.Module):
         self.lambda_xent = args['lambda_xent']
         self.lambda_htri = args['lambda_htri']
 
+        self.xbm_size = args.get('xbm_size', 0)
+        self.xbm_start = args.get('xbm_start', 0)
+        self.memories = nn.ModuleList()
+        self.num_iters = 0
+
+    def get_extra_state(self):
+        return {'num_iters': self.num_iters}
+
+    def set_extra_state(self, state):
+        self.num_iters = state['num_iters']
+
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # memories are created by the first forward
+        while self.xbm_size > 0 and prefix + 'memories.{}.feats'.format(len(self.memories)) in state_dict:
+            self.memories.append(CrossBatchMemory(self.xbm_size))
+        super(TripletLoss, self)._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
     def _forward(self, inputs, targets):
 
         if not isinstance(inputs, tuple):
@@ -34,32 +59,57 @@ class TripletLoss(nn.Module):
         else:
             inputs_tuple = inputs
 
-        results = sum([self.apply_loss(x, targets) for x in inputs_tuple])
+        if self.xbm_size > 0:
+            while len(self.memories) < len(inputs_tuple):
+                self.memories.append(CrossBatchMemory(self.xbm_size))
+            memories = self.memories
+        else:
+            memories = [None] * len(inputs_tuple)
+
+        results = sum([self.apply_loss(x, targets, memory) for x, memory in zip(inputs_tuple, memories)])
         return results / len(inputs_tuple)
 
     def forward(self, inputs, targets):
 
         xent_loss = self.xent(inputs, targets)
         htri_loss = self._forward(inputs[2], targets)
+        self.num_iters += 1
 
         return self.lambda_xent * xent_loss + self.lambda_htri * htri_loss
 
-    def apply_loss(self, inputs, targets):
+    def apply_loss(self, inputs, targets, memory=None):
         """
         Args:
         - inputs: feature matrix with shape (batch_size, feat_dim)
         - targets: ground truth labels with shape (num_classes)
+        - memory (CrossBatchMemory, optional): embeddings of recent batches
         """
         n = inputs.size(0)
 
         # Compute pairwise distance, replace by the official when merged
-        dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
-        dist = dist + dist.t()
-        dist.addmm_(1, -2, inputs, inputs.t())
-        dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+        # in fp32 under autocast, the expansion of |a - b|^2 cancels badly in half precision
+        with torch.autocast(device_type=inputs.device.type, enabled=False):
+            inputs = inputs.float()
+            dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True).expand(n, n)
+            dist = dist + dist.t()
+            dist.addmm_(inputs, inputs.t(), beta=1, alpha=-2)
+            dist = dist.clamp(min=1e-12).sqrt()  # for numerical stability
+
+            candidates = targets
+            if memory is not None and len(memory) > 0 and self.num_iters >= self.xbm_start:
+                # memory embeddings are constants, gradients flow through the anchors only
+                mem_feats, mem_pids = memory.get()
+                mem_dist = torch.pow(inputs, 2).sum(dim=1, keepdim=True) + torch.pow(mem_feats, 2).sum(dim=1).view(1, -1)
+                mem_dist.addmm_(inputs, mem_feats.t(), beta=1, alpha=-2)
+                mem_dist = mem_dist.clamp(min=1e-12).sqrt()
+                dist = torch.cat([dist, mem_dist], dim=1)
+                candidates = torch.cat([targets, mem_pids])
+
+        if memory is not None:
+            memory.enqueue(inputs, targets)
 
         # For each anchor, find the hardest positive and negative
-        mask = targets.expand(n, n).eq(targets.expand(n, n).t())
+        mask = targets.view(n, 1).eq(candidates.view(1, -1))
         dist_ap, dist_an = [], []
         for i in range(n):
             dist_ap.append(dist[i][mask[i]].max().unsqueeze(0))
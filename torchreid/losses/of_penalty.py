@@ -26,7 +26,7 @@ class OFPenalty(nn.Module):
     def dominant_eigenvalue(self, A):
 
         B, N, _ = A.size()
-        x = torch.randn(B, N, 1, device='cuda')
+        x = torch.randn(B, N, 1, device=A.device, dtype=A.dtype)
 
         for _ in range(1):
             x = torch.bmm(A, x)
@@ -44,7 +44,7 @@ class OFPenalty(nn.Module):
         AAT = torch.bmm(A, A.permute(0, 2, 1))
         B, N, _ = AAT.size()
         largest = self.dominant_eigenvalue(AAT)
-        I = torch.eye(N, device='cuda').expand(B, N, N)  # noqa
+        I = torch.eye(N, device=AAT.device, dtype=AAT.dtype).expand(B, N, N)  # noqa
         I = I * largest.view(B, 1, 1).repeat(1, N, N)  # noqa
         tmp = self.dominant_eigenvalue(AAT - I)
         return tmp + largest, largest
@@ -57,8 +57,10 @@ class OFPenalty(nn.Module):
             return sum([self.apply_penalty(k, xx) for xx in x]) / len(x)
 
         batches, channels, height, width = x.size()
-        W = x.view(batches, channels, -1)
-        smallest, largest = self.get_singular_values(W)
+        # power iterations are not accurate enough in half precision
+        with torch.autocast(device_type=x.device.type, enabled=False):
+            W = x.float().reshape(batches, channels, -1)
+            smallest, largest = self.get_singular_values(W)
         singular_penalty = (largest - smallest) * self.beta
 
         if k == 'intermediate':
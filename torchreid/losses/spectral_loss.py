@@ -51,7 +51,7 @@ class SpectralLoss(nn.Module):
             return sum([self.apply_penalty(k, xx) for xx in x]) / len(x)
 
         batches, channels, height, width = x.size()
-        W = x.view(batches, channels, -1)
+        W = x.reshape(batches, channels, -1)
 
         penalty = self.get_laplacian_nuc_norm(W)
 
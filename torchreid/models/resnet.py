@@ -283,8 +283,8 @@ class MultiBranchResNetCls(branches.MultiBranchNetwork):
 
         return ResNetDeepBranch(self, backbone, args)
 
-    def forward(self, x):
-        _, xent, trip, _ = outputs = list(super().forward(x))
+    def forward(self, x, from_middle=False):
+        _, xent, trip, _ = outputs = list(super().forward(x, from_middle=from_middle))
         xent = list(xent)
         xent.append(
             self.final_classifier(torch.cat(trip, 1))
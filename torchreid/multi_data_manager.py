@@ -1,16 +1,27 @@
 from __future__ import absolute_import
 from __future__ import print_function
 
-from torch.utils.data import DataLoader
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch.utils.data import DataLoader, Subset
+from torch.utils.data.distributed import DistributedSampler
 
 from .dataset_loader import ImageDataset, VideoDataset
-from .datasets import init_imgreid_dataset, init_vidreid_dataset
-from .transforms import build_transforms
-from .samplers import RandomIdentitySampler
+from .datasets import init_imgreid_dataset, init_vidreid_dataset, ImageList
+from .transforms import build_transforms, get_decode_size
+from .batch_transforms import build_batch_transforms, build_normalize_transform
+from .worker_pool import WorkerPool, PooledDataLoader
+from .utils.proxy_eval import sample_proxy_split
+from .samplers import RandomIdentitySampler, DistributedRandomIdentitySampler, HardIdentitySampler
 
 
 class BaseDataManager(object):
 
+    train_batch_transform = None
+    test_batch_transform = None
+    worker_pool = None
+
     @property
     def num_train_pids(self):
         return self._num_train_pids
@@ -19,6 +30,85 @@ class BaseDataManager(object):
     def num_train_cams(self):
         return self._num_train_cams
 
+    def _make_loader(self, dataset, num_workers=0, **kwargs):
+        """
+        Build a DataLoader, or a PooledDataLoader served by the shared worker pool
+        """
+        if self.worker_pool is None:
+            return DataLoader(dataset, num_workers=num_workers, **kwargs)
+        return PooledDataLoader(self.worker_pool, dataset, **kwargs)
+
+    def shutdown_workers(self):
+        """
+        Stop the shared worker pool, if any
+        """
+        if self.worker_pool is not None:
+            self.worker_pool.shutdown()
+
+    def set_epoch(self, epoch):
+        """
+        Pass the epoch to the train sampler if it depends on it (e.g. distributed samplers)
+        """
+        sampler = getattr(getattr(self.trainloader, 'batch_sampler', None), 'sampler', None)
+        if hasattr(sampler, 'set_epoch'):
+            sampler.set_epoch(epoch)
+
+    def sampler_state_dict(self):
+        """
+        State of the train sampler, or None if it has none
+        """
+        sampler = getattr(getattr(self.trainloader, 'batch_sampler', None), 'sampler', None)
+        if hasattr(sampler, 'state_dict'):
+            return sampler.state_dict()
+        return None
+
+    def load_sampler_state_dict(self, state_dict):
+        sampler = getattr(getattr(self.trainloader, 'batch_sampler', None), 'sampler', None)
+        if state_dict is not None and hasattr(sampler, 'load_state_dict'):
+            sampler.load_state_dict(state_dict)
+
+    def set_prototype_fn(self, prototype_fn):
+        """
+        Give the train sampler access to identity prototypes (for HardIdentitySampler)
+        """
+        sampler = getattr(getattr(self.trainloader, 'batch_sampler', None), 'sampler', None)
+        if hasattr(sampler, 'set_prototype_fn'):
+            sampler.set_prototype_fn(prototype_fn)
+
+    def return_sequential_trainloader(self):
+        """
+        Return a loader over the training set in order, with training augmentation
+        """
+        return self._make_loader(
+            self.trainloader.dataset,
+            batch_size=self.train_batch_size, shuffle=False, num_workers=self.workers,
+            pin_memory=self.pin_memory, drop_last=False
+        )
+
+    def return_proxy_testloaders(self, loaders, num_ids, num_negatives, seed=0):
+        """
+        Return query/gallery loaders (and their flipped versions) over a fixed subset of a
+        test set for proxy evaluation, see `sample_proxy_split`.
+
+        Args:
+        - loaders (dict): 'query', 'gallery', 'query_flip' and 'gallery_flip' loaders of the test set.
+        """
+        query, gallery = loaders['query'].dataset.dataset, loaders['gallery'].dataset.dataset
+        q_indices, g_indices = sample_proxy_split(
+            np.asarray(query.pids), np.asarray(gallery.pids), num_ids, num_negatives, seed=seed
+        )
+        print("=> Proxy evaluation on {} queries and {} gallery images".format(len(q_indices), len(g_indices)))
+
+        proxy_loaders = {}
+        for key, indices in [('query', q_indices), ('gallery', g_indices),
+                             ('query_flip', q_indices), ('gallery_flip', g_indices)]:
+            proxy_loaders[key] = self._make_loader(
+                Subset(loaders[key].dataset, indices.tolist()),
+                batch_size=self.test_batch_size, shuffle=False, num_workers=self.workers,
+                pin_memory=self.pin_memory, drop_last=False
+            )
+        return proxy_loaders
+
     def return_dataloaders(self):
         """
         Return trainloader and testloader dictionary
@@ -53,7 +143,15 @@ class ImageDataManager(BaseDataManager):
                  data_augment='none',
                  num_instances=4,  # number of instances per identity (for RandomIdentitySampler)
                  cuhk03_labeled=False,  # use cuhk03's labeled or detected images
-                 cuhk03_classic_split=False  # use cuhk03's classic split or 767/700 split
+                 cuhk03_classic_split=False,  # use cuhk03's classic split or 767/700 split
+                 cuhk03_packed=False,  # extract cuhk03's images into packed arrays instead of png files
+                 draft_decode=False,  # decode JPEGs at reduced size close to (height, width)
+                 batch_augment=False,  # augment collated batches instead of single images in workers
+                 uint8=False,  # workers emit uint8 tensors, normalization is done on device
+                 shared_workers=False,  # serve all loaders from one persistent worker pool
+                 prefetch=2,  # batches in flight per worker (for the shared worker pool)
+                 io_threads=0,  # concurrent file reads per worker, 0 to read files one by one
+                 hard_sampler_refresh=200  # batches between prototype refreshes (for HardIdentitySampler)
                  ):
         super(ImageDataManager, self).__init__()
         self.use_gpu = use_gpu
@@ -70,44 +168,91 @@ class ImageDataManager(BaseDataManager):
         self.num_instances = num_instances
         self.cuhk03_labeled = cuhk03_labeled
         self.cuhk03_classic_split = cuhk03_classic_split
+        self.cuhk03_packed = cuhk03_packed
+        self.io_threads = io_threads
+        self.hard_sampler_refresh = hard_sampler_refresh
         self.pin_memory = True if self.use_gpu else False
+        self._datasets = {}
+        if shared_workers and self.workers > 0:
+            self.worker_pool = WorkerPool(self.workers, prefetch=prefetch)
 
         # Build train and test transform functions
-        transform_train = build_transforms(self.height, self.width, is_train=True, data_augment=data_augment)
-        transform_test = build_transforms(self.height, self.width, is_train=False, data_augment=data_augment)
-        transform_test_flip = build_transforms(self.height, self.width, is_train=False, data_augment=data_augment, flip=True)
+        transform_train = build_transforms(self.height, self.width, is_train=True, data_augment=data_augment,
+                                           batch_augment=batch_augment, uint8=uint8)
+        transform_test = build_transforms(self.height, self.width, is_train=False, data_augment=data_augment, uint8=uint8)
+        transform_test_flip = build_transforms(self.height, self.width, is_train=False, data_augment=data_augment,
+                                               flip=True, uint8=uint8)
+
+        if draft_decode:
+            decode_size_train = get_decode_size(self.height, self.width, is_train=True, data_augment=data_augment)
+            decode_size_test = get_decode_size(self.height, self.width, is_train=False, data_augment=data_augment)
+        else:
+            decode_size_train = decode_size_test = None
+
+        if batch_augment:
+            # seeded from torch's global seed, i.e. `--seed`
+            self.train_batch_transform = build_batch_transforms(
+                self.height, self.width, data_augment, seed=torch.initial_seed())
+        elif uint8:
+            self.train_batch_transform = build_normalize_transform()
+
+        if uint8:
+            self.test_batch_transform = build_normalize_transform()
 
         print("=> Initializing TRAIN (source) datasets")
-        self.train = []
+        train = []
         self._num_train_pids = 0
         self._num_train_cams = 0
 
         for name in self.source_names:
-            dataset = init_imgreid_dataset(
-                root=self.root, name=name, split_id=self.split_id, cuhk03_labeled=self.cuhk03_labeled,
-                cuhk03_classic_split=self.cuhk03_classic_split
-            )
+            dataset = self._init_dataset(name)
 
-            for img_path, pid, camid in dataset.train:
-                pid += self._num_train_pids
-                camid += self._num_train_cams
-                self.train.append((img_path, pid, camid))
+            train.append(ImageList.from_tuples(dataset.train).shift(self._num_train_pids, self._num_train_cams))
 
             self._num_train_pids += dataset.num_train_pids
             self._num_train_cams += dataset.num_train_cams
 
-        if self.train_sampler == 'RandomIdentitySampler':
-            print('!!! Using RandomIdentitySampler !!!')
-            self.trainloader = DataLoader(
-                ImageDataset(self.train, transform=transform_train),
-                sampler=RandomIdentitySampler(self.train, self.train_batch_size, self.num_instances),
+        self.train = ImageList.concat(train)
+
+        if self.train_sampler == 'HardIdentitySampler':
+            if dist.is_available() and dist.is_initialized():
+                # every process would sample whole epochs of its own, with no shared schedule
+                raise ValueError("HardIdentitySampler does not support distributed training")
+            print('!!! Using HardIdentitySampler !!!')
+            self.trainloader = self._make_loader(
+                ImageDataset(self.train, transform=transform_train, decode_size=decode_size_train, io_threads=self.io_threads),
+                sampler=HardIdentitySampler(self.train, self.train_batch_size, self.num_instances,
+                                            refresh_iters=self.hard_sampler_refresh),
+                batch_size=self.train_batch_size, shuffle=False, num_workers=self.workers,
+                pin_memory=self.pin_memory, drop_last=True
+            )
+
+        elif self.train_sampler == 'RandomIdentitySampler':
+            if dist.is_available() and dist.is_initialized():
+                print('!!! Using DistributedRandomIdentitySampler !!!')
+                sampler = DistributedRandomIdentitySampler(self.train, self.train_batch_size, self.num_instances)
+            else:
+                print('!!! Using RandomIdentitySampler !!!')
+                sampler = RandomIdentitySampler(self.train, self.train_batch_size, self.num_instances)
+            self.trainloader = self._make_loader(
+                ImageDataset(self.train, transform=transform_train, decode_size=decode_size_train, io_threads=self.io_threads),
+                sampler=sampler,
+                batch_size=self.train_batch_size, shuffle=False, num_workers=self.workers,
+                pin_memory=self.pin_memory, drop_last=True
+            )
+
+        elif dist.is_available() and dist.is_initialized():
+            train_dataset = ImageDataset(self.train, transform=transform_train, decode_size=decode_size_train, io_threads=self.io_threads)
+            self.trainloader = self._make_loader(
+                train_dataset,
+                sampler=DistributedSampler(train_dataset, shuffle=True, seed=torch.initial_seed(), drop_last=True),
                 batch_size=self.train_batch_size, shuffle=False, num_workers=self.workers,
                 pin_memory=self.pin_memory, drop_last=True
             )
 
         else:
-            self.trainloader = DataLoader(
-                ImageDataset(self.train, transform=transform_train),
+            self.trainloader = self._make_loader(
+                ImageDataset(self.train, transform=transform_train, decode_size=decode_size_train, io_threads=self.io_threads),
                 batch_size=self.train_batch_size, shuffle=True, num_workers=self.workers,
                 pin_memory=self.pin_memory, drop_last=True
             )
@@ -117,34 +262,31 @@ class ImageDataManager(BaseDataManager):
         self.testdataset_dict = {name: {'query': None, 'gallery': None} for name in self.target_names}
 
         for name in self.target_names:
-            dataset = init_imgreid_dataset(
-                root=self.root, name=name, split_id=self.split_id, cuhk03_labeled=self.cuhk03_labeled,
-                cuhk03_classic_split=self.cuhk03_classic_split
-            )
+            dataset = self._init_dataset(name)
 
             for sub_name, dct in dataset.datasets.items():
                 (query, gallery) = dct['query'], dct['gallery']
                 self.testloader_dict[name][sub_name] = dict(
-                    query=DataLoader(
-                        ImageDataset(query, transform=transform_test),
+                    query=self._make_loader(
+                        ImageDataset(query, transform=transform_test, decode_size=decode_size_test, io_threads=self.io_threads),
                         batch_size=self.test_batch_size, shuffle=False, num_workers=self.workers,
                         pin_memory=self.pin_memory, drop_last=False
                     ),
 
-                    gallery=DataLoader(
-                        ImageDataset(gallery, transform=transform_test),
+                    gallery=self._make_loader(
+                        ImageDataset(gallery, transform=transform_test, decode_size=decode_size_test, io_threads=self.io_threads),
                         batch_size=self.test_batch_size, shuffle=False, num_workers=self.workers,
                         pin_memory=self.pin_memory, drop_last=False
                     ),
 
-                    query_flip=DataLoader(
-                        ImageDataset(query, transform=transform_test_flip),
+                    query_flip=self._make_loader(
+                        ImageDataset(query, transform=transform_test_flip, decode_size=decode_size_test, io_threads=self.io_threads),
                         batch_size=self.test_batch_size, shuffle=False, num_workers=self.workers,
                         pin_memory=self.pin_memory, drop_last=False
                     ),
 
-                    gallery_flip=DataLoader(
-                        ImageDataset(gallery, transform=transform_test_flip),
+                    gallery_flip=self._make_loader(
+                        ImageDataset(gallery, transform=transform_test_flip, decode_size=decode_size_test, io_threads=self.io_threads),
                         batch_size=self.test_batch_size, shuffle=False, num_workers=self.workers,
                         pin_memory=self.pin_memory, drop_last=False
                     )
@@ -153,6 +295,9 @@ class ImageDataManager(BaseDataManager):
             # self.testdataset_dict[name]['query'] = dataset.query
             # self.testdataset_dict[name]['gallery'] = dataset.gallery
 
+        # datasets are only needed while building the loaders
+        self._datasets = {}
+
         print("\n")
         print("  **************** Summary ****************")
         print("  train names      : {}".format(self.source_names))
@@ -162,4 +307,15 @@ class ImageDataManager(BaseDataManager):
         print("  # train cameras  : {}".format(self._num_train_cams))
         print("  test names       : {}".format(self.target_names))
         print("  *****************************************")
-        print("\n")
\ No newline at end of file
+        print("\n")
+
+    def _init_dataset(self, name):
+        """
+        Initialize a dataset once, even if it is both a source and a target
+        """
+        if name not in self._datasets:
+            self._datasets[name] = init_imgreid_dataset(
+                root=self.root, name=name, split_id=self.split_id, cuhk03_labeled=self.cuhk03_labeled,
+                cuhk03_classic_split=self.cuhk03_classic_split, cuhk03_packed=self.cuhk03_packed
+            )
+        return self._datasets[name]
@@ -1,6 +1,9 @@
 from __future__ import absolute_import
 
 import torch
+from torch.distributed.optim import ZeroRedundancyOptimizer
+
+from .utils.distributed import get_rank, get_world_size
 
 
 def init_optimizer(params,
@@ -12,23 +15,60 @@ def init_optimizer(params,
                    sgd_nesterov=False, # whether to enable sgd's Nesterov momentum
                    rmsprop_alpha=0.99, # rmsprop's smoothing constant
                    adam_beta1=0.9, # exponential decay rate for adam's first moment
-                   adam_beta2=0.999 # # exponential decay rate for adam's second moment
+                   adam_beta2=0.999, # # exponential decay rate for adam's second moment
+                   zero=False # shard the optimizer state across the ranks of distributed training
                    ):
     if optim == 'adam':
-        return torch.optim.Adam(params, lr=lr, weight_decay=weight_decay,
-                                betas=(adam_beta1, adam_beta2))
+        optimizer_class = torch.optim.Adam
+        kwargs = dict(lr=lr, weight_decay=weight_decay, betas=(adam_beta1, adam_beta2))
     
     elif optim == 'amsgrad':
-        return torch.optim.Adam(params, lr=lr, weight_decay=weight_decay,
-                                betas=(adam_beta1, adam_beta2), amsgrad=True)
+        optimizer_class = torch.optim.Adam
+        kwargs = dict(lr=lr, weight_decay=weight_decay, betas=(adam_beta1, adam_beta2), amsgrad=True)
     
     elif optim == 'sgd':
-        return torch.optim.SGD(params, lr=lr, momentum=momentum, weight_decay=weight_decay,
-                               dampening=sgd_dampening, nesterov=sgd_nesterov)
+        optimizer_class = torch.optim.SGD
+        kwargs = dict(lr=lr, momentum=momentum, weight_decay=weight_decay,
+                      dampening=sgd_dampening, nesterov=sgd_nesterov)
     
     elif optim == 'rmsprop':
-        return torch.optim.RMSprop(params, lr=lr, momentum=momentum, weight_decay=weight_decay,
-                                   alpha=rmsprop_alpha)
+        optimizer_class = torch.optim.RMSprop
+        kwargs = dict(lr=lr, momentum=momentum, weight_decay=weight_decay, alpha=rmsprop_alpha)
     
     else:
-        raise ValueError("Unsupported optimizer: {}".format(optim))
\ No newline at end of file
+        raise ValueError("Unsupported optimizer: {}".format(optim))
+
+    if zero:
+        # ZeRO stage 1: every rank keeps the state of, and updates, its own shard of the
+        # parameters, then broadcasts it to the other ranks after each step
+        return ZeroRedundancyOptimizer(params, optimizer_class=optimizer_class, **kwargs)
+    return optimizer_class(params, **kwargs)
+
+
+def optimizer_state_dict(optimizer, all_ranks=False):
+    """
+    Return the state dict of `optimizer`. The state of a ZeroRedundancyOptimizer is
+    gathered on rank 0 only (None is returned elsewhere), or on every rank if `all_ranks`;
+    all ranks must call this function then.
+    """
+    if not isinstance(optimizer, ZeroRedundancyOptimizer):
+        return optimizer.state_dict()
+
+    state_dict = None
+    for rank in range(get_world_size() if all_ranks else 1):
+        optimizer.consolidate_state_dict(to=rank)
+        if rank == get_rank():
+            state_dict = optimizer.state_dict()
+    return state_dict
+
+
+def load_optimizer_state_dict(optimizer, state_dict):
+    """
+    Load a state dict returned by `optimizer_state_dict`, on every rank.
+    """
+    if isinstance(optimizer, ZeroRedundancyOptimizer):
+        # unlike torch.optim optimizers, it keeps the state of the parameters missing
+        # from `state_dict` (and it modifies `state_dict`)
+        optimizer.optim.state.clear()
+        state_dict = dict(state_dict, state=dict(state_dict['state']))
+    optimizer.load_state_dict(state_dict)
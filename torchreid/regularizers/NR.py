@@ -7,5 +7,5 @@ class NoneRegularizer(nn.Module):
     def __init__(self, *args, **kwargs):
         super().__init__()
 
-    def forward(self, _):
-        return torch.tensor(0.0).cuda()
+    def forward(self, W):
+        return torch.tensor(0.0, device=W.device)
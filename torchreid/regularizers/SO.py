@@ -38,7 +38,7 @@ class SORegularizer(nn.Module):
         # old_W = W
         old_size = W.size()
 
-        W = W.view(old_size[0], -1).permute(1, 0)
+        W = W.reshape(old_size[0], -1).permute(1, 0)
         # W = W.permute(2, 3, 0, 1).view(old_size[0] * old_size[2] * old_size[3], old_size[1])
 
         d_ev = self.dominant_eigenvalue(
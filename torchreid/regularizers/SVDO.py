@@ -67,7 +67,7 @@ class SVDORegularizer(nn.Module):
         # old_W = W
         old_size = W.size()
 
-        W = W.view(old_size[0], -1).permute(1, 0)
+        W = W.reshape(old_size[0], -1).permute(1, 0)
 
         smallest, largest = self.get_singular_values(W)
         return (
@@ -20,7 +20,7 @@ class SVMORegularizer(nn.Module):
     def dominant_eigenvalue(self, A: 'N x N'):
 
         N, _ = A.size()
-        x = torch.rand(N, 1, device='cuda')
+        x = torch.rand(N, 1, device=A.device, dtype=A.dtype)
 
         # Ax = (A @ x).squeeze()
         # AAx = (A @ Ax).squeeze()
@@ -50,7 +50,7 @@ class SVMORegularizer(nn.Module):
         ATA = A.permute(1, 0) @ A
         N, _ = ATA.size()
         largest = self.dominant_eigenvalue(ATA)
-        I = torch.eye(N, device='cuda')  # noqa
+        I = torch.eye(N, device=ATA.device, dtype=ATA.dtype)  # noqa
         I = I * largest  # noqa
         tmp = self.dominant_eigenvalue(ATA - I)
         return tmp + largest, largest
@@ -65,9 +65,11 @@ class SVMORegularizer(nn.Module):
         if old_size[0] == 1:
             return 0
 
-        W = W.view(old_size[0], -1).permute(1, 0)  # (C x H x W) x S
+        # the Gram matrix and power iterations are computed in fp32 under autocast
+        with torch.autocast(device_type=W.device.type, enabled=False):
+            W = W.float().reshape(old_size[0], -1).permute(1, 0)  # (C x H x W) x S
 
-        smallest, largest = self.get_singular_values(W)
+            smallest, largest = self.get_singular_values(W)
         return (
             self.beta * 10 * (largest - smallest)**2
         ).squeeze()
@@ -1,6 +1,8 @@
 import torch
 import torch.nn as nn
 
+from torchreid.utils.distributed import unwrap_model
+
 from .NR import NoneRegularizer
 from .SVMO import SVMORegularizer
 from .SVDO import SVDORegularizer
@@ -29,12 +31,12 @@ class ConvRegularizer(nn.Module):
 
     def forward(self, net, ignore=False):
 
-        accumulator = torch.tensor(0.0).cuda()
+        accumulator = torch.tensor(0.0, device=next(net.parameters()).device)
 
         if ignore:
             return accumulator
 
-        for conv in self.get_all_conv_layers(net.module.backbone_modules()):
+        for conv in self.get_all_conv_layers(unwrap_model(net).backbone_modules()):
             accumulator += self.reg_instance(conv.weight)
 
         # print(accumulator.data)
@@ -1,71 +1,325 @@
 from __future__ import absolute_import
 from __future__ import division
 
-from collections import defaultdict
 import numpy as np
-import copy
-import random
 
 import torch
+import torch.distributed as dist
+import torch.nn.functional as F
 from torch.utils.data.sampler import Sampler
 
+from .datasets.image_list import ImageList
+
+
+def get_pids(data_source):
+    """Return the pids of a list of (img_path, pid, camid) as an int64 array."""
+    if isinstance(data_source, ImageList):
+        return data_source.pids
+    return np.asarray([item[1] for item in data_source], dtype=np.int64)
+
+
+def group_indices_by_pid(data_source):
+    """Yield (pid, indices) for every identity, indices in ascending order."""
+    pids = get_pids(data_source)
+    order = np.argsort(pids, kind='stable')
+    unique_pids, starts = np.unique(pids[order], return_index=True)
+    for pid, idxs in zip(unique_pids.tolist(), np.split(order, starts[1:])):
+        yield pid, idxs
+
 
 class RandomIdentitySampler(Sampler):
     """
     Randomly sample N identities, then for each identity,
     randomly sample K instances, therefore batch size is N*K.
 
+    An epoch is built in linear time: the images of every identity are
+    shuffled and cut into chunks of K (identities with fewer than K images
+    are sampled with replacement), then batches are drawn in rounds. In each
+    round every identity with chunks left contributes at most one chunk, in
+    random order; if the identities do not fill a whole number of batches,
+    those with the fewest chunks left wait for the next round. The epoch ends
+    when fewer than N identities have chunks left. Since identities with many
+    chunks are never held back, the number of batches per epoch is fixed.
+
     Args:
-    - data_source (list): list of (img_path, pid, camid).
+    - data_source (list or ImageList): list of (img_path, pid, camid).
     - num_instances (int): number of instances per identity in a batch.
     - batch_size (int): number of examples in a batch.
+    - generator (numpy.random.Generator, optional): source of randomness,
+      seeded with `torch.initial_seed()` by default.
     """
-    def __init__(self, data_source, batch_size, num_instances):
+    def __init__(self, data_source, batch_size, num_instances, generator=None):
         self.data_source = data_source
         self.batch_size = batch_size
         self.num_instances = num_instances
         self.num_pids_per_batch = self.batch_size // self.num_instances
-        self.index_dic = defaultdict(list)
-        for index, (_, pid, _) in enumerate(self.data_source):
-            self.index_dic[pid].append(index)
-        self.pids = list(self.index_dic.keys())
-
-        # estimate number of examples in an epoch
-        self.length = 0
-        for pid in self.pids:
-            idxs = self.index_dic[pid]
-            num = len(idxs)
-            if num < self.num_instances:
-                num = self.num_instances
-            self.length += num - num % self.num_instances
+        if generator is None:
+            generator = np.random.default_rng(torch.initial_seed())
+        self.generator = generator
+
+        # indices grouped by pid: pid i owns order[starts[i]:starts[i] + counts[i]]
+        pids = get_pids(self.data_source)
+        self.order = np.argsort(pids, kind='stable')
+        self.pids, self.starts, self.counts = np.unique(pids[self.order], return_index=True, return_counts=True)
+        self.group = np.repeat(np.arange(len(self.pids)), self.counts)
+
+        self.num_chunks = np.maximum(self.counts // self.num_instances, 1)
+        self.length = self._num_batches() * self.batch_size
+
+    def _num_batches(self):
+        """Run the rounds on the chunk counts only; which identities are
+        held back does not change the counts, so no randomness is needed."""
+        P = self.num_pids_per_batch
+        remaining = np.sort(self.num_chunks)
+        num_batches = 0
+        while len(remaining) >= P:
+            num_used = len(remaining) // P * P
+            num_batches += num_used // P
+            # remaining is sorted, the held back identities come first
+            remaining = np.concatenate([remaining[:len(remaining) - num_used], remaining[len(remaining) - num_used:] - 1])
+            remaining = np.sort(remaining[remaining > 0], kind='stable')
+        return num_batches
+
+    def _make_chunks(self):
+        """Return a (num_chunks, K) array of indices, rows grouped by identity."""
+        K = self.num_instances
+        rng = self.generator
+
+        # shuffle within every identity
+        perm = np.lexsort((rng.random(len(self.order)), self.group))
+        shuffled = self.order[perm]
+        rank = np.arange(len(shuffled)) - self.starts[self.group]
+
+        large = self.counts >= K
+        keep = large[self.group] & (rank < (self.counts // K * K)[self.group])
+        chunks = shuffled[keep].reshape(-1, K)
+        chunk_group = self.group[keep][::K]
+
+        # identities with fewer than K images: sample K with replacement
+        small = np.flatnonzero(~large)
+        if len(small) > 0:
+            picks = self.starts[small, None] + (rng.random((len(small), K)) * self.counts[small, None]).astype(np.int64)
+            chunks = np.concatenate([chunks, self.order[picks]])
+            chunk_group = np.concatenate([chunk_group, small])
+
+        return chunks[np.argsort(chunk_group, kind='stable')]
+
+    def _order_round(self, selected):
+        """Order the identities of a round; consecutive groups of N form the batches."""
+        return self.generator.permutation(selected)
+
+    def _iter_rounds(self):
+        """Yield the indices of every round, a whole number of batches each."""
+        P = self.num_pids_per_batch
+        rng = self.generator
+        chunks = self._make_chunks()
+
+        remaining = self.num_chunks.copy()
+        # row of the next unused chunk of every identity
+        next_chunk = np.concatenate([[0], np.cumsum(self.num_chunks)[:-1]])
+        # identities with chunks left
+        pool = np.arange(len(self.pids))
+
+        while len(pool) >= P:
+            selected = pool
+            num_held = len(pool) % P
+            if num_held > 0:
+                # hold back the identities with the fewest chunks left, ties broken randomly
+                keys = remaining[pool] + rng.random(len(pool))
+                selected = pool[np.argpartition(keys, num_held)[num_held:]]
+            selected = self._order_round(selected)
+            yield chunks[next_chunk[selected]].reshape(-1)
+            next_chunk[selected] += 1
+            remaining[selected] -= 1
+            pool = pool[remaining[pool] > 0]
+
+    def _sample_epoch(self):
+        rounds = list(self._iter_rounds())
+        if not rounds:
+            return np.zeros(0, dtype=np.int64)
+        return np.concatenate(rounds)
+
+    def __iter__(self):
+        return iter(self._sample_epoch().tolist())
+
+    def __len__(self):
+        return self.length
+
+    def state_dict(self):
+        """State of the generator, to resume training with the same sampling."""
+        return {'generator': self.generator.bit_generator.state}
+
+    def load_state_dict(self, state_dict):
+        self.generator.bit_generator.state = state_dict['generator']
+
+class DistributedRandomIdentitySampler(RandomIdentitySampler):
+    """
+    `RandomIdentitySampler` for distributed training. Every process draws
+    the same global schedule of batches of N*num_replicas identities from a
+    shared seed, and takes its own N identities out of each global batch, so
+    identities never repeat across processes within a step. Call `set_epoch`
+    at the beginning of each epoch to draw a different schedule.
+
+    Args:
+    - data_source (list or ImageList): list of (img_path, pid, camid).
+    - batch_size (int): number of examples in a batch of one process.
+    - num_instances (int): number of instances per identity in a batch.
+    - num_replicas (int, optional): number of processes, the world size by default.
+    - rank (int, optional): rank of the current process, taken from the
+      default process group by default.
+    - seed (int, optional): must be the same in all processes, defaults to
+      `torch.initial_seed()`.
+    """
+    def __init__(self, data_source, batch_size, num_instances, num_replicas=None, rank=None, seed=None):
+        if num_replicas is None or rank is None:
+            if not dist.is_available() or not dist.is_initialized():
+                raise RuntimeError("Requires an initialized process group, or num_replicas and rank")
+            num_replicas = dist.get_world_size() if num_replicas is None else num_replicas
+            rank = dist.get_rank() if rank is None else rank
+        if not 0 <= rank < num_replicas:
+            raise ValueError("Invalid rank {}, rank should be in the interval [0, {}]".format(rank, num_replicas - 1))
+
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = torch.initial_seed() if seed is None else seed
+        self.epoch = 0
+        super(DistributedRandomIdentitySampler, self).__init__(
+            data_source, batch_size * num_replicas, num_instances,
+            generator=np.random.default_rng([self.seed, self.epoch])
+        )
+        self.local_batch_size = batch_size
+        self.length //= num_replicas
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+        self.generator = np.random.default_rng([self.seed, epoch])
+
+    def __iter__(self):
+        indices = self._sample_epoch().reshape(-1, self.num_replicas, self.local_batch_size)
+        return iter(indices[:, self.rank].reshape(-1).tolist())
+
+
+class HardIdentitySampler(RandomIdentitySampler):
+    """
+    `RandomIdentitySampler` whose batches are made of clusters of mutually
+    confusable identities instead of uniformly random ones.
+
+    Identities are represented by prototypes, the rows of the identity
+    classifier weight. They are fetched from `prototype_fn` (see
+    `set_prototype_fn`) at the first round starting after every
+    `refresh_iters` batches, followed by a k-NN search over them. Each round is then split greedily into clusters of
+    `cluster_size` identities: a random identity and its nearest neighbours
+    not yet taken in the round. Until prototypes are available, batches are
+    drawn as in `RandomIdentitySampler`.
+
+    Args:
+    - data_source (list or ImageList): list of (img_path, pid, camid).
+    - batch_size (int): number of examples in a batch.
+    - num_instances (int): number of instances per identity in a batch.
+    - refresh_iters (int): number of batches between prototype refreshes.
+    - cluster_size (int): number of identities per cluster.
+    - num_neighbors (int): number of neighbours searched per identity.
+    - generator (numpy.random.Generator, optional): see `RandomIdentitySampler`.
+    """
+    def __init__(self, data_source, batch_size, num_instances, refresh_iters=200, cluster_size=4, num_neighbors=16,
+                 generator=None):
+        super(HardIdentitySampler, self).__init__(data_source, batch_size, num_instances, generator=generator)
+        self.refresh_iters = refresh_iters
+        self.cluster_size = cluster_size
+        self.num_neighbors = min(num_neighbors, len(self.pids) - 1)
+        self.prototype_fn = None
+        self.neighbors = None
+        # batches drawn since the last refresh
+        self._batches_since_refresh = refresh_iters
+
+    def set_prototype_fn(self, prototype_fn):
+        """`prototype_fn()` returns a (num_classes, dim) tensor whose row i represents pid i."""
+        self.prototype_fn = prototype_fn
+
+    @torch.no_grad()
+    def _refresh_neighbors(self):
+        prototypes = self.prototype_fn() if self.prototype_fn is not None else None
+        if prototypes is None or self.num_neighbors < 1:
+            return
+
+        prototypes = prototypes.detach().float()
+        prototypes = F.normalize(prototypes[torch.as_tensor(self.pids, device=prototypes.device)], dim=1)
+        neighbors = []
+        # batched to bound the size of the similarity matrix
+        for start in range(0, prototypes.size(0), 4096):
+            sim = prototypes[start:start + 4096].mm(prototypes.t())
+            rows = torch.arange(sim.size(0), device=sim.device)
+            sim[rows, rows + start] = -float('inf')
+            neighbors.append(sim.topk(self.num_neighbors, dim=1)[1].cpu())
+        self.neighbors = torch.cat(neighbors).numpy()
+
+    def state_dict(self):
+        """Also the refresh counter and the neighbours, which are refreshed every `refresh_iters` batches only."""
+        state_dict = super(HardIdentitySampler, self).state_dict()
+        state_dict['batches_since_refresh'] = self._batches_since_refresh
+        state_dict['neighbors'] = self.neighbors
+        return state_dict
+
+    def load_state_dict(self, state_dict):
+        super(HardIdentitySampler, self).load_state_dict(state_dict)
+        self._batches_since_refresh = state_dict['batches_since_refresh']
+        self.neighbors = state_dict['neighbors']
+
+    def _order_round(self, selected):
+        if self._batches_since_refresh >= self.refresh_iters:
+            self._refresh_neighbors()
+            self._batches_since_refresh = 0
+        self._batches_since_refresh += len(selected) // self.num_pids_per_batch
+
+        if self.neighbors is None:
+            return super(HardIdentitySampler, self)._order_round(selected)
+
+        available = np.zeros(len(self.pids), dtype=bool)
+        available[selected] = True
+        clusters = []
+        for seed in self.generator.permutation(selected):
+            if not available[seed]:
+                continue
+            neighbors = self.neighbors[seed]
+            cluster = np.concatenate([[seed], neighbors[available[neighbors]][:self.cluster_size - 1]])
+            available[cluster] = False
+            clusters.append(cluster)
+
+        return np.concatenate([clusters[i] for i in self.generator.permutation(len(clusters))])
+
+    def __iter__(self):
+        # rounds are drawn lazily, so that prototypes are refreshed during the epoch
+        for indices in self._iter_rounds():
+            for index in indices.tolist():
+                yield index
+
+
+class TrackletBatchSampler(Sampler):
+    """
+    Group consecutive tracklets into batches holding at most max_frames
+    frames in total (a longer tracklet forms a batch on its own), to be used
+    with `pack_tracklets` when every frame of a tracklet is loaded.
+
+    Args:
+    - data_source (list): list of (img_paths, pid, camid).
+    - max_frames (int): frame budget of a batch.
+    """
+    def __init__(self, data_source, max_frames):
+        self.max_frames = max_frames
+        self.batches = []
+
+        batch, num_frames = [], 0
+        for index, (img_paths, _, _) in enumerate(data_source):
+            if batch and num_frames + len(img_paths) > self.max_frames:
+                self.batches.append(batch)
+                batch, num_frames = [], 0
+            batch.append(index)
+            num_frames += len(img_paths)
+        if batch:
+            self.batches.append(batch)
 
     def __iter__(self):
-        batch_idxs_dict = defaultdict(list)
-
-        for pid in self.pids:
-            idxs = copy.deepcopy(self.index_dic[pid])
-            if len(idxs) < self.num_instances:
-                idxs = np.random.choice(idxs, size=self.num_instances, replace=True)
-            random.shuffle(idxs)
-            batch_idxs = []
-            for idx in idxs:
-                batch_idxs.append(idx)
-                if len(batch_idxs) == self.num_instances:
-                    batch_idxs_dict[pid].append(batch_idxs)
-                    batch_idxs = []
-
-        avai_pids = copy.deepcopy(self.pids)
-        final_idxs = []
-
-        while len(avai_pids) >= self.num_pids_per_batch:
-            selected_pids = random.sample(avai_pids, self.num_pids_per_batch)
-            for pid in selected_pids:
-                batch_idxs = batch_idxs_dict[pid].pop(0)
-                final_idxs.extend(batch_idxs)
-                if len(batch_idxs_dict[pid]) == 0:
-                    avai_pids.remove(pid)
-
-        return iter(final_idxs)
+        return iter(self.batches)
 
     def __len__(self):
-        return self.length
\ No newline at end of file
+        return len(self.batches)
@@ -92,6 +92,30 @@ class Random2DTranslation(object):
         return croped_img
 
 
+class ToUint8Tensor(object):
+    """
+    Convert a PIL Image to a uint8 tensor of shape (C, H, W) without scaling,
+    so that workers ship 1 byte per pixel instead of 4.
+    """
+
+    def __call__(self, img):
+        arr = np.asarray(img, dtype=np.uint8)
+        if arr.ndim == 2:
+            arr = arr[:, :, None]
+        return torch.from_numpy(arr.transpose(2, 0, 1).copy())
+
+    def __repr__(self):
+        return self.__class__.__name__ + '()'
+
+
+def erasing_value_in_pixels(mean=[0.4914, 0.4822, 0.4465]):
+    """Convert the (normalized space) erasing value of `RandomErasing` into uint8 pixel values."""
+
+    imagenet_mean = [0.485, 0.456, 0.406]
+    imagenet_std = [0.229, 0.224, 0.225]
+    return [int(round(255 * (m * s + mu))) for m, s, mu in zip(mean, imagenet_std, imagenet_mean)]
+
+
 # def build_transforms(height, width, is_train, **kwargs):
 #     """Build transforms
 
@@ -121,7 +145,7 @@ class Random2DTranslation(object):
 
 #     return transforms
 
-def build_training_transforms(height, width, data_augment):
+def build_training_transforms(height, width, data_augment, uint8=False):
 
     imagenet_mean = [0.485, 0.456, 0.406]
     imagenet_std = [0.229, 0.224, 0.225]
@@ -141,15 +165,32 @@ def build_training_transforms(height, width, data_augment):
     if 'color-jitter' in data_augment:
         transforms.append(ColorJitter())
 
-    transforms.append(ToTensor())
-    transforms.append(normalize)
+    if uint8:
+        # normalization is done on device, see `build_batch_transforms`
+        transforms.append(ToUint8Tensor())
+    else:
+        transforms.append(ToTensor())
+        transforms.append(normalize)
 
     if 'random-erase' in data_augment:
-        transforms.append(RandomErasing())
+        if uint8:
+            transforms.append(RandomErasing(mean=erasing_value_in_pixels()))
+        else:
+            transforms.append(RandomErasing())
 
     return transforms
 
 
+def get_decode_size(height, width, is_train, data_augment):
+    """Smallest (width, height) an image must be decoded at so that the
+    transforms built by `build_transforms` never have to upsample it."""
+
+    if is_train and 'crop' in set(data_augment):
+        return int(round(width * 1.125)), int(round(height * 1.125))
+
+    return width, height
+
+
 def build_transforms(height, width, is_train, data_augment, **kwargs):
     """Build transforms
 
@@ -158,6 +199,10 @@ def build_transforms(height, width, is_train, data_augment, **kwargs):
     - width (int): target image width.
     - is_train (bool): train or test phase.
     - data_augment (str)
+    - batch_augment (bool): only resize and convert training images to tensors;
+      the augmentation itself is done on whole batches (see batch_transforms.py).
+    - uint8 (bool): output unnormalized uint8 tensors; normalization is left to
+      the batch transforms applied on device.
     """
 
     # use imagenet mean and std as default
@@ -166,17 +211,25 @@ def build_transforms(height, width, is_train, data_augment, **kwargs):
     normalize = Normalize(mean=imagenet_mean, std=imagenet_std)
 
     transforms = []
-
-    if is_train:
-        transforms = build_training_transforms(height, width, data_augment)
+    uint8 = kwargs.get('uint8', False)
+
+    if is_train and kwargs.get('batch_augment', False):
+        decode_height_width = get_decode_size(height, width, is_train, data_augment)[::-1]
+        transforms += [Resize(decode_height_width)]
+        transforms += [ToUint8Tensor() if uint8 else ToTensor()]
+    elif is_train:
+        transforms = build_training_transforms(height, width, data_augment, uint8=uint8)
     else:
         transforms += [Resize((height, width))]
 
         if kwargs.get('flip', False):
             transforms += [Lambda(lambda img: TF.hflip(img))]
 
-        transforms += [ToTensor()]
-        transforms += [normalize]
+        if uint8:
+            transforms += [ToUint8Tensor()]
+        else:
+            transforms += [ToTensor()]
+            transforms += [normalize]
 
     transforms = Compose(transforms)
     if is_train:
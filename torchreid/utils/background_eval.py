@@ -0,0 +1,100 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import os.path as osp
+import re
+import sys
+import json
+import subprocess
+
+RESULTS_FILE = 'eval_results.jsonl'
+
+# set by torchrun, they would make the worker join the process group
+_DISTRIBUTED_ENV = ('RANK', 'WORLD_SIZE', 'LOCAL_RANK', 'LOCAL_WORLD_SIZE', 'GROUP_RANK', 'ROLE_RANK',
+                    'ROLE_WORLD_SIZE', 'MASTER_ADDR', 'MASTER_PORT', 'TORCHELASTIC_RUN_ID')
+
+
+def parse_cpus(spec):
+    """
+    Parse a CPU list like '0-3,8' into [0, 1, 2, 3, 8].
+    """
+    cpus = []
+    for part in spec.split(','):
+        first, _, last = part.partition('-')
+        cpus.extend(range(int(first), int(last or first) + 1))
+    return cpus
+
+
+def list_checkpoints(save_dir):
+    """
+    Return the (epoch, path) of the epoch checkpoints in `save_dir`, by epoch.
+    """
+    if not osp.isdir(save_dir):
+        return []
+    checkpoints = []
+    for fname in os.listdir(save_dir):
+        match = re.match(r'checkpoint_ep(\d+)\.pth\.tar$', fname)
+        if match:
+            checkpoints.append((int(match.group(1)) - 1, osp.join(save_dir, fname)))
+    return sorted(checkpoints)
+
+
+def append_result(save_dir, result):
+    """
+    Append one evaluation result (a dict) as a JSON line to the results file.
+    """
+    with open(osp.join(save_dir, RESULTS_FILE), 'a') as f:
+        f.write(json.dumps(result) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+
+class ResultsReader(object):
+    """
+    Read the results appended to the results file of `save_dir` since the last call.
+    """
+
+    def __init__(self, save_dir):
+        self.fpath = osp.join(save_dir, RESULTS_FILE)
+        self.offset = 0
+
+    def poll(self):
+        if not osp.exists(self.fpath):
+            return []
+        with open(self.fpath) as f:
+            f.seek(self.offset)
+            lines = f.readlines()
+        results = []
+        for line in lines:
+            # a line being written is read at the next poll
+            if not line.endswith('\n'):
+                break
+            self.offset += len(line)
+            results.append(json.loads(line))
+        return results
+
+
+def launch_eval_worker(script, argv, gpu_devices=None, cpus=None):
+    """
+    Start `script argv --eval-worker` in a new process, on `gpu_devices`
+    ('cpu' for the CPU, the training devices by default), pinned to `cpus` if given.
+
+    Args:
+    - script (str): the training script.
+    - argv (list): arguments of the training run.
+    - gpu_devices (str, optional): value of --gpu-devices for the worker, or 'cpu'.
+    - cpus (list, optional): CPU cores the worker runs on.
+    """
+    argv = [sys.executable, script] + list(argv) + ['--eval-worker']
+    if gpu_devices == 'cpu':
+        argv.append('--use-cpu')
+    elif gpu_devices:
+        argv += ['--gpu-devices', gpu_devices]
+
+    env = {k: v for k, v in os.environ.items() if k not in _DISTRIBUTED_ENV}
+    preexec_fn = None
+    if cpus:
+        preexec_fn = lambda: os.sched_setaffinity(0, cpus)
+    # the worker logs to log_eval.txt
+    return subprocess.Popen(argv, env=env, stdout=subprocess.DEVNULL, preexec_fn=preexec_fn)
@@ -0,0 +1,152 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import os.path as osp
+import random
+import shutil
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import torch
+
+from .iotools import mkdir_if_missing
+
+
+def get_rng_state():
+    """State of the python, numpy and torch (CPU and CUDA) random number generators."""
+    state = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        state['cuda'] = torch.cuda.get_rng_state_all()
+    return state
+
+
+def set_rng_state(state):
+    random.setstate(state['python'])
+    np.random.set_state(state['numpy'])
+    torch.set_rng_state(state['torch'])
+    if 'cuda' in state and torch.cuda.is_available() and len(state['cuda']) == torch.cuda.device_count():
+        torch.cuda.set_rng_state_all(state['cuda'])
+
+
+def _to_cpu(obj):
+    # a copy: training goes on updating the tensors while the snapshot is written
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return type(obj)((k, _to_cpu(v)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return obj
+
+
+def _atomic_save(obj, fpath):
+    # a reader (or a crash) never sees a partially written file
+    tmp_path = fpath + '.tmp'
+    with open(tmp_path, 'wb') as f:
+        torch.save(obj, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, fpath)
+
+
+def checkpoint_path(save_dir, epoch):
+    return osp.join(save_dir, 'checkpoint_ep{}.pth.tar'.format(epoch + 1))
+
+
+def _atomic_link(src, dst):
+    # a hard link costs no copy; fall back to copying where links are not supported
+    tmp_path = dst + '.tmp'
+    if osp.lexists(tmp_path):
+        os.remove(tmp_path)
+    try:
+        os.link(src, tmp_path)
+    except OSError:
+        shutil.copyfile(src, tmp_path)
+    os.replace(tmp_path, dst)
+
+
+class CheckpointManager(object):
+    """
+    Save training checkpoints in a background thread, so that writing
+    hundreds of MB to slow storage does not stall training.
+
+    `save()` snapshots the state to CPU memory, then returns; the snapshot is
+    written to `checkpoint_ep<epoch>.pth.tar` through a temporary file and an
+    atomic rename. `checkpoint_latest.pth.tar` and `checkpoint_best.pth.tar`
+    are hard links to the last and the best checkpoints, and only the last
+    `keep_last` epoch files are kept. At most one snapshot waits to be
+    written; an error in the writer is raised by the next `save()` or by
+    `close()`.
+
+    A checkpoint saved with `hold=True` is not removed until `release()`,
+    e.g. until a background evaluation tells whether it is the best one.
+
+    Args:
+    - save_dir (str): directory of the checkpoints.
+    - keep_last (int): number of epoch checkpoints kept, besides the best one.
+    """
+
+    def __init__(self, save_dir, keep_last=1):
+        self.save_dir = save_dir
+        self.keep_last = max(keep_last, 1)
+        self.executor = ThreadPoolExecutor(1)
+        self.pending = []
+        self.saved = []
+        self.held = set()
+
+    def wait(self):
+        """Wait until the last checkpoint is written."""
+        pending, self.pending = self.pending, []
+        for future in pending:
+            future.result()
+
+    def save(self, state, epoch, is_best=False, hold=False):
+        if os.environ.get('no_save'):
+            return
+
+        self.wait()
+        self.pending.append(self.executor.submit(self._write, _to_cpu(state), epoch, is_best, hold))
+
+    def release(self, epoch, is_best=False):
+        """
+        Let the checkpoint of `epoch`, saved with `hold=True`, be removed;
+        link it as the best checkpoint first if `is_best`.
+        """
+        self.pending.append(self.executor.submit(self._release, epoch, is_best))
+
+    def _write(self, state, epoch, is_best, hold):
+        mkdir_if_missing(self.save_dir)
+        fpath = checkpoint_path(self.save_dir, epoch)
+        _atomic_save(state, fpath)
+        _atomic_link(fpath, osp.join(self.save_dir, 'checkpoint_latest.pth.tar'))
+        if is_best:
+            _atomic_link(fpath, osp.join(self.save_dir, 'checkpoint_best.pth.tar'))
+
+        self.saved.append(fpath)
+        if hold:
+            self.held.add(fpath)
+        self._prune()
+
+    def _release(self, epoch, is_best):
+        fpath = checkpoint_path(self.save_dir, epoch)
+        # results of an earlier run may refer to removed checkpoints
+        if is_best and osp.exists(fpath):
+            _atomic_link(fpath, osp.join(self.save_dir, 'checkpoint_best.pth.tar'))
+        self.held.discard(fpath)
+        self._prune()
+
+    def _prune(self):
+        # the best checkpoint, if it is one of these, lives on as checkpoint_best.pth.tar
+        for fpath in self.saved[:-self.keep_last]:
+            if fpath not in self.held:
+                os.remove(fpath)
+                self.saved.remove(fpath)
+
+    def close(self):
+        self.wait()
+        self.executor.shutdown()
@@ -0,0 +1,79 @@
+from __future__ import absolute_import
+
+import os
+import datetime
+
+import torch
+import torch.nn as nn
+import torch.distributed as dist
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def get_local_rank():
+    return int(os.environ.get('LOCAL_RANK', 0))
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+# the other ranks wait in `barrier` while rank 0 evaluates, which can take longer than the
+# timeout of NCCL collectives, hence a gloo group with a timeout of its own
+BARRIER_TIMEOUT = datetime.timedelta(hours=6)
+_barrier_group = None
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier(group=_barrier_group)
+
+
+def init_distributed(use_gpu, backend=None):
+    """
+    Initialize the default process group from the environment set by
+    torchrun (RANK, WORLD_SIZE, LOCAL_RANK, MASTER_ADDR, MASTER_PORT).
+    Return False, without doing anything, when not launched by torchrun
+    or with a single process.
+
+    Args:
+    - use_gpu (bool): bind the process to GPU LOCAL_RANK.
+    - backend (str, optional): 'nccl' or 'gloo'; 'nccl' on GPU if
+      available, 'gloo' otherwise.
+    """
+    if int(os.environ.get('WORLD_SIZE', 1)) <= 1:
+        return False
+
+    if backend is None:
+        backend = 'nccl' if use_gpu and dist.is_nccl_available() else 'gloo'
+    if use_gpu:
+        torch.cuda.set_device(get_local_rank())
+    dist.init_process_group(backend=backend, init_method='env://')
+
+    global _barrier_group
+    _barrier_group = dist.new_group(backend='gloo', timeout=BARRIER_TIMEOUT)
+    return True
+
+
+def cleanup_distributed():
+    global _barrier_group
+    if is_distributed():
+        dist.destroy_process_group()
+    _barrier_group = None
+
+
+def unwrap_model(model):
+    """Return the model wrapped by DataParallel or DistributedDataParallel."""
+    if isinstance(model, (nn.DataParallel, nn.parallel.DistributedDataParallel)):
+        return model.module
+    return model
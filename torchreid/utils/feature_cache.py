@@ -0,0 +1,126 @@
+from __future__ import absolute_import
+from __future__ import print_function
+from __future__ import division
+
+import os
+import os.path as osp
+
+import numpy as np
+import torch
+
+# larger caches are memory-mapped files instead of arrays in RAM
+MAX_IN_MEMORY = 4 * 2 ** 30
+
+
+class FeatureCache(object):
+    """
+    Frozen feature maps of every training image, stored in fp16, for
+    `num_variants` augmented versions of the training set: one array of
+    shape (num_variants, num_images, *shape) per entry of `shapes`.
+
+    Args:
+    - num_images (int): number of training images.
+    - shapes (list): shape of the feature map of one image, for each entry.
+    - num_variants (int): number of augmented versions of each image.
+    - fpath (str, optional): prefix of the memory-mapped files used if the
+      cache exceeds MAX_IN_MEMORY bytes.
+    """
+
+    def __init__(self, num_images, shapes, num_variants, fpath=None):
+        self.num_images = num_images
+        self.num_variants = num_variants
+        self.fpaths = []
+
+        shapes = [(num_variants, num_images) + tuple(shape) for shape in shapes]
+        nbytes = sum(int(np.prod(shape)) * 2 for shape in shapes)
+        if nbytes > MAX_IN_MEMORY and fpath is not None:
+            print("=> Memory-mapping a {:.1f} GB feature cache to {}.*".format(nbytes / 2 ** 30, fpath))
+            self.arrays = []
+            for i, shape in enumerate(shapes):
+                self.fpaths.append('{}.{}.npy'.format(fpath, i))
+                self.arrays.append(np.lib.format.open_memmap(self.fpaths[-1], mode='w+', dtype=np.float16, shape=shape))
+        else:
+            self.arrays = [np.empty(shape, dtype=np.float16) for shape in shapes]
+
+    def put(self, variant, indices, feats):
+        indices = np.asarray(indices)
+        for array, f in zip(self.arrays, feats):
+            array[variant, indices] = f.detach().cpu().half().numpy()
+
+    def get(self, variant, indices):
+        # sorted reads are sequential in memory-mapped files
+        indices = np.asarray(indices)
+        order = np.argsort(indices)
+        inverse = np.empty_like(order)
+        inverse[order] = np.arange(len(order))
+        return [torch.from_numpy(array[variant, indices[order]][inverse]).float() for array in self.arrays]
+
+    def close(self):
+        self.arrays = []
+        for fpath in self.fpaths:
+            if osp.exists(fpath):
+                os.remove(fpath)
+        self.fpaths = []
+
+
+class CachedFeatureLoader(object):
+    """
+    Iterate over the batches of the train sampler like the trainloader, but
+    yield (feats, pids, None, None), where feats are the cached feature
+    maps of variant `epoch % num_variants` instead of images.
+
+    Args:
+    - cache (FeatureCache): the feature cache.
+    - trainloader (DataLoader): the trainloader, whose batch sampler is used.
+    - pids (numpy.ndarray): pid of every training image.
+    """
+
+    def __init__(self, cache, trainloader, pids):
+        self.cache = cache
+        self.batch_sampler = trainloader.batch_sampler
+        self.pids = np.asarray(pids)
+        self.variant = 0
+
+    def set_epoch(self, epoch):
+        self.variant = epoch % self.cache.num_variants
+
+    def __iter__(self):
+        for indices in self.batch_sampler:
+            yield self.cache.get(self.variant, indices), torch.from_numpy(self.pids[indices]), None, None
+
+    def __len__(self):
+        return len(self.batch_sampler)
+
+
+@torch.no_grad()
+def build_feature_cache(model, loader, num_variants, use_gpu, batch_transform=None, fpath=None):
+    """
+    Run the frozen part of `model` (`model.forward_middle`) over `loader`
+    `num_variants` times and store its outputs in a FeatureCache.
+
+    Args:
+    - model (nn.Module): a model with `forward_middle`, unwrapped from DataParallel.
+    - loader (DataLoader): the training set in order, with training augmentation.
+    - num_variants (int): number of passes, i.e. of augmented versions of each image.
+    - use_gpu (bool): run the model on GPU.
+    - batch_transform (callable, optional): batch transform applied after the copy to GPU.
+    - fpath (str, optional): see `FeatureCache`.
+    """
+    cache = None
+    for variant in range(num_variants):
+        start = 0
+        for imgs, _, _, _ in loader:
+            if use_gpu:
+                imgs = imgs.cuda()
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
+
+            feats, _ = model.forward_middle(imgs)
+            if cache is None:
+                cache = FeatureCache(len(loader.dataset), [f.shape[1:] for f in feats], num_variants, fpath=fpath)
+            cache.put(variant, np.arange(start, start + imgs.size(0)), feats)
+            start += imgs.size(0)
+
+        print("Cached backbone features of variant {}/{} of the training set".format(variant + 1, num_variants))
+
+    return cache
@@ -3,6 +3,8 @@ from __future__ import absolute_import
 import sys
 import os
 import os.path as osp
+import json
+import copy
 
 from .iotools import mkdir_if_missing
 
@@ -65,10 +67,32 @@ class RankLogger(object):
         self.logger[name]['epoch'].append(epoch)
         self.logger[name]['rank1'].append(rank1)
 
+    def state_dict(self):
+        return copy.deepcopy(self.logger)
+
+    def load_state_dict(self, state_dict):
+        """
+        Restore the results recorded before resuming.
+        """
+        for name in self.target_names:
+            self.logger[name] = copy.deepcopy(state_dict[name])
+
     def show_summary(self):
         print("=> Show summary")
         for name in self.target_names:
             from_where = 'source' if name in self.source_names else 'target'
             print("{} ({})".format(name, from_where))
             for epoch, rank1 in zip(self.logger[name]['epoch'], self.logger[name]['rank1']):
-                print("- epoch {}\t rank1 {:.1%}".format(epoch, rank1))
\ No newline at end of file
+                print("- epoch {}\t rank1 {:.1%}".format(epoch, rank1))
+
+    def save(self, fpath, **extra):
+        """
+        Write the recorded results, and the `extra` fields, to a JSON file.
+        """
+        summary = dict(extra)
+        summary['results'] = {
+            name: {'epoch': self.logger[name]['epoch'], 'rank1': [float(rank1) for rank1 in self.logger[name]['rank1']]}
+            for name in self.target_names
+        }
+        with open(fpath, 'w') as f:
+            json.dump(summary, f, indent=2)
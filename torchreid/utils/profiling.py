@@ -0,0 +1,106 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os.path as osp
+from contextlib import contextmanager
+
+import torch
+from torch.profiler import profile, ProfilerActivity, _ExperimentalConfig
+
+
+def parse_step_range(steps):
+    """Parse 'START-STOP' into (start, stop); '' or None into None."""
+    if not steps:
+        return None
+    try:
+        start, stop = (int(s) for s in steps.split('-'))
+    except ValueError:
+        raise ValueError("Invalid step range '{}', expected START-STOP, e.g. 50-60".format(steps))
+    if not 0 <= start < stop:
+        raise ValueError("Invalid step range '{}', expected 0 <= START < STOP".format(steps))
+    return start, stop
+
+
+class Profiler(object):
+    """
+    Capture a window of the program with torch.profiler (CPU and, on GPU,
+    CUDA activity, with shapes, memory and Python stacks), then export into
+    `save_dir`:
+    - profile_<name>.json: Chrome trace, for chrome://tracing or Perfetto.
+    - profile_<name>.txt: per-operator summary table.
+    - profile_<name>.stacks.txt: the same table, per operator and calling Python stack.
+
+    The window is either given in steps, with `step()` called at the start
+    of every step, or is the first block run under `capture()`. A disabled
+    profiler does nothing.
+
+    Args:
+    - save_dir (str): output directory.
+    - name (str): name of the capture, used in the file names.
+    - use_gpu (bool): also record CUDA activity.
+    - steps (tuple, optional): (start, stop), capture steps start to stop - 1, counting from 0.
+    - enabled (bool): whether to profile at all.
+    """
+
+    def __init__(self, save_dir, name, use_gpu, steps=None, enabled=True):
+        self.save_dir = save_dir
+        self.name = name
+        self.use_gpu = use_gpu
+        self.steps = steps
+        self.enabled = enabled
+        self.num_steps = 0
+        self.prof = None
+
+    def _start(self):
+        activities = [ProfilerActivity.CPU]
+        if self.use_gpu:
+            activities.append(ProfilerActivity.CUDA)
+        # verbose: keep the Python stacks of the events, not only of the trace
+        self.prof = profile(activities=activities, record_shapes=True, profile_memory=True, with_stack=True,
+                            experimental_config=_ExperimentalConfig(verbose=True))
+        self.prof.start()
+        print("=> Profiling {} ...".format(self.name))
+
+    def _export(self):
+        prof, self.prof = self.prof, None
+        self.enabled = False
+        if self.use_gpu:
+            torch.cuda.synchronize()
+        prof.stop()
+
+        prefix = osp.join(self.save_dir, 'profile_{}'.format(self.name))
+        sort_by = 'self_cuda_time_total' if self.use_gpu else 'self_cpu_time_total'
+        prof.export_chrome_trace(prefix + '.json')
+        with open(prefix + '.txt', 'w') as f:
+            f.write(prof.key_averages().table(sort_by=sort_by, row_limit=100))
+        with open(prefix + '.stacks.txt', 'w') as f:
+            f.write(prof.key_averages(group_by_stack_n=8).table(sort_by=sort_by, row_limit=100))
+        print("=> Profile of {} saved to {}.{{json,txt,stacks.txt}}".format(self.name, prefix))
+
+    def step(self):
+        if not self.enabled or self.steps is None:
+            return
+
+        start, stop = self.steps
+        if self.num_steps == stop and self.prof is not None:
+            self._export()
+        elif self.num_steps == start:
+            self._start()
+        self.num_steps += 1
+
+    @contextmanager
+    def capture(self):
+        if not self.enabled or self.prof is not None:
+            yield
+            return
+
+        self._start()
+        try:
+            yield
+        finally:
+            self._export()
+
+    def close(self):
+        """Export a capture still running, e.g. when training ends inside the window."""
+        if self.prof is not None:
+            self._export()
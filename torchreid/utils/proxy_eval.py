@@ -0,0 +1,52 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import numpy as np
+
+
+def sample_proxy_split(q_pids, g_pids, num_ids, num_negatives, seed=0):
+    """
+    Draw a fixed subset of a test set for proxy evaluation: all the queries
+    of `num_ids` random query identities, all the gallery images of these
+    identities (positives) and `num_negatives` random other gallery images.
+    Return the sorted (query_indices, gallery_indices).
+
+    Args:
+    - q_pids (np.ndarray): pids of the queries.
+    - g_pids (np.ndarray): pids of the gallery images.
+    - num_ids (int): number of query identities.
+    - num_negatives (int): number of gallery images of other identities.
+    - seed (int): seed of the draw.
+    """
+    rng = np.random.RandomState(seed)
+    ids = np.unique(q_pids)
+    ids = rng.choice(ids, min(num_ids, len(ids)), replace=False)
+
+    q_indices = np.flatnonzero(np.isin(q_pids, ids))
+    positive = np.isin(g_pids, ids)
+    negatives = np.flatnonzero(~positive)
+    negatives = rng.choice(negatives, min(num_negatives, len(negatives)), replace=False)
+    g_indices = np.sort(np.concatenate([np.flatnonzero(positive), negatives]))
+    return q_indices, g_indices
+
+
+def bootstrap_ci(values, groups, num_samples=1000, alpha=0.05, seed=0):
+    """
+    Return the mean of `values` and its (1 - alpha) bootstrap confidence
+    interval (low, high). Whole groups (e.g. the queries of one identity,
+    which are correlated) are resampled together.
+
+    Args:
+    - values (np.ndarray): one value per query.
+    - groups (np.ndarray): group of every query.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    _, inverse = np.unique(groups, return_inverse=True)
+    sums = np.bincount(inverse, weights=values)
+    counts = np.bincount(inverse)
+
+    rng = np.random.RandomState(seed)
+    draws = rng.randint(len(sums), size=(num_samples, len(sums)))
+    means = sums[draws].sum(1) / counts[draws].sum(1)
+    low, high = np.percentile(means, [100 * alpha / 2, 100 * (1 - alpha / 2)])
+    return values.mean(), low, high
@@ -0,0 +1,84 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+MAX_RETRIES = 5
+# seconds before the first retry, doubled after every failed attempt
+RETRY_BACKOFF = 0.1
+
+# per process; read by `get_io_stats`
+_io_stats = {'reads': 0, 'retries': 0}
+_io_stats_lock = threading.Lock()
+
+
+def _count(key):
+    with _io_stats_lock:
+        _io_stats[key] += 1
+
+
+def get_io_stats():
+    """Number of files read and of retried reads in the current process."""
+    with _io_stats_lock:
+        return dict(_io_stats)
+
+
+def retry_io(fn, path, max_retries=MAX_RETRIES, backoff=RETRY_BACKOFF):
+    """
+    Call `fn(path)`, retrying on IOError at most `max_retries` times with
+    exponential backoff. Transient failures of networked storage are thus
+    absorbed, while a persistent one is raised instead of looping forever.
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return fn(path)
+        except IOError as e:
+            if attempt == max_retries:
+                raise IOError("Failed to read '{}' after {} retries: {}".format(path, max_retries, e))
+            delay = backoff * 2 ** attempt
+            _count('retries')
+            print("=> Warning: IOError when reading '{}' ({}), retry {}/{} in {:.2f}s".format(
+                path, e, attempt + 1, max_retries, delay))
+            time.sleep(delay)
+
+
+def read_bytes(path):
+    with open(path, 'rb') as f:
+        buf = f.read()
+    _count('reads')
+    return buf
+
+
+class ReadAhead(object):
+    """
+    A bounded pool of reader threads fetching the raw bytes of many files
+    concurrently, so that reading a batch from high-latency storage costs
+    about one round trip instead of one per file.
+
+    Threads do not survive a fork, so every process (e.g. each DataLoader
+    worker) lazily creates its own pool.
+
+    Args:
+    - num_threads (int): number of concurrent reads.
+    """
+
+    def __init__(self, num_threads):
+        self.num_threads = num_threads
+        self._executor = None
+        self._pid = None
+
+    def _get_executor(self):
+        if self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(self.num_threads)
+            self._pid = os.getpid()
+        return self._executor
+
+    def read(self, paths):
+        """Return the bytes of every file in `paths`, in order."""
+        return list(self._get_executor().map(lambda path: retry_io(read_bytes, path), paths))
+
+    def __getstate__(self):
+        return {'num_threads': self.num_threads, '_executor': None, '_pid': None}
@@ -5,8 +5,23 @@ import numpy as np
 import os
 import os.path as osp
 import shutil
+from PIL import Image
 
 from .iotools import mkdir_if_missing
+from ..datasets.packed_images import is_packed_path, read_packed_image
+
+
+def _copy_image(src, dst):
+    """
+    shutil.copy for images, also of packed stores (--cuhk03-packed), which
+    are written as png files
+    """
+    if not is_packed_path(src):
+        shutil.copy(src, dst)
+        return
+    if osp.isdir(dst):
+        dst = osp.join(dst, osp.basename(src))
+    Image.fromarray(read_packed_image(src)).save(dst + '.png')
 
 
 def visualize_ranked_results(distmat, dataset, save_dir='log/ranked_results', topk=20):
@@ -47,10 +62,10 @@ def visualize_ranked_results(distmat, dataset, save_dir='log/ranked_results', to
             dst = osp.join(dst, prefix + '_top' + str(rank).zfill(3))
             mkdir_if_missing(dst)
             for img_path in src:
-                shutil.copy(img_path, dst)
+                _copy_image(img_path, dst)
         else:
             dst = osp.join(dst, prefix + '_top' + str(rank).zfill(3) + '_name_' + osp.basename(src))
-            shutil.copy(src, dst)
+            _copy_image(src, dst)
 
     for q_idx in range(num_q):
         qimg_path, qpid, qcamid = query[q_idx]
@@ -0,0 +1,136 @@
+from __future__ import absolute_import
+from __future__ import division
+
+import json
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+import torch
+
+try:
+    import resource
+except ImportError:  # not available on Windows
+    resource = None
+
+
+def peak_memory_mb(use_gpu):
+    """
+    Peak memory in MB: allocated by tensors since the last reset of the
+    peak statistics on GPU, resident in the whole process on CPU (None if
+    unavailable).
+    """
+    if use_gpu:
+        return torch.cuda.max_memory_allocated() / 2 ** 20
+    if resource is not None:
+        # ru_maxrss is in KB on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+    return None
+
+
+class StepTimer(object):
+    """
+    Time the phases of training steps (data wait, host-to-device copy,
+    forward, criterion, ...) and append, every `log_freq` steps, one JSON
+    line with the mean time of every phase, the throughput and the peak
+    memory over these steps. The last steps of an epoch are written by
+    `flush`, so that a record never spans evaluation or checkpointing.
+
+    Kernels run asynchronously on accelerators, so without `sync` the time
+    of a phase is only the time to launch its kernels; with `sync` the
+    device is synchronized around every phase, which is accurate but
+    slows training down.
+
+    Args:
+    - fpath (str): path of the JSONL file. None disables the timer.
+    - log_freq (int): number of steps per record.
+    - sync (bool): synchronize the device around phases.
+    - use_gpu (bool): whether training runs on GPU.
+    - append (bool): append to the file, e.g. when resuming, instead of truncating it.
+    """
+
+    def __init__(self, fpath=None, log_freq=0, sync=False, use_gpu=False, append=False):
+        self.fpath = fpath
+        self.log_freq = log_freq
+        self.sync = sync
+        self.use_gpu = use_gpu
+        self.enabled = fpath is not None and log_freq > 0
+        if self.enabled and not append:
+            open(fpath, 'w').close()
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new window of steps. On GPU, this also resets the peak memory
+        statistics: the timer is the one place where they are reset.
+        """
+        self.times = OrderedDict()
+        self.num_steps = 0
+        self.last_step = None
+        self.num_images = 0
+        self.loss_sum = 0.
+        self.start = time.time()
+        if self.use_gpu:
+            torch.cuda.reset_peak_memory_stats()
+
+    def _synchronize(self):
+        if self.sync and self.use_gpu:
+            torch.cuda.synchronize()
+
+    def add(self, name, seconds):
+        if self.enabled:
+            self.times[name] = self.times.get(name, 0.) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        # also labels the phase in torch.profiler traces
+        with torch.profiler.record_function(name):
+            if not self.enabled:
+                yield
+                return
+
+            self._synchronize()
+            start = time.time()
+            yield
+            self._synchronize()
+            self.add(name, time.time() - start)
+
+    def _peak_memory(self):
+        peak = peak_memory_mb(self.use_gpu)
+        if peak is None:
+            return {}
+        return {'peak_mem_mb' if self.use_gpu else 'peak_rss_mb': peak}
+
+    def step(self, epoch, batch_idx, num_images, loss):
+        """Close a step; write a record every `log_freq` steps."""
+        if not self.enabled:
+            return
+
+        self.num_steps += 1
+        self.last_step = (epoch, batch_idx)
+        self.num_images += num_images
+        self.loss_sum += loss
+        if self.num_steps >= self.log_freq:
+            self.flush()
+
+    def flush(self):
+        """Write a record of the steps since the last one, if any."""
+        if not self.enabled or self.num_steps == 0:
+            return
+
+        epoch, batch_idx = self.last_step
+        elapsed = time.time() - self.start
+        record = OrderedDict([
+            ('epoch', epoch + 1),
+            ('step', batch_idx + 1),
+            ('num_steps', self.num_steps),
+            ('step_time', elapsed / self.num_steps),
+            ('phases', OrderedDict((k, v / self.num_steps) for k, v in self.times.items())),
+            ('images_per_sec', self.num_images / elapsed),
+            ('loss', self.loss_sum / self.num_steps),
+        ])
+        record.update(self._peak_memory())
+
+        with open(self.fpath, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+        self.reset()
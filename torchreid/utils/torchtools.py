@@ -2,8 +2,12 @@ from __future__ import absolute_import
 from __future__ import print_function
 from __future__ import division
 
+from contextlib import contextmanager
+
+import numpy as np
 import torch
 import torch.nn as nn
+from torch.utils.checkpoint import checkpoint
 
 def init_params(x):
 
@@ -91,6 +95,60 @@ def open_specified_layers(model, open_layers):
             open_specified_layers(module, open_layers)
 
 
+@contextmanager
+def _frozen_bn_stats(module):
+    # momentum 0 leaves the running statistics unchanged, but num_batches_tracked is still incremented
+    bns = [m for m in module.modules() if isinstance(m, nn.modules.batchnorm._BatchNorm) and m.training]
+    momenta = [m.momentum for m in bns]
+    num_batches = [m.num_batches_tracked.clone() if m.num_batches_tracked is not None else None for m in bns]
+    for m in bns:
+        m.momentum = 0.
+    try:
+        yield
+    finally:
+        for m, momentum, tracked in zip(bns, momenta, num_batches):
+            m.momentum = momentum
+            if tracked is not None:
+                m.num_batches_tracked.copy_(tracked)
+
+
+def maybe_checkpoint(module, *inputs):
+    """
+    Return `module(*inputs)`. If `module.checkpointing` is set, in training,
+    the activations inside `module` are not stored but recomputed in
+    backward, trading compute for memory.
+    """
+    if not (getattr(module, 'checkpointing', False) and module.training and torch.is_grad_enabled()):
+        return module(*inputs)
+
+    num_calls = [0]
+
+    def forward(*inputs):
+        num_calls[0] += 1
+        if num_calls[0] == 1:
+            return module(*inputs)
+        # recomputation in backward: BatchNorm statistics were updated already
+        with _frozen_bn_stats(module):
+            return module(*inputs)
+
+    return checkpoint(forward, *inputs, use_reentrant=False)
+
+
+def to_channels_last(model):
+    """
+    Convert the parameters of `model` and, through a forward pre-hook, its
+    4-d inputs to the channels_last (NHWC) memory format, which convolutions
+    run faster in with oneDNN on CPU and with tensor cores on GPU.
+    """
+    def hook(module, inputs):
+        return tuple(x.contiguous(memory_format=torch.channels_last) if torch.is_tensor(x) and x.dim() == 4 else x
+                     for x in inputs)
+
+    model.to(memory_format=torch.channels_last)
+    model.register_forward_pre_hook(hook)
+    return model
+
+
 def count_num_param(model):
     num_param = sum(p.numel() for p in model.parameters()) / 1e+06
 
@@ -101,3 +159,54 @@ def count_num_param(model):
         # we ignore the classifier because it is unused at test time
         num_param -= sum(p.numel() for p in model.classifier.parameters()) / 1e+06
     return num_param
+
+
+def pool_tracklet_features(features, offsets, method='avg'):
+    """
+    Pool frame features into tracklet features.
+
+    Args:
+    - features (torch.Tensor): frame features of shape (total_frames, feat_dim).
+    - offsets (torch.LongTensor): tracklet i owns frames offsets[i]:offsets[i + 1],
+      as returned by `pack_tracklets`.
+    - method (str): 'avg' or 'max'.
+    """
+    offsets = offsets.to(features.device)
+    lengths = offsets[1:] - offsets[:-1]
+    num_tracklets = lengths.size(0)
+    segment = torch.repeat_interleave(torch.arange(num_tracklets, device=features.device), lengths)
+    index = segment.view(-1, 1).expand_as(features)
+
+    pooled = features.new_zeros(num_tracklets, features.size(1))
+    if method == 'avg':
+        pooled.scatter_add_(0, index, features)
+        return pooled / lengths.view(-1, 1).to(features.dtype)
+    elif method == 'max':
+        return pooled.scatter_reduce_(0, index, features, reduce='amax', include_self=False)
+
+    raise ValueError("Unknown pooling method: {}. Expected one of ['avg', 'max']".format(method))
+
+
+def extract_tracklet_features(model, loader, use_gpu, method='avg'):
+    """
+    Extract one feature per tracklet from a loader yielding packed batches
+    (see `pack_tracklets`): frames of all tracklets in a batch go through
+    the model at once and are pooled per tracklet afterwards.
+
+    Returns features (torch.Tensor), pids (np.ndarray) and camids (np.ndarray).
+    The training scripts here are image-based, this is for video evaluation
+    code built on `VideoDataManager`, with `method=dm.pool_tracklet_features`.
+    """
+    model.eval()
+
+    features, pids, camids = [], [], []
+    with torch.no_grad():
+        for imgs, offsets, batch_pids, batch_camids in loader:
+            if use_gpu:
+                imgs = imgs.cuda()
+            frame_features = model(imgs)[0]
+            features.append(pool_tracklet_features(frame_features, offsets, method).cpu())
+            pids.extend(batch_pids.tolist())
+            camids.extend(batch_camids.tolist())
+
+    return torch.cat(features, 0), np.asarray(pids), np.asarray(camids)
@@ -0,0 +1,217 @@
+from __future__ import absolute_import
+from __future__ import print_function
+
+import itertools
+import queue
+import random
+import time
+import traceback
+
+import numpy as np
+
+import torch
+import torch.multiprocessing as mp
+from torch.utils.data.dataloader import default_collate
+from torch.utils.data.sampler import BatchSampler, RandomSampler, SequentialSampler
+
+
+def _worker_loop(datasets, task_queue, result_queue, seed):
+    torch.set_num_threads(1)
+    random.seed(seed)
+    np.random.seed(seed % 2 ** 32)
+    torch.manual_seed(seed)
+
+    while True:
+        task = task_queue.get()
+        if task is None:
+            # results not read yet are discarded, instead of blocking the exit until they are
+            result_queue.cancel_join_thread()
+            break
+        key, loader_id, indices = task
+        try:
+            dataset, collate_fn = datasets[loader_id]
+            if hasattr(dataset, '__getitems__'):
+                samples = dataset.__getitems__(indices)
+            else:
+                samples = [dataset[i] for i in indices]
+            result_queue.put((key, collate_fn(samples), None))
+        except Exception:
+            result_queue.put((key, None, traceback.format_exc()))
+
+
+def _pin_memory(batch):
+    if isinstance(batch, torch.Tensor):
+        return batch.pin_memory()
+    if isinstance(batch, (list, tuple)):
+        return type(batch)(_pin_memory(x) for x in batch)
+    return batch
+
+
+class WorkerPool(object):
+    """
+    A pool of data loading processes shared by several `PooledDataLoader`s.
+
+    Workers are forked once, at the first iteration of any loader, and then
+    serve every loader for the rest of the run, so neither epochs nor
+    evaluations pay for forking workers again. All loaders must therefore
+    be created before the first iteration.
+
+    Args:
+    - num_workers (int): number of worker processes.
+    - prefetch (int): number of batches in flight per worker and loader.
+    """
+
+    def __init__(self, num_workers, prefetch=2):
+        self.num_workers = num_workers
+        self.prefetch = prefetch
+        self.datasets = {}
+        self.workers = []
+        self.startup_time = None
+        self._pending = {}
+        # iter_id of a dropped iterator -> number of its batches still to be discarded
+        self._dropped = {}
+        self._iter_ids = itertools.count()
+
+    def register(self, dataset, collate_fn=default_collate):
+        if self.workers:
+            raise RuntimeError("Cannot register datasets after the worker pool has started")
+        loader_id = len(self.datasets)
+        self.datasets[loader_id] = (dataset, collate_fn)
+        return loader_id
+
+    def start(self):
+        if self.workers:
+            return
+
+        start = time.time()
+        self.task_queue = mp.Queue()
+        self.result_queue = mp.Queue()
+        base_seed = torch.initial_seed()
+        for i in range(self.num_workers):
+            worker = mp.Process(
+                target=_worker_loop,
+                args=(self.datasets, self.task_queue, self.result_queue, base_seed + i)
+            )
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+        self.startup_time = time.time() - start
+        print("=> Started {} shared data loading workers in {:.3f}s".format(self.num_workers, self.startup_time))
+
+    def shutdown(self):
+        """Stop the workers; batches still in flight are discarded."""
+        if not self.workers:
+            return
+        for _ in self.workers:
+            self.task_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+        self._pending.clear()
+        self._dropped.clear()
+
+    def submit(self, key, loader_id, indices):
+        self.task_queue.put((key, loader_id, indices))
+
+    def _check_workers(self):
+        for i, worker in enumerate(self.workers):
+            if not worker.is_alive():
+                raise RuntimeError("Data loading worker {} (pid {}) exited unexpectedly with exit code {}".format(
+                    i, worker.pid, worker.exitcode))
+
+    def get(self, key, timeout=5):
+        while key not in self._pending:
+            try:
+                result_key, batch, error = self.result_queue.get(timeout=timeout)
+            except queue.Empty:
+                # e.g. killed by the OOM killer, its batches would never come
+                self._check_workers()
+                continue
+            except ConnectionError:
+                # the tensors of a batch are shared through its worker, which may be gone
+                self._check_workers()
+                raise
+            if error is not None:
+                raise RuntimeError("Caught exception in data loading worker:\n{}".format(error))
+            iter_id = result_key[0]
+            if iter_id not in self._dropped:
+                self._pending[result_key] = batch
+                continue
+            self._dropped[iter_id] -= 1
+            if self._dropped[iter_id] == 0:
+                del self._dropped[iter_id]
+        return self._pending.pop(key)
+
+    def drop(self, iter_id, num_outstanding):
+        """
+        Discard batches of an iterator that was not exhausted, of which
+        `num_outstanding` were submitted but not taken with `get`.
+        """
+        for key in [k for k in self._pending if k[0] == iter_id]:
+            del self._pending[key]
+            num_outstanding -= 1
+        if num_outstanding > 0:
+            self._dropped[iter_id] = num_outstanding
+
+
+class _PooledDataLoaderIter(object):
+
+    def __init__(self, loader):
+        self.loader = loader
+        self.pool = loader.pool
+        self.pool.start()
+
+        self.iter_id = next(self.pool._iter_ids)
+        self.batches = iter(loader.batch_sampler)
+        self.num_sent = self.num_received = 0
+        for _ in range(self.pool.prefetch * max(self.pool.num_workers, 1)):
+            self._submit()
+
+    def _submit(self):
+        indices = next(self.batches, None)
+        if indices is None:
+            return
+        self.pool.submit((self.iter_id, self.num_sent), self.loader.loader_id, list(indices))
+        self.num_sent += 1
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.num_received == self.num_sent:
+            raise StopIteration
+        batch = self.pool.get((self.iter_id, self.num_received))
+        self.num_received += 1
+        self._submit()
+        if self.loader.pin_memory:
+            batch = _pin_memory(batch)
+        return batch
+
+    def __del__(self):
+        if self.num_received < self.num_sent:
+            self.pool.drop(self.iter_id, self.num_sent - self.num_received)
+
+
+class PooledDataLoader(object):
+    """
+    Drop-in replacement of `DataLoader` whose batches are produced by a
+    shared `WorkerPool`.
+    """
+
+    def __init__(self, pool, dataset, batch_size=1, shuffle=False, sampler=None, batch_sampler=None,
+                 collate_fn=default_collate, pin_memory=False, drop_last=False):
+        self.pool = pool
+        self.dataset = dataset
+        self.pin_memory = pin_memory
+        if batch_sampler is None:
+            if sampler is None:
+                sampler = RandomSampler(dataset) if shuffle else SequentialSampler(dataset)
+            batch_sampler = BatchSampler(sampler, batch_size, drop_last)
+        self.batch_sampler = batch_sampler
+        self.loader_id = pool.register(dataset, collate_fn)
+
+    def __iter__(self):
+        return _PooledDataLoaderIter(self)
+
+    def __len__(self):
+        return len(self.batch_sampler)
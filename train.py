@@ -16,13 +16,23 @@ from torch.optim import lr_scheduler
 from args import argument_parser, image_dataset_kwargs, optimizer_kwargs
 from torchreid.data_manager import ImageDataManager
 from torchreid import models
-from torchreid.utils.iotools import save_checkpoint, check_isfile
+from torchreid.utils.iotools import check_isfile
+from torchreid.utils.checkpoint import CheckpointManager, get_rng_state, set_rng_state
+from torchreid.utils.feature_cache import build_feature_cache, CachedFeatureLoader
+from torchreid.samplers import get_pids
 from torchreid.utils.avgmeter import AverageMeter
+from torchreid.utils.step_timer import StepTimer, peak_memory_mb
+from torchreid.utils.profiling import Profiler, parse_step_range
+from torchreid.utils.proxy_eval import bootstrap_ci
+from torchreid.utils.background_eval import launch_eval_worker, list_checkpoints, append_result, ResultsReader, \
+    parse_cpus
 from torchreid.utils.loggers import Logger, RankLogger
-from torchreid.utils.torchtools import count_num_param, open_all_layers, open_specified_layers
+from torchreid.utils.torchtools import count_num_param, open_all_layers, open_specified_layers, to_channels_last
 from torchreid.utils.reidtools import visualize_ranked_results
-from torchreid.eval_metrics import evaluate
-from torchreid.optimizers import init_optimizer
+from torchreid.utils.distributed import init_distributed, is_main_process, get_rank, get_world_size, get_local_rank, \
+    barrier, unwrap_model, cleanup_distributed
+from torchreid.eval_metrics import evaluate, eval_market1501_per_query
+from torchreid.optimizers import init_optimizer, optimizer_state_dict, load_optimizer_state_dict
 from torchreid.regularizers import get_regularizer
 
 
@@ -62,9 +72,15 @@ def main():
     use_gpu = torch.cuda.is_available()
     if args.use_cpu:
         use_gpu = False
+    # launched by torchrun: one process per GPU (or CPU worker), see README
+    distributed = init_distributed(use_gpu, args.dist_backend)
     log_name = 'log_test.txt' if args.evaluate else 'log_train.txt'
+    if not is_main_process():
+        log_name = '{}.rank{}.txt'.format(osp.splitext(log_name)[0], get_rank())
     sys.stderr = sys.stdout = Logger(osp.join(args.save_dir, log_name))
     print("==========\nArgs:{}\n==========".format(args))
+    if distributed:
+        print("Distributed training: rank {} of {}, local rank {}".format(get_rank(), get_world_size(), get_local_rank()))
 
     if use_gpu:
         print("Currently using GPU {}".format(args.gpu_devices))
@@ -76,24 +92,36 @@ def main():
     print("Initializing image data manager")
     dm = ImageDataManager(use_gpu, **image_dataset_kwargs(args))
     trainloader, testloader_dict = dm.return_dataloaders()
+    proxy_testloader_dict = build_proxy_testloaders(dm, testloader_dict)
 
     print("Initializing model: {}".format(args.arch))
     model = models.init_model(name=args.arch, num_classes=dm.num_train_pids, loss={'xent'}, use_gpu=use_gpu, args=vars(args))
     print(model)
     print("Model size: {:.3f} M".format(count_num_param(model)))
 
+    if hasattr(model, 'identity_prototypes'):
+        # `model` is looked up at call time, i.e. after being wrapped by DataParallel
+        dm.set_prototype_fn(lambda: unwrap_model(model).identity_prototypes())
+
+    if use_gpu:
+        # before building the optimizer: ZeroRedundancyOptimizer communicates on the device of the
+        # parameters, and NCCL has no CPU backend
+        model = model.cuda()
+
     criterion = get_criterion(dm.num_train_pids, use_gpu, args)
     regularizer = get_regularizer(vars(args))
-    optimizer = init_optimizer(model.parameters(), **optimizer_kwargs(args))
+    if args.zero_optimizer and not distributed:
+        print("=> Warning: --zero-optimizer is ignored without distributed training, launch with torchrun")
+    optimizer = init_optimizer(model.parameters(), zero=args.zero_optimizer and distributed, **optimizer_kwargs(args))
     scheduler = lr_scheduler.MultiStepLR(optimizer, milestones=args.stepsize, gamma=args.gamma)
 
     if args.load_weights and check_isfile(args.load_weights):
         # load pretrained weights but ignore layers that don't match in size
         try:
-            checkpoint = torch.load(args.load_weights)
+            checkpoint = torch.load(args.load_weights, weights_only=False)
         except Exception as e:
             print(e)
-            checkpoint = torch.load(args.load_weights, map_location={'cuda:0': 'cpu'})
+            checkpoint = torch.load(args.load_weights, map_location={'cuda:0': 'cpu'}, weights_only=False)
 
         pretrain_dict = checkpoint['state_dict']
         model_dict = model.state_dict()
@@ -103,29 +131,66 @@ def main():
         model.load_state_dict(model_dict)
         print("Loaded pretrained weights from '{}'".format(args.load_weights))
 
+    # full training state, restored once the optimizer, scaler, etc. are ready
+    resume_state = None
     if args.resume and check_isfile(args.resume):
-        checkpoint = torch.load(args.resume)
+        checkpoint = torch.load(args.resume, map_location='cpu', weights_only=False)
         state = model.state_dict()
         state.update(checkpoint['state_dict'])
         model.load_state_dict(state)
-        # args.start_epoch = checkpoint['epoch'] + 1
+        if 'optimizer' in checkpoint:
+            resume_state = checkpoint
         print("Loaded checkpoint from '{}'".format(args.resume))
-        print("- start_epoch: {}\n- rank1: {}".format(args.start_epoch, checkpoint['rank1']))
+        print("- epoch: {}\n- rank1: {}".format(checkpoint['epoch'] + 1, checkpoint['rank1']))
+
+    if args.activation_checkpointing:
+        if not hasattr(model, 'set_activation_checkpointing'):
+            raise ValueError("--activation-checkpointing is not supported by {}".format(args.arch))
+        print("Using activation checkpointing for {}".format(', '.join(args.activation_checkpointing)))
+        model.set_activation_checkpointing(args.activation_checkpointing)
+
+    if args.channels_last:
+        print("Using channels_last memory format")
+        to_channels_last(model)
+
+    if args.compile:
+        if use_gpu and not distributed and torch.cuda.device_count() > 1:
+            # DataParallel replicas would all call the forward compiled for the original module
+            print("=> Warning: --compile is ignored with DataParallel over several GPUs, launch with torchrun instead")
+        else:
+            print("Compiling model with torch.compile")
+            # in place: state_dict keys, unwrap_model() and DataParallel/DDP wrapping are unchanged
+            model.compile()
 
-    if use_gpu:
+    if distributed:
+        # unused parameters: layers frozen during fixbase epochs, branch outputs ignored by the criterion
+        if use_gpu:
+            model = nn.parallel.DistributedDataParallel(
+                model, device_ids=[get_local_rank()], find_unused_parameters=True)
+        else:
+            model = nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
+    elif use_gpu:
         model = nn.DataParallel(model).cuda()
 
+    # evaluation runs on rank 0 only, on the bare model
+    eval_model = unwrap_model(model) if distributed else model
+    eval_profiler = Profiler(args.save_dir, 'eval', use_gpu, enabled=args.profile_eval)
+
     if args.evaluate:
+        if not is_main_process():
+            return
+
         print("Evaluate only")
 
         for name in args.target_names:
             print("Evaluating {} ...".format(name))
             if 'val' in testloader_dict[name]:                    
-                performance = test_classification(model, testloader_dict[name]['val'], use_gpu) / 100
+                performance = test_classification(eval_model, testloader_dict[name]['val'], use_gpu, batch_transform=dm.test_batch_transform) / 100
             else:
                 queryloader = testloader_dict[name]['query'], testloader_dict[name]['query_flip']
                 galleryloader = testloader_dict[name]['gallery'], testloader_dict[name]['gallery_flip']
-                performance = test_reid(model, queryloader, galleryloader, use_gpu)
+                performance = test_reid(eval_model, queryloader, galleryloader, use_gpu,
+                                        batch_transform=dm.test_batch_transform, profiler=eval_profiler)
 
             if args.visualize_ranks:
                 visualize_ranked_results(
@@ -133,84 +198,344 @@ def main():
                     save_dir=osp.join(args.save_dir, 'ranked_results', name),
                     topk=20
                 )
+        dm.shutdown_workers()
         return
 
-    start_time = time.time()
+    # loss scaling is only needed for fp16, i.e. on GPU; bf16 on CPU has the range of fp32
+    scaler = torch.amp.GradScaler('cuda', enabled=args.amp and use_gpu)
+    if args.amp:
+        print("Using mixed precision training ({})".format('fp16' if use_gpu else 'bf16'))
+
+    step_timer = StepTimer(use_gpu=use_gpu)
+    if args.step_stats_freq > 0 and is_main_process():
+        step_timer = StepTimer(osp.join(args.save_dir, 'step_stats.jsonl'), args.step_stats_freq,
+                               sync=args.sync_timing, use_gpu=use_gpu, append=resume_state is not None)
+        print("Writing per-phase step timings to {}".format(step_timer.fpath))
+    # steps are counted over all epochs, fixbase ones included
+    train_profiler = Profiler(args.save_dir, 'train' if is_main_process() else 'train.rank{}'.format(get_rank()),
+                              use_gpu, steps=parse_step_range(args.profile_steps))
+
     ranklogger = RankLogger(args.source_names, args.target_names)
+    max_performance = 0
+    if resume_state is not None:
+        load_optimizer_state_dict(optimizer, resume_state['optimizer'])
+        scheduler.load_state_dict(resume_state['scheduler'])
+        if resume_state['scaler']:
+            scaler.load_state_dict(resume_state['scaler'])
+        if resume_state['criterion'] is not None:
+            criterion.load_state_dict(resume_state['criterion'])
+        dm.load_sampler_state_dict(resume_state['sampler'])
+        if resume_state['batch_transform'] is not None:
+            dm.train_batch_transform.load_state_dict(resume_state['batch_transform'])
+        set_rng_state(resume_state['rng_state'])
+        ranklogger.load_state_dict(resume_state['ranklogger'])
+        max_performance = resume_state['max_performance']
+        args.start_epoch = resume_state['epoch'] + 1
+        print("Resuming training from epoch {}".format(args.start_epoch + 1))
+
+    checkpoint_manager = CheckpointManager(args.save_dir, keep_last=args.keep_checkpoints)
+    eval_worker_process = eval_results = None
+    if args.background_eval and is_main_process():
+        eval_results = ResultsReader(args.save_dir)
+        eval_worker_process = launch_eval_worker(
+            __file__, sys.argv[1:], gpu_devices=args.eval_gpu_devices,
+            cpus=parse_cpus(args.eval_cpus) if args.eval_cpus else None
+        )
+        print("Started background evaluation, pid {}, logging to {}".format(
+            eval_worker_process.pid, osp.join(args.save_dir, 'log_eval.txt')))
+
+    start_time = time.time()
     train_time = 0
     print("==> Start training")
 
-    if args.fixbase_epoch > 0:
+    if args.fixbase_epoch > 0 and resume_state is None:
         print("Train {} for {} epochs while keeping other layers frozen".format(args.open_layers, args.fixbase_epoch))
-        initial_optim_state = optimizer.state_dict()
+        initial_optim_state = optimizer_state_dict(optimizer, all_ranks=True)
+
+        fixbase_loader = trainloader
+        if args.fixbase_cache > 0:
+            start_train_time = time.time()
+            fixbase_loader = build_fixbase_loader(model, dm, use_gpu)
+            train_time += round(time.time() - start_train_time)
 
         for epoch in range(args.fixbase_epoch):
             start_train_time = time.time()
-            train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=True)
+            dm.set_epoch(epoch)
+            if fixbase_loader is not trainloader:
+                fixbase_loader.set_epoch(epoch)
+            train(epoch, model, criterion, regularizer, optimizer, fixbase_loader, use_gpu, fixbase=True,
+                  batch_transform=dm.train_batch_transform, scaler=scaler, step_timer=step_timer,
+                  profiler=train_profiler)
             train_time += round(time.time() - start_train_time)
 
-        print("Done. All layers are open to train for {} epochs".format(args.max_epoch))
-        optimizer.load_state_dict(initial_optim_state)
+        if fixbase_loader is not trainloader:
+            fixbase_loader.cache.close()
 
-    max_performance = 0
+        print("Done. All layers are open to train for {} epochs".format(args.max_epoch))
+        load_optimizer_state_dict(optimizer, initial_optim_state)
 
     for epoch in range(args.start_epoch, args.max_epoch):
         start_train_time = time.time()
         print(epoch)
         print(criterion)
+        dm.set_epoch(args.fixbase_epoch + epoch)
 
-        train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False)
+        train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False,
+              batch_transform=dm.train_batch_transform, scaler=scaler, step_timer=step_timer,
+              profiler=train_profiler)
         train_time += round(time.time() - start_train_time)
 
-        if use_gpu:
-            state_dict = model.module.state_dict()
-        else:
-            state_dict = model.state_dict()
+        scheduler.step()
+        # gathered by all ranks, before the other ranks skip to the next epoch at evaluation
+        optimizer_state = optimizer_state_dict(optimizer)
 
-        save_checkpoint({
-            'state_dict': state_dict,
-            'rank1': 0,
-            'epoch': epoch,
-        }, False, osp.join(args.save_dir, 'checkpoint_latest.pth.tar'))
+        performance = 0
+        is_best = False
 
-        scheduler.step()
+        run_eval, full_eval = eval_schedule(epoch)
 
-        if (epoch + 1) > args.start_eval and args.eval_freq > 0 and (epoch + 1) % args.eval_freq == 0 or (epoch + 1) == args.max_epoch:
-            print("==> Test")
-
-            for name in args.target_names:
-                print("Evaluating {} ...".format(name))
-                if 'val' in testloader_dict[name]:                    
-                    performance = test_classification(model, testloader_dict[name]['val'], use_gpu)
-                else:
-                    queryloader = testloader_dict[name]['query'], testloader_dict[name]['query_flip']
-                    galleryloader = testloader_dict[name]['gallery'], testloader_dict[name]['gallery_flip']
-                    performance = test_reid(model, queryloader, galleryloader, use_gpu)
-                ranklogger.write(name, epoch + 1, performance)
+        if run_eval and not args.background_eval:
+            if not is_main_process():
+                # wait for rank 0 to finish evaluating
+                barrier()
+                continue
 
-            if use_gpu:
-                state_dict = model.module.state_dict()
-            else:
-                state_dict = model.state_dict()
+            print("==> Test" if full_eval else "==> Proxy test")
 
-            if max_performance < performance:
-                print('Save!', max_performance, performance)
-                save_checkpoint({
-                    'state_dict': state_dict,
-                    'rank1': performance,
-                    'epoch': epoch,
-                }, False, osp.join(args.save_dir, 'checkpoint_best.pth.tar'))
+            for name, performance in evaluate_targets(eval_model, dm, testloader_dict, proxy_testloader_dict, use_gpu,
+                                                      full_eval, profiler=eval_profiler).items():
+                if full_eval:
+                    ranklogger.write(name, epoch + 1, performance)
 
+            # proxy estimates are biased, only full evaluations select the best model
+            if full_eval and max_performance < performance:
+                print('Save!', max_performance, performance)
                 max_performance = performance
+                is_best = True
+
+            barrier()
+
+        if is_main_process():
+            # snapshot now, written in the background while the next epoch trains
+            checkpoint_manager.save({
+                'state_dict': unwrap_model(model).state_dict(),
+                'optimizer': optimizer_state,
+                'scheduler': scheduler.state_dict(),
+                'scaler': scaler.state_dict(),
+                'criterion': criterion.state_dict() if isinstance(criterion, nn.Module) else None,
+                'sampler': dm.sampler_state_dict(),
+                'batch_transform': dm.train_batch_transform.state_dict() if dm.train_batch_transform is not None else None,
+                'rng_state': get_rng_state(),
+                'ranklogger': ranklogger.state_dict(),
+                'rank1': performance,
+                'max_performance': max_performance,
+                'epoch': epoch,
+            }, epoch, is_best=is_best, hold=run_eval and args.background_eval)
+
+        if eval_results is not None:
+            max_performance = poll_eval_results(eval_results, checkpoint_manager, ranklogger, max_performance)
+
+    if eval_worker_process is not None:
+        checkpoint_manager.wait()
+        if checkpoint_manager.held:
+            print("Waiting for the background evaluation of {} checkpoints".format(len(checkpoint_manager.held)))
+        while checkpoint_manager.held and eval_worker_process.poll() is None:
+            time.sleep(5)
+            max_performance = poll_eval_results(eval_results, checkpoint_manager, ranklogger, max_performance)
+            checkpoint_manager.wait()
+        if checkpoint_manager.held:
+            print("=> Warning: the background evaluation exited with code {}, see log_eval.txt".format(
+                eval_worker_process.returncode))
+        eval_worker_process.terminate()
+        eval_worker_process.wait()
+
+    checkpoint_manager.close()
+    train_profiler.close()
+    dm.shutdown_workers()
 
     elapsed = round(time.time() - start_time)
     elapsed = str(datetime.timedelta(seconds=elapsed))
     train_time = str(datetime.timedelta(seconds=train_time))
     print("Finished. Total elapsed time (h:m:s): {}. Training time (h:m:s): {}.".format(elapsed, train_time))
     ranklogger.show_summary()
+    if is_main_process():
+        # read by scheduler.py
+        ranklogger.save(osp.join(args.save_dir, 'summary.json'), elapsed=elapsed, train_time=train_time)
+
+
+def eval_schedule(epoch):
+    """
+    Return whether to evaluate after `epoch`, and whether on the full test
+    sets (or on the proxy ones of --proxy-eval-ids).
+    """
+    eval_epoch = (epoch + 1) > args.start_eval and args.eval_freq > 0 and (epoch + 1) % args.eval_freq == 0
+    if args.proxy_eval_ids > 0:
+        # proxy evaluation at eval epochs, full evaluation (for model selection) every full_eval_freq epochs
+        full_eval = (epoch + 1) > args.start_eval and args.full_eval_freq > 0 and (epoch + 1) % args.full_eval_freq == 0
+    else:
+        full_eval = eval_epoch
+    full_eval = full_eval or (epoch + 1) == args.max_epoch
+    return eval_epoch or full_eval, full_eval
+
+
+def build_proxy_testloaders(dm, testloader_dict):
+    """
+    For --proxy-eval-ids: the proxy test loaders of every reid target
+    """
+    proxy_testloader_dict = {}
+    if args.proxy_eval_ids > 0:
+        for name in args.target_names:
+            if testloader_dict[name].get('query') is not None:
+                proxy_testloader_dict[name] = dm.return_proxy_testloaders(
+                    testloader_dict[name], args.proxy_eval_ids, args.proxy_eval_negatives, seed=args.seed
+                )
+    return proxy_testloader_dict
+
+
+def evaluate_targets(model, dm, testloader_dict, proxy_testloader_dict, use_gpu, full_eval, profiler=None):
+    """
+    Evaluate `model` on every target, return {name: performance}
+    """
+    performances = {}
+    for name in args.target_names:
+        print("Evaluating {} ...".format(name))
+        if 'val' in testloader_dict[name]:
+            performances[name] = test_classification(model, testloader_dict[name]['val'], use_gpu,
+                                                     batch_transform=dm.test_batch_transform)
+        else:
+            loaders = testloader_dict[name] if full_eval else proxy_testloader_dict[name]
+            queryloader = loaders['query'], loaders['query_flip']
+            galleryloader = loaders['gallery'], loaders['gallery_flip']
+            performances[name] = test_reid(model, queryloader, galleryloader, use_gpu,
+                                           batch_transform=dm.test_batch_transform, profiler=profiler,
+                                           proxy=not full_eval)
+    return performances
+
+
+def poll_eval_results(eval_results, checkpoint_manager, ranklogger, max_performance):
+    """
+    For --background-eval: log the new results of the evaluation worker,
+    release their checkpoints and link the best one. Return the updated max_performance.
+    """
+    for result in eval_results.poll():
+        epoch, performance = result['epoch'], 0
+        print("Background {}evaluation of epoch {}: {}".format(
+            '' if result['full'] else 'proxy ', epoch + 1, result['performance']))
+        for name in args.target_names:
+            performance = result['performance'][name]
+            # when resuming, the results file is read again from the start
+            if result['full'] and epoch + 1 not in ranklogger.logger[name]['epoch']:
+                ranklogger.write(name, epoch + 1, performance)
+
+        # proxy estimates are biased, only full evaluations select the best model
+        is_best = result['full'] and max_performance < performance
+        if is_best:
+            print('Save!', max_performance, performance)
+            max_performance = performance
+        checkpoint_manager.release(epoch, is_best=is_best)
+    return max_performance
+
+
+def eval_worker():
+    """
+    For --background-eval: evaluate the checkpoints of the evaluation epochs
+    as the training process writes them to --save-dir, and append the
+    results to eval_results.jsonl there. Exit after the last epoch, or when
+    the training process is gone.
+    """
+    parent_pid = os.getppid()
+    torch.manual_seed(args.seed)
+    if not args.use_avai_gpus:
+        os.environ['CUDA_VISIBLE_DEVICES'] = args.gpu_devices
+    use_gpu = torch.cuda.is_available() and not args.use_cpu
+    if args.eval_cpus:
+        torch.set_num_threads(len(os.sched_getaffinity(0)))
+    sys.stderr = sys.stdout = Logger(osp.join(args.save_dir, 'log_eval.txt'))
+    print("==========\nArgs:{}\n==========".format(args))
+
+    dm = ImageDataManager(use_gpu, **image_dataset_kwargs(args))
+    _, testloader_dict = dm.return_dataloaders()
+    proxy_testloader_dict = build_proxy_testloaders(dm, testloader_dict)
+
+    model = models.init_model(name=args.arch, num_classes=dm.num_train_pids, loss={'xent'}, use_gpu=use_gpu, args=vars(args))
+    if args.channels_last:
+        to_channels_last(model)
+    if use_gpu:
+        model = model.cuda()
+
+    evaluated = {result['epoch'] for result in ResultsReader(args.save_dir).poll()}
+    while args.max_epoch - 1 not in evaluated:
+        checkpoints = [(epoch, fpath) for epoch, fpath in list_checkpoints(args.save_dir)
+                       if epoch not in evaluated and eval_schedule(epoch)[0]]
+        if not checkpoints:
+            if os.getppid() != parent_pid:
+                print("=> Training process is gone, exiting")
+                dm.shutdown_workers()
+                return
+            time.sleep(5)
+            continue
+
+        epoch, fpath = checkpoints[0]
+        print("==> Test {}".format(fpath))
+        start = time.time()
+        # checkpoints that are not held (e.g. of an earlier run) may be removed meanwhile
+        try:
+            checkpoint = torch.load(fpath, map_location='cpu', weights_only=False)
+        except FileNotFoundError:
+            continue
+        model.load_state_dict(checkpoint['state_dict'])
+
+        full_eval = eval_schedule(epoch)[1]
+        performances = evaluate_targets(model, dm, testloader_dict, proxy_testloader_dict, use_gpu, full_eval)
+        append_result(args.save_dir, {
+            'epoch': epoch,
+            'checkpoint': osp.basename(fpath),
+            'full': full_eval,
+            'performance': {name: float(performance) for name, performance in performances.items()},
+            'eval_time': time.time() - start,
+        })
+        evaluated.add(epoch)
+    dm.shutdown_workers()
 
 
-def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False):
+def build_fixbase_loader(model, dm, use_gpu):
+    """
+    For --fixbase-cache: cache the outputs of the frozen backbone of a
+    multi-branch model and return a loader of them, to train the heads from.
+    Return the trainloader if the backbone is not entirely frozen.
+    """
+    net = unwrap_model(model)
+    if not hasattr(net, 'forward_middle'):
+        print("=> Warning: --fixbase-cache is not supported by {}, ignored".format(args.arch))
+        return dm.trainloader
+
+    open_specified_layers(model, args.open_layers)
+    frozen = [net.common_branch] + [middle_subbranch for middle_subbranch, _ in net.branches]
+    if any(p.requires_grad for module in frozen for p in module.parameters()) or \
+            any(m.training for module in frozen for m in module.modules()):
+        print("=> Warning: --fixbase-cache is ignored, as layers of the backbone are trained during fixbase epochs "
+              "(e.g. the CAM of --shallow-cam)")
+        return dm.trainloader
+
+    print("Caching the outputs of the frozen backbone for {} augmented variants of the training set".format(args.fixbase_cache))
+    # every rank caches its own augmented variants, in its own files
+    fname = 'fixbase_cache' if is_main_process() else 'fixbase_cache.rank{}'.format(get_rank())
+    cache = build_feature_cache(net, dm.return_sequential_trainloader(), args.fixbase_cache, use_gpu,
+                                batch_transform=dm.train_batch_transform, fpath=osp.join(args.save_dir, fname))
+    return CachedFeatureLoader(cache, dm.trainloader, get_pids(dm.train))
+
+
+def autocast(use_gpu):
+    """
+    Mixed precision context for --amp: fp16 on GPU, bf16 on CPU
+    """
+    if use_gpu:
+        return torch.autocast('cuda', dtype=torch.float16, enabled=args.amp)
+    return torch.autocast('cpu', dtype=torch.bfloat16, enabled=args.amp)
+
+
+def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False, batch_transform=None,
+          scaler=None, step_timer=None, profiler=None):
 
     if not fixbase and args.use_of and epoch >= args.of_start_epoch:
         print('Using OF')
@@ -219,9 +544,18 @@ def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu,
 
     of_penalty = OFPenalty(vars(args))
 
+    if scaler is None:
+        scaler = torch.amp.GradScaler('cuda', enabled=False)
+    if step_timer is None:
+        step_timer = StepTimer(use_gpu=use_gpu)
+    if profiler is None:
+        profiler = Profiler(None, 'train', use_gpu, enabled=False)
+
     losses = AverageMeter()
     batch_time = AverageMeter()
     data_time = AverageMeter()
+    # the step timer resets the peak memory statistics with every record, keep the max of the epoch
+    epoch_peak = 0.
 
     model.train()
 
@@ -230,6 +564,9 @@ def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu,
     else:
         open_all_layers(model)
 
+    # batches of cached backbone outputs instead of images, see --fixbase-cache
+    from_cache = isinstance(trainloader, CachedFeatureLoader)
+
     end = time.time()
     for batch_idx, (imgs, pids, _, _) in enumerate(trainloader):
 
@@ -242,28 +579,51 @@ def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu,
             break
 
         data_time.update(time.time() - end)
-
-        if use_gpu:
-            imgs, pids = imgs.cuda(), pids.cuda()
-
-        outputs = model(imgs)
-        loss = criterion(outputs, pids)
-        if not fixbase:
-            reg = regularizer(model)
-            loss += reg
-        if not fixbase and args.use_of and epoch >= args.of_start_epoch:
-
-            penalty = of_penalty(outputs)
-            loss += penalty
-
-        optimizer.zero_grad()
-        loss.backward()
-
-        optimizer.step()
+        profiler.step()
+        if batch_idx == 0:
+            print('Epoch: [{0}] loader startup (until first batch) {1:.3f}s'.format(epoch + 1, data_time.val))
+            # the records of an epoch start at its first batch, the startup is reported above
+            step_timer.reset()
+        else:
+            step_timer.add('data', data_time.val)
+
+        with step_timer.phase('h2d'):
+            if use_gpu and from_cache:
+                imgs, pids = [f.cuda() for f in imgs], pids.cuda()
+            elif use_gpu:
+                imgs, pids = imgs.cuda(), pids.cuda()
+
+        with step_timer.phase('batch_transform'):
+            if batch_transform is not None and not from_cache:
+                imgs = batch_transform(imgs)
+
+        with autocast(use_gpu):
+            with step_timer.phase('forward'):
+                outputs = model(imgs, from_middle=True) if from_cache else model(imgs)
+            with step_timer.phase('criterion'):
+                loss = criterion(outputs, pids)
+            if not fixbase:
+                with step_timer.phase('regularizer'):
+                    reg = regularizer(model)
+                loss += reg
+            if not fixbase and args.use_of and epoch >= args.of_start_epoch:
+                with step_timer.phase('of_penalty'):
+                    penalty = of_penalty(outputs)
+                loss += penalty
+
+        with step_timer.phase('backward'):
+            optimizer.zero_grad()
+            scaler.scale(loss).backward()
+
+        with step_timer.phase('optimizer'):
+            scaler.step(optimizer)
+            scaler.update()
 
         batch_time.update(time.time() - end)
 
         losses.update(loss.item(), pids.size(0))
+        epoch_peak = max(epoch_peak, peak_memory_mb(use_gpu) or 0.)
+        step_timer.step(epoch, batch_idx, pids.size(0), losses.val)
 
         if (batch_idx + 1) % args.print_freq == 0:
             print('Epoch: [{0}][{1}/{2}]\t'
@@ -275,6 +635,15 @@ def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu,
 
         end = time.time()
 
+    step_timer.flush()
+
+    # e.g. to weigh the memory saved by --activation-checkpointing against the time spent recomputing
+    peak = peak_memory_mb(use_gpu)
+    if peak is not None:
+        peak = max(peak, epoch_peak)
+    print('Epoch: [{0}] {1:.3f}s/step, peak memory {2}'.format(
+        epoch + 1, batch_time.avg, 'n/a' if peak is None else '{:.0f} MB'.format(peak)))
+
 def accuracy(output, target, topk=(1,)):
     """Computes the accuracy over the k top predictions for
     the specified values of k.
@@ -307,7 +676,7 @@ def accuracy(output, target, topk=(1,)):
 
     return res
 
-def test_classification(model, valloader, use_gpu):
+def test_classification(model, valloader, use_gpu, batch_transform=None):
 
     from collections import defaultdict
 
@@ -322,6 +691,9 @@ def test_classification(model, valloader, use_gpu):
             if use_gpu:
                 imgs = imgs.cuda()
 
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
+
             features_tuple = model(imgs)[1]
 
             for index, features in enumerate(features_tuple):
@@ -344,7 +716,8 @@ def test_classification(model, valloader, use_gpu):
         return final_acc
 
 
-def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20], return_distmat=False):
+def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20], return_distmat=False, batch_transform=None,
+              profiler=None, proxy=False):
 
     flip_eval = args.flip_eval
 
@@ -352,10 +725,12 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
         print('# Using Flip Eval')
 
     batch_time = AverageMeter()
+    if profiler is None:
+        profiler = Profiler(None, 'eval', use_gpu, enabled=False)
 
     model.eval()
 
-    with torch.no_grad():
+    with torch.no_grad(), profiler.capture():
         qf, q_pids, q_camids, q_paths = [], [], [], []
 
         if flip_eval:
@@ -370,12 +745,16 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
                 (imgs0, pids, camids, paths), (imgs1, _, _, _) = package
                 if use_gpu:
                     imgs0, imgs1 = imgs0.cuda(), imgs1.cuda()
+                if batch_transform is not None:
+                    imgs0, imgs1 = batch_transform(imgs0), batch_transform(imgs1)
                 features = (model(imgs0)[0] + model(imgs1)[0]) / 2.0
                 # print(features.size())
             else:
                 (imgs, pids, camids, paths) = package
                 if use_gpu:
                     imgs = imgs.cuda()
+                if batch_transform is not None:
+                    imgs = batch_transform(imgs)
 
                 features = model(imgs)[0]
 
@@ -406,12 +785,16 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
                 (imgs0, pids, camids, paths), (imgs1, _, _, _) = package
                 if use_gpu:
                     imgs0, imgs1 = imgs0.cuda(), imgs1.cuda()
+                if batch_transform is not None:
+                    imgs0, imgs1 = batch_transform(imgs0), batch_transform(imgs1)
                 features = (model(imgs0)[0] + model(imgs1)[0]) / 2.0
                 # print(features.size())
             else:
                 (imgs, pids, camids, _) = package
                 if use_gpu:
                     imgs = imgs.cuda()
+                if batch_transform is not None:
+                    imgs = batch_transform(imgs)
 
                 features = model(imgs)[0]
 
@@ -445,6 +828,18 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
         import scipy.io as io
         io.savemat(os.environ.get('distmat'), {'distmat': distmat, 'qp': q_paths, 'gp': g_paths})
 
+    if proxy:
+        print("Computing proxy Rank-1 and mAP")
+        valid, rank1, AP = eval_market1501_per_query(distmat, q_pids, g_pids, q_camids, g_camids)
+        rank1, rank1_low, rank1_high = bootstrap_ci(rank1, q_pids[valid], seed=args.seed)
+        mAP, mAP_low, mAP_high = bootstrap_ci(AP, q_pids[valid], seed=args.seed)
+
+        print("Proxy results (95% CI) ----------")
+        print("mAP     : {:.2%} [{:.2%}, {:.2%}]".format(mAP, mAP_low, mAP_high))
+        print("Rank-1  : {:.2%} [{:.2%}, {:.2%}]".format(rank1, rank1_low, rank1_high))
+        print("------------------")
+        return rank1
+
     print("Computing CMC and mAP")
     cmc, mAP = evaluate(distmat, q_pids, g_pids, q_camids, g_camids, use_metric_cuhk03=args.use_metric_cuhk03)
 
@@ -461,4 +856,8 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
 
 
 if __name__ == '__main__':
-    main()
+    if args.eval_worker:
+        eval_worker()
+    else:
+        main()
+    cleanup_distributed()
@@ -121,11 +121,11 @@ def main():
         for name in args.target_names:
             print("Evaluating {} ...".format(name))
             if 'val' in testloader_dict[name]:                    
-                performance = test_classification(model, testloader_dict[name]['val'], use_gpu) / 100
+                performance = test_classification(model, testloader_dict[name]['val'], use_gpu, batch_transform=dm.test_batch_transform) / 100
             else:
                 queryloader = testloader_dict[name]['query'], testloader_dict[name]['query_flip']
                 galleryloader = testloader_dict[name]['gallery'], testloader_dict[name]['gallery_flip']
-                performance = test_reid(model, queryloader, galleryloader, use_gpu)
+                performance = test_reid(model, queryloader, galleryloader, use_gpu, batch_transform=dm.test_batch_transform)
 
             if args.visualize_ranks:
                 visualize_ranked_results(
@@ -146,7 +146,8 @@ def main():
 
         for epoch in range(args.fixbase_epoch):
             start_train_time = time.time()
-            train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=True)
+            train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=True,
+                  batch_transform=dm.train_batch_transform)
             train_time += round(time.time() - start_train_time)
 
         print("Done. All layers are open to train for {} epochs".format(args.max_epoch))
@@ -159,7 +160,8 @@ def main():
         print(epoch)
         print(criterion)
 
-        train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False)
+        train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False,
+              batch_transform=dm.train_batch_transform)
         train_time += round(time.time() - start_train_time)
 
         if use_gpu:
@@ -181,11 +183,11 @@ def main():
             for name in args.target_names:
                 print("Evaluating {} ...".format(name))
                 if 'val' in testloader_dict[name]:                    
-                    performance = test_classification(model, testloader_dict[name]['val'], use_gpu)
+                    performance = test_classification(model, testloader_dict[name]['val'], use_gpu, batch_transform=dm.test_batch_transform)
                 else:
                     queryloader = testloader_dict[name]['query'], testloader_dict[name]['query_flip']
                     galleryloader = testloader_dict[name]['gallery'], testloader_dict[name]['gallery_flip']
-                    performance = test_reid(model, queryloader, galleryloader, use_gpu)
+                    performance = test_reid(model, queryloader, galleryloader, use_gpu, batch_transform=dm.test_batch_transform)
                 ranklogger.write(name, epoch + 1, performance)
 
             if use_gpu:
@@ -210,7 +212,7 @@ def main():
     ranklogger.show_summary()
 
 
-def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False):
+def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu, fixbase=False, batch_transform=None):
 
     if not fixbase and args.use_of and epoch >= args.of_start_epoch:
         print('Using OF')
@@ -245,6 +247,8 @@ def train(epoch, model, criterion, regularizer, optimizer, trainloader, use_gpu,
 
         if use_gpu:
             imgs, pids = imgs.cuda(), pids.cuda()
+        if batch_transform is not None:
+            imgs = batch_transform(imgs)
 
         outputs = model(imgs)
         loss = criterion(outputs, pids)
@@ -307,7 +311,7 @@ def accuracy(output, target, topk=(1,)):
 
     return res
 
-def test_classification(model, valloader, use_gpu):
+def test_classification(model, valloader, use_gpu, batch_transform=None):
 
     from collections import defaultdict
 
@@ -321,6 +325,8 @@ def test_classification(model, valloader, use_gpu):
 
             if use_gpu:
                 imgs = imgs.cuda()
+            if batch_transform is not None:
+                imgs = batch_transform(imgs)
 
             features_tuple = model(imgs)[1]
 
@@ -344,7 +350,7 @@ def test_classification(model, valloader, use_gpu):
         return final_acc
 
 
-def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20], return_distmat=False):
+def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20], return_distmat=False, batch_transform=None):
 
     flip_eval = args.flip_eval
 
@@ -370,12 +376,16 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
                 (imgs0, pids, camids, paths), (imgs1, _, _, _) = package
                 if use_gpu:
                     imgs0, imgs1 = imgs0.cuda(), imgs1.cuda()
+                if batch_transform is not None:
+                    imgs0, imgs1 = batch_transform(imgs0), batch_transform(imgs1)
                 features = (model(imgs0)[0] + model(imgs1)[0]) / 2.0
                 # print(features.size())
             else:
                 (imgs, pids, camids, paths) = package
                 if use_gpu:
                     imgs = imgs.cuda()
+                if batch_transform is not None:
+                    imgs = batch_transform(imgs)
 
                 features = model(imgs)[0]
 
@@ -406,12 +416,16 @@ def test_reid(model, queryloader, galleryloader, use_gpu, ranks=[1, 5, 10, 20],
                 (imgs0, pids, camids, paths), (imgs1, _, _, _) = package
                 if use_gpu:
                     imgs0, imgs1 = imgs0.cuda(), imgs1.cuda()
+                if batch_transform is not None:
+                    imgs0, imgs1 = batch_transform(imgs0), batch_transform(imgs1)
                 features = (model(imgs0)[0] + model(imgs1)[0]) / 2.0
                 # print(features.size())
             else:
                 (imgs, pids, camids, _) = package
                 if use_gpu:
                     imgs = imgs.cuda()
+                if batch_transform is not None:
+                    imgs = batch_transform(imgs)
 
                 features = model(imgs)[0]
 